@@ -6,13 +6,14 @@ import logging
 import qt
 import ctk
 import vtk
+from RadioembolizationDosimetryLib import PARTIAL_VOLUME_AUTO, StageTimer, calculateLungShuntFraction, getSegmentMasks
 
 class LSFcalc(ScriptedLoadableModule):
     def __init__(self, parent):
         ScriptedLoadableModule.__init__(self, parent)
         parent.title = "Taranis - LSF Calculator"
         parent.categories = ["Nuclear Medicine"]
-        parent.dependencies = []
+        parent.dependencies = ["RadioembolizationDosimetry"]
         parent.contributors = ["Burak Demir, MD, FEBNM"]
         parent.helpText = """
         This module calculates lung shunt fraction before radioembolization treatment.
@@ -98,7 +99,13 @@ class LSFcalcWidget(ScriptedLoadableModuleWidget):
 
         # Connect segmentation selector to update liver segment selector
         self.segmentationSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.onSegmentationNodeChanged2)
-        
+
+        # Partial-volume segments
+        self.partialVolumeCheckBox = qt.QCheckBox()
+        self.partialVolumeCheckBox.setToolTip("Rasterise each segment at sub-voxel resolution and weight every voxel by the "
+                                              "fraction the segment covers.")
+        formLayout.addRow("Partial-volume Segments: ", self.partialVolumeCheckBox)
+
         # Calculate Button
         self.calculateButton = qt.QPushButton("Calculate")
         self.calculateButton.toolTip = "Perform dosimetric calculations."
@@ -157,12 +164,15 @@ class LSFcalcWidget(ScriptedLoadableModuleWidget):
 
         # Perform dosimetric calculations
         logic = LSFcalcLogic()
-        logic.calculateDose(spectVolumeNode, segmentationNode, lungSegmentID, liverSegmentID, self.lungTextBox,self.liverTextBox,self.lsfTextBox)
+        oversampling = PARTIAL_VOLUME_AUTO if self.partialVolumeCheckBox.checked else None
+        logic.calculateDose(spectVolumeNode, segmentationNode, lungSegmentID, liverSegmentID, self.lungTextBox,self.liverTextBox,self.lsfTextBox,
+                            oversampling)
 
 class LSFcalcLogic(ScriptedLoadableModuleLogic):
-    def calculateDose(self, spectVolumeNode, segmentationNode, lungSegmentID, liverSegmentID, lungTextBox,liverTextBox,lsfTextBox):
+    def calculateDose(self, spectVolumeNode, segmentationNode, lungSegmentID, liverSegmentID, lungTextBox,liverTextBox,lsfTextBox, oversampling=None):
         """
         Perform dosimetric calculations using the given inputs.
+        With oversampling, the segments are partial-volume masks (see getSegmentMasks).
         """
         logging.info("Starting dosimetric calculations.")
 
@@ -175,31 +185,17 @@ class LSFcalcLogic(ScriptedLoadableModuleLogic):
         if spectArray is None:
             raise ValueError("Unable to access data from the input SPECT volume.")
 
-        
-        # Calculate mean dose for each segment
-        liverlabelMapVolumeNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLabelMapVolumeNode")
-        slicer.modules.segmentations.logic().ExportSegmentsToLabelmapNode(
-            segmentationNode, [liverSegmentID], liverlabelMapVolumeNode, spectVolumeNode
-        )
- 
-        # Mask dose array to calculate liver
-        liverlabelMapArray = slicer.util.arrayFromVolume(liverlabelMapVolumeNode)
-        maskedDoseArray = spectArray[liverlabelMapArray == 1]
-        livercounts = np.sum(maskedDoseArray)
-
-
-
-        lunglabelMapVolumeNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLabelMapVolumeNode")
-        slicer.modules.segmentations.logic().ExportSegmentsToLabelmapNode(
-            segmentationNode, [lungSegmentID], lunglabelMapVolumeNode, spectVolumeNode
-        )
-
-        # Mask dose array to calculate lung
-        lunglabelMapArray = slicer.util.arrayFromVolume(lunglabelMapVolumeNode)
-        maskedDoseArray2 = spectArray[lunglabelMapArray == 1]
-        lungcounts = np.sum(maskedDoseArray2)        
-
-        lsf = (lungcounts/(lungcounts+livercounts))*100
+        with StageTimer("LSFcalc") as timer:
+            # Segment masks come from the shared labelmap cache, so unchanged segments are not exported again
+            with timer.stage("labelmapExport"):
+                segmentMasks = getSegmentMasks(segmentationNode, [liverSegmentID, lungSegmentID], spectVolumeNode,
+                                               oversampling=oversampling)
+
+            # Sum liver and lung counts in one pass over the bounding box of both segments
+            with timer.stage("lsfSums"):
+                lungcounts, livercounts, lsf = calculateLungShuntFraction(
+                    spectArray, segmentMasks[liverSegmentID], segmentMasks[lungSegmentID]
+                )
 
         lungTextBox.setText(f"{lungcounts:.2f}")
         liverTextBox.setText(f"{livercounts:.2f}")
@@ -6,6 +6,55 @@ import logging
 import qt
 import ctk
 import vtk
+from RadioembolizationDosimetryLib import (
+    DEFAULT_DVH_METRICS,
+    DEFAULT_ISODOSE_LEVELS,
+    DOSE_ENGINES,
+    DosimetryParameters,
+    BackgroundJob,
+    NORMAL_LIVER_TISSUE,
+    PARTIAL_VOLUME_AUTO,
+    ParameterUncertainty,
+    PartitionConstraints,
+    TUMOUR_TISSUE,
+    UncertaintyModel,
+    StageTimer,
+    acquireOutputVolume,
+    computeRelativeDoseState,
+    computeSegmentRadiobiology,
+    finishOutputVolume,
+    getChangedSegmentIDs,
+    formatRtfReport,
+    getSegmentIDs,
+    getSegmentMasks,
+    getMetricUnit,
+    getSegmentationStateKey,
+    maskVolumeWithLabelmap,
+    planPartitionActivity,
+    prepareOutputVolume,
+    propagateRelativeDoseUncertainty,
+    releaseOutputVolume,
+    timedStage,
+    writeDoseSweepCsv,
+)
+from RadioembolizationDosimetryLib.WidgetMixins import (
+    BackgroundJobWidgetMixin,
+    IsodoseWidgetMixin,
+    RadiobiologyWidgetMixin,
+    SegmentObserverWidgetMixin,
+)
+
+# Scenarios shown in the sweep table; the exported CSV always contains all of them
+SWEEP_TABLE_MAX_ROWS = 2000
+
+# Uncertain parameters: DosimetryParameters field, label, spread range and the factor from the spin box to the field unit
+UNCERTAINTY_PARAMETERS = [
+    ("lungShuntFraction", "Lung Shunt (%)", 100.0, 0.01),
+    ("lungMassG", "Lung Mass (g)", 5000.0, 1.0),
+    ("densityGPerML", "Liver Density (g/mL)", 10.0, 1.0),
+    ("conversionFactor", "Conversion Factor (Gy/MBq/g)", 100.0, 1.0),
+]
+UNCERTAINTY_DISTRIBUTIONS = ["fixed", "normal", "uniform"]
 
 class RadioembolizationDosimetry(ScriptedLoadableModule):
     def __init__(self, parent):
@@ -94,7 +143,8 @@ def registerSampleData():
     )
 
 
-class RadioembolizationDosimetryWidget(ScriptedLoadableModuleWidget):
+class RadioembolizationDosimetryWidget(BackgroundJobWidgetMixin, RadiobiologyWidgetMixin, IsodoseWidgetMixin,
+                                       SegmentObserverWidgetMixin, ScriptedLoadableModuleWidget):
     def setup(self):
         ScriptedLoadableModuleWidget.setup(self)
 
@@ -210,6 +260,26 @@ class RadioembolizationDosimetryWidget(ScriptedLoadableModuleWidget):
         self.outputVolumeSelector.setToolTip("Select the output volume for the Gy maps.")
         formLayout.addRow("Output Volume: ", self.outputVolumeSelector)
 
+        # Dose Engine
+        self.doseEngineComboBox = qt.QComboBox()
+        self.doseEngineComboBox.addItems([label for label, nuclide in DOSE_ENGINES])
+        self.doseEngineComboBox.setToolTip("Local deposition keeps the dose in the voxel where the activity is. "
+                                           "Approximate dose kernel convolves the activity with an exponential beta point kernel "
+                                           "of the nuclide in water, not with tabulated voxel S-values.")
+        formLayout.addRow("Dose Engine: ", self.doseEngineComboBox)
+
+        # Partial-volume segments
+        self.partialVolumeCheckBox = qt.QCheckBox()
+        self.partialVolumeCheckBox.setToolTip("Rasterise each segment at sub-voxel resolution and weight every voxel by the "
+                                              "fraction the segment covers. Keeps small lesions stable on coarse SPECT grids.")
+        formLayout.addRow("Partial-volume Segments: ", self.partialVolumeCheckBox)
+
+        # Output Precision
+        self.outputPrecisionComboBox = qt.QComboBox()
+        self.outputPrecisionComboBox.addItems(["float32", "float64"])
+        self.outputPrecisionComboBox.setToolTip("Precision of the dose map. float64 doubles its memory use.")
+        formLayout.addRow("Output Precision: ", self.outputPrecisionComboBox)
+
         # Calculate Button
         self.calculateButton = qt.QPushButton("Calculate with the desired activity")
         self.calculateButton.toolTip = "Perform dosimetric calculations."
@@ -232,11 +302,27 @@ class RadioembolizationDosimetryWidget(ScriptedLoadableModuleWidget):
         self.calculateButtonlim.toolTip = "Perform dosimetric calculations."
         formLayout.addRow(self.calculateButtonlim)
 
+        # Progress of the running calculation
+        self.progressBar = qt.QProgressBar()
+        self.progressBar.setRange(0, 100)
+        self.progressBar.setValue(0)
+        self.progressBar.setTextVisible(True)
+        formLayout.addRow("Progress: ", self.progressBar)
+
+        # Cancel Button
+        self.cancelButton = qt.QPushButton("Cancel")
+        self.cancelButton.toolTip = "Cancel the running calculation."
+        self.cancelButton.enabled = False
+        formLayout.addRow(self.cancelButton)
+
         # Segment Dose Table
         self.segmentDoseTable = qt.QTableWidget()
-        self.segmentDoseTable.setColumnCount(4)
-        self.segmentDoseTable.setHorizontalHeaderLabels(["Segment", "Dose (Gy)","Volume (mL)","Activity (MBq)"])
-        self.segmentDoseTable.setFixedSize(420,350)
+        self.dvhMetricColumns = [f"{name} ({getMetricUnit(name)})" for name in DEFAULT_DVH_METRICS]
+        self.radiobiologyColumns = ["Mean BED (Gy)", "Mean EQD2 (Gy)", "EUD (Gy)"]
+        self.uncertaintyColumn = 4 + len(self.dvhMetricColumns) + len(self.radiobiologyColumns)
+        self.segmentDoseTable.setColumnCount(self.uncertaintyColumn + 1)
+        self.segmentDoseTable.setHorizontalHeaderLabels(["Segment", "Dose (Gy)","Volume (mL)","Activity (MBq)"] + self.dvhMetricColumns + self.radiobiologyColumns + ["Dose CI (Gy)"])
+        self.segmentDoseTable.setFixedSize(640,350)
         formLayout.addRow("Segment Doses: ", self.segmentDoseTable)
 
         # Save Report Button
@@ -245,9 +331,201 @@ class RadioembolizationDosimetryWidget(ScriptedLoadableModuleWidget):
         formLayout.addRow(self.saveReportButton)
         self.saveReportButton.connect('clicked(bool)', self.onSaveReportClicked)
 
+        # Activity sweep: segment and lung doses for a grid of activities, lung shunts and tissue parameters
+        sweepCollapsibleButton = ctk.ctkCollapsibleButton()
+        sweepCollapsibleButton.text = "Activity Sweep"
+        sweepCollapsibleButton.collapsed = True
+        self.layout.addWidget(sweepCollapsibleButton)
+        sweepFormLayout = qt.QFormLayout(sweepCollapsibleButton)
+
+        self.sweepActivityRange = self.createSweepRangeRow(sweepFormLayout, "Activity (MBq): ", 0.0, 10000.0, 500.0, 5000.0, 10)
+        self.sweepLungShuntRange = self.createSweepRangeRow(sweepFormLayout, "Lung Shunt (%): ", 0.0, 100.0, 0.0, 20.0, 5)
+        self.sweepConversionFactorRange = self.createSweepRangeRow(sweepFormLayout, "Conversion Factor: ", 0.0, 100.0, 49.67, 49.67, 1)
+        self.sweepDensityRange = self.createSweepRangeRow(sweepFormLayout, "Liver Density (g/mL): ", 0.0, 10.0, 1.05, 1.05, 1)
+
+        self.sweepButton = qt.QPushButton("Run Sweep")
+        self.sweepButton.toolTip = "Compute segment and lung doses for every combination of the ranges above."
+        sweepFormLayout.addRow(self.sweepButton)
+
+        self.sweepTable = qt.QTableWidget()
+        self.sweepTable.setFixedSize(640, 300)
+        sweepFormLayout.addRow("Scenarios: ", self.sweepTable)
+
+        self.exportSweepButton = qt.QPushButton("Export Sweep as CSV")
+        self.exportSweepButton.enabled = False
+        sweepFormLayout.addRow(self.exportSweepButton)
+        self.sweep = None
+
+        # Uncertainty: confidence intervals of segment and lung doses from sampled parameters
+        uncertaintyCollapsibleButton = ctk.ctkCollapsibleButton()
+        uncertaintyCollapsibleButton.text = "Uncertainty"
+        uncertaintyCollapsibleButton.collapsed = True
+        self.layout.addWidget(uncertaintyCollapsibleButton)
+        uncertaintyFormLayout = qt.QFormLayout(uncertaintyCollapsibleButton)
+
+        self.uncertaintyCheckBox = qt.QCheckBox()
+        self.uncertaintyCheckBox.setToolTip("Add confidence intervals of the segment and lung doses to the table and report.")
+        uncertaintyFormLayout.addRow("Report Confidence Intervals: ", self.uncertaintyCheckBox)
+
+        self.uncertaintyWidgets = {}
+        for name, label, maximum, _ in UNCERTAINTY_PARAMETERS:
+            rowLayout = qt.QHBoxLayout()
+            distributionComboBox = qt.QComboBox()
+            distributionComboBox.addItems(UNCERTAINTY_DISTRIBUTIONS)
+            distributionComboBox.setToolTip("normal: spread is the standard deviation, uniform: spread is the half-width.")
+            spreadSpinBox = qt.QDoubleSpinBox()
+            spreadSpinBox.setRange(0.0, maximum)
+            spreadSpinBox.setDecimals(3)
+            rowLayout.addWidget(distributionComboBox)
+            rowLayout.addWidget(spreadSpinBox)
+            uncertaintyFormLayout.addRow(label + ": ", rowLayout)
+            self.uncertaintyWidgets[name] = (distributionComboBox, spreadSpinBox)
+
+        self.uncertaintySamplesSpinBox = qt.QSpinBox()
+        self.uncertaintySamplesSpinBox.setRange(100, 1000000)
+        self.uncertaintySamplesSpinBox.setValue(10000)
+        uncertaintyFormLayout.addRow("Samples: ", self.uncertaintySamplesSpinBox)
+
+        self.uncertaintySeedSpinBox = qt.QSpinBox()
+        self.uncertaintySeedSpinBox.setRange(0, 2147483647)
+        self.uncertaintySeedSpinBox.setValue(12345)
+        self.uncertaintySeedSpinBox.setToolTip("The same seed always gives the same intervals.")
+        uncertaintyFormLayout.addRow("Random Seed: ", self.uncertaintySeedSpinBox)
+
+        self.confidenceSpinBox = qt.QDoubleSpinBox()
+        self.confidenceSpinBox.setRange(50.0, 99.9)
+        self.confidenceSpinBox.setValue(95.0)
+        uncertaintyFormLayout.addRow("Confidence Level (%): ", self.confidenceSpinBox)
+
+        # Radiobiology: BED and EQD2 of tumour and normal liver, with maps that are only computed when shown
+        radiobiologyCollapsibleButton = ctk.ctkCollapsibleButton()
+        radiobiologyCollapsibleButton.text = "Radiobiology"
+        radiobiologyCollapsibleButton.collapsed = True
+        self.layout.addWidget(radiobiologyCollapsibleButton)
+        radiobiologyFormLayout = qt.QFormLayout(radiobiologyCollapsibleButton)
+
+        self.tumourSegmentSelector = slicer.qMRMLSegmentSelectorWidget()
+        self.tumourSegmentSelector.multiSelection = True
+        self.tumourSegmentSelector.setMRMLScene(slicer.mrmlScene)
+        self.tumourSegmentSelector.setToolTip("Segments with the tumour parameters; all others use the normal liver parameters.")
+        radiobiologyFormLayout.addRow("Tumour Segments: ", self.tumourSegmentSelector)
+
+        self.halfLifeSpinBox = qt.QDoubleSpinBox()
+        self.halfLifeSpinBox.setRange(0.1, 200.0)
+        self.halfLifeSpinBox.setValue(64.2)
+        self.halfLifeSpinBox.setToolTip("Physical half-life of the radionuclide in hours, 64.2 for Y-90.")
+        radiobiologyFormLayout.addRow("Half-Life (hours):", self.halfLifeSpinBox)
+
+        self.tumourTissueWidgets = self.createTissueRows(radiobiologyFormLayout, "Tumour", TUMOUR_TISSUE)
+        self.normalTissueWidgets = self.createTissueRows(radiobiologyFormLayout, "Normal Liver", NORMAL_LIVER_TISSUE)
+
+        self.showBedButton = qt.QPushButton("Show BED Map")
+        self.showBedButton.toolTip = "Compute the BED map from the dose map in the output volume."
+        radiobiologyFormLayout.addRow(self.showBedButton)
+        self.showEqd2Button = qt.QPushButton("Show EQD2 Map")
+        self.showEqd2Button.toolTip = "Compute the EQD2 map from the dose map in the output volume."
+        radiobiologyFormLayout.addRow(self.showEqd2Button)
+
+        # Partition model: allowed activity range for all tumour segments and the normal liver together
+        partitionCollapsibleButton = ctk.ctkCollapsibleButton()
+        partitionCollapsibleButton.text = "Partition Model"
+        partitionCollapsibleButton.collapsed = True
+        self.layout.addWidget(partitionCollapsibleButton)
+        partitionFormLayout = qt.QFormLayout(partitionCollapsibleButton)
+
+        defaultConstraints = PartitionConstraints()
+        self.maxLungDoseSpinBox = qt.QDoubleSpinBox()
+        self.maxLungDoseSpinBox.setRange(0.0, 1000.0)
+        self.maxLungDoseSpinBox.setValue(defaultConstraints.maxLungDoseGy)
+        partitionFormLayout.addRow("Max. Lung Dose (Gy): ", self.maxLungDoseSpinBox)
+
+        self.maxNormalLiverDoseSpinBox = qt.QDoubleSpinBox()
+        self.maxNormalLiverDoseSpinBox.setRange(0.0, 1000.0)
+        self.maxNormalLiverDoseSpinBox.setValue(defaultConstraints.maxNormalLiverDoseGy)
+        partitionFormLayout.addRow("Max. Normal Liver Dose (Gy): ", self.maxNormalLiverDoseSpinBox)
+
+        self.minTumourDoseSpinBox = qt.QDoubleSpinBox()
+        self.minTumourDoseSpinBox.setRange(0.0, 10000.0)
+        self.minTumourDoseSpinBox.setValue(defaultConstraints.minTumourDoseGy)
+        partitionFormLayout.addRow("Min. Tumour Dose (Gy): ", self.minTumourDoseSpinBox)
+
+        self.planButton = qt.QPushButton("Plan Activity Range")
+        self.planButton.toolTip = ("Tumours are the Tumour Segments under Radiobiology, or all segments inside the liver if none "
+                                   "are selected. Uses the lung shunt, conversion factor, density and lung mass above.")
+        partitionFormLayout.addRow(self.planButton)
+
+        self.allowedActivityTextBox = qt.QLineEdit()
+        self.allowedActivityTextBox.setReadOnly(True)
+        partitionFormLayout.addRow("Allowed Activity (MBq): ", self.allowedActivityTextBox)
+
+        self.partitionTable = qt.QTableWidget()
+        self.partitionTable.setColumnCount(5)
+        self.partitionTable.setHorizontalHeaderLabels(["Compartment", "T/N Ratio", "Activity Limit (MBq)",
+                                                       "Dose at Min. (Gy)", "Dose at Max. (Gy)"])
+        self.partitionTable.setFixedSize(640, 250)
+        partitionFormLayout.addRow("Compartments: ", self.partitionTable)
+
+        # Isodose segments: all levels from one digitisation of the dose map, with volumes and segment overlaps
+        isodoseCollapsibleButton = ctk.ctkCollapsibleButton()
+        isodoseCollapsibleButton.text = "Isodose Segments"
+        isodoseCollapsibleButton.collapsed = True
+        self.layout.addWidget(isodoseCollapsibleButton)
+        isodoseFormLayout = qt.QFormLayout(isodoseCollapsibleButton)
+
+        self.isodoseLevelsLineEdit = qt.QLineEdit(", ".join(f"{level:g}" for level in DEFAULT_ISODOSE_LEVELS))
+        self.isodoseLevelsLineEdit.setToolTip("Isodose levels in Gy, separated by commas.")
+        isodoseFormLayout.addRow("Levels (Gy): ", self.isodoseLevelsLineEdit)
+
+        self.isodoseAfterCalculationCheckBox = qt.QCheckBox()
+        self.isodoseAfterCalculationCheckBox.setToolTip("Create the isodose segments whenever a dose calculation finishes.")
+        isodoseFormLayout.addRow("Create After Calculation: ", self.isodoseAfterCalculationCheckBox)
+
+        self.createIsodoseButton = qt.QPushButton("Create Isodose Segments")
+        self.createIsodoseButton.toolTip = "Add one segment per level to the Isodose Segments segmentation, from the dose map in the output volume."
+        isodoseFormLayout.addRow(self.createIsodoseButton)
+
+        self.isodoseTable = qt.QTableWidget()
+        self.isodoseTable.setFixedSize(640, 200)
+        isodoseFormLayout.addRow("Isodose Regions: ", self.isodoseTable)
+        self.isodoseSegmentationNodeID = None
+
         # Connections
         self.calculateButton.connect('clicked(bool)', self.onCalculateButton)
+        self.createIsodoseButton.connect('clicked(bool)', self.onCreateIsodoseClicked)
+        self.planButton.connect('clicked(bool)', self.onPlanButton)
+        self.showBedButton.connect('clicked(bool)', self.onShowBedClicked)
+        self.showEqd2Button.connect('clicked(bool)', self.onShowEqd2Clicked)
         self.calculateButtonlim.connect('clicked(bool)', self.limonCalculateButton)
+        self.sweepButton.connect('clicked(bool)', self.onSweepButton)
+        self.exportSweepButton.connect('clicked(bool)', self.onExportSweepClicked)
+
+        # Calculations run as background jobs that are polled from the main thread
+        self.setupBackgroundJobs()
+
+        # Segment edits are tracked, so Calculate only recomputes the statistics of the edited segments
+        self.setupSegmentObserver(self.segmentationSelector.currentNode())
+        self.doseOutput = None
+
+        # Parameters that only scale the dose update the table immediately
+        self.doseState = None
+        self.activitySlider.connect('valueChanged(double)', self.onDoseParameterChanged)
+        self.lungShuntSlider.connect('valueChanged(double)', self.onDoseParameterChanged)
+        self.conversionFactorSpinBox.connect('valueChanged(double)', self.onDoseParameterChanged)
+        self.lungMassSpinBox.connect('valueChanged(double)', self.onDoseParameterChanged)
+        self.liverDensitySpinBox.connect('valueChanged(double)', self.onDoseParameterChanged)
+        self.uncertaintyCheckBox.connect('toggled(bool)', self.onDoseParameterChanged)
+        for distributionComboBox, spreadSpinBox in self.uncertaintyWidgets.values():
+            distributionComboBox.connect('currentIndexChanged(int)', self.onDoseParameterChanged)
+            spreadSpinBox.connect('valueChanged(double)', self.onDoseParameterChanged)
+        self.uncertaintySamplesSpinBox.connect('valueChanged(int)', self.onDoseParameterChanged)
+        self.uncertaintySeedSpinBox.connect('valueChanged(int)', self.onDoseParameterChanged)
+        self.confidenceSpinBox.connect('valueChanged(double)', self.onDoseParameterChanged)
+        self.doseEngineComboBox.connect('currentIndexChanged(int)', self.onDoseParameterChanged)
+        self.partialVolumeCheckBox.connect('toggled(bool)', self.onDoseParameterChanged)
+        self.tumourSegmentSelector.connect('selectedSegmentIDsChanged(QStringList)', self.onDoseParameterChanged)
+        self.halfLifeSpinBox.connect('valueChanged(double)', self.onDoseParameterChanged)
+        for spinBox in self.tumourTissueWidgets + self.normalTissueWidgets:
+            spinBox.connect('valueChanged(double)', self.onDoseParameterChanged)
 
         # Add vertical spacer
         self.layout.addStretch(1)
@@ -268,8 +546,155 @@ class RadioembolizationDosimetryWidget(ScriptedLoadableModuleWidget):
 
 
         
+    def createSweepRangeRow(self, formLayout, label, minimum, maximum, start, stop, steps):
+        """
+        Add a row of from/to/steps spin boxes to formLayout and return them.
+        """
+        rowLayout = qt.QHBoxLayout()
+        spinBoxes = []
+        for value in (start, stop):
+            spinBox = qt.QDoubleSpinBox()
+            spinBox.setRange(minimum, maximum)
+            spinBox.setDecimals(2)
+            spinBox.setValue(value)
+            rowLayout.addWidget(spinBox)
+            spinBoxes.append(spinBox)
+        stepsSpinBox = qt.QSpinBox()
+        stepsSpinBox.setRange(1, 1000)
+        stepsSpinBox.setValue(steps)
+        stepsSpinBox.setToolTip("Number of values from the first to the second bound.")
+        rowLayout.addWidget(stepsSpinBox)
+        spinBoxes.append(stepsSpinBox)
+        formLayout.addRow(label, rowLayout)
+        return spinBoxes
+
+    def getSweepValues(self, rangeRow):
+        start, stop, steps = rangeRow
+        return np.linspace(start.value, stop.value, steps.value)
+
+    def onSweepButton(self):
+        spectVolumeNode = self.spectSelector.currentNode()
+        segmentationNode = self.segmentationSelector.currentNode()
+        liverSegmentID = self.liverSegmentSelector.currentSegmentID()
+        if not spectVolumeNode or not segmentationNode or not liverSegmentID:
+            slicer.util.errorDisplay("Please select the input volume, the segmentation and the liver segment.")
+            return
+        if self.job is not None:
+            slicer.util.errorDisplay("A dose calculation is running. Wait until it finishes.")
+            return
+
+        try:
+            with StageTimer("RadioembolizationDosimetrySweep") as timer:
+                # The sweep only scales the cached per-segment count sums
+                doseState = self.updateDoseState(spectVolumeNode, segmentationNode, liverSegmentID, timer)
+                with timer.stage("sweep"):
+                    self.sweep = doseState.sweep(
+                        self.getSweepValues(self.sweepActivityRange),
+                        self.getSweepValues(self.sweepLungShuntRange) / 100.0,
+                        self.getSweepValues(self.sweepConversionFactorRange),
+                        self.getSweepValues(self.sweepDensityRange),
+                        self.lungMassSpinBox.value,
+                    )
+                    self.sweepSegmentNames = [segmentationNode.GetSegmentation().GetSegment(segmentID).GetName()
+                                              for segmentID in self.sweep.segmentIDs]
+                with timer.stage("sweepTable"):
+                    self.updateSweepTable()
+        except Exception as e:
+            slicer.util.errorDisplay(f"Sweep failed: {e}")
+            return
+        self.exportSweepButton.enabled = True
+
+    def onPlanButton(self):
+        spectVolumeNode = self.spectSelector.currentNode()
+        segmentationNode = self.segmentationSelector.currentNode()
+        liverSegmentID = self.liverSegmentSelector.currentSegmentID()
+        if not spectVolumeNode or not segmentationNode or not liverSegmentID:
+            slicer.util.errorDisplay("Please select the input volume, the segmentation and the liver segment.")
+            return
+        if self.job is not None:
+            slicer.util.errorDisplay("A dose calculation is running. Wait until it finishes.")
+            return
+
+        try:
+            with StageTimer("RadioembolizationDosimetryPartition") as timer:
+                tumourSegmentIDs = [segmentID for segmentID in self.tumourSegmentSelector.selectedSegmentIDs()
+                                    if segmentID != liverSegmentID]
+                if not tumourSegmentIDs:
+                    raise ValueError("Select the tumour segments under Radiobiology.")
+                # The tumour doses use the cached per-segment count sums; the normal liver also needs the
+                # tumour masks, which come from the labelmap cache
+                doseState = self.updateDoseState(spectVolumeNode, segmentationNode, liverSegmentID, timer)
+                segmentMasks = self.getDoseSegmentMasks(segmentationNode, spectVolumeNode, timer)
+                constraints = PartitionConstraints(
+                    maxLungDoseGy=self.maxLungDoseSpinBox.value,
+                    maxNormalLiverDoseGy=self.maxNormalLiverDoseSpinBox.value,
+                    minTumourDoseGy=self.minTumourDoseSpinBox.value,
+                )
+                with timer.stage("partitionModel"):
+                    plan = planPartitionActivity(doseState, liverSegmentID,
+                                                 self.getDosimetryParameters(self.activitySlider.value, self.lungShuntSlider.value),
+                                                 constraints, tumourSegmentIDs, segmentMasks)
+                self.updatePartitionTable(segmentationNode, plan)
+        except Exception as e:
+            slicer.util.errorDisplay(f"Partition model failed: {e}")
+
+    def updatePartitionTable(self, segmentationNode, plan):
+        """
+        Show the allowed activity range of a PartitionPlan and the doses of every compartment at its limits.
+        """
+        if plan.feasible:
+            self.allowedActivityTextBox.setText(f"{plan.minimumActivityMBq:.2f} - {plan.maximumActivityMBq:.2f}")
+        else:
+            self.allowedActivityTextBox.setText(f"None: tumours need {plan.minimumActivityMBq:.2f}, "
+                                                f"limits allow {plan.maximumActivityMBq:.2f}")
+        tumourDosesAtMinimum, normalDoseAtMinimum, lungDoseAtMinimum = plan.doses(plan.minimumActivityMBq)
+        tumourDosesAtMaximum, normalDoseAtMaximum, lungDoseAtMaximum = plan.doses(plan.maximumActivityMBq)
+
+        segmentation = segmentationNode.GetSegmentation()
+        rows = [(segmentation.GetSegment(segmentID).GetName(), f"{ratio:.2f}", plan.activityLimits.get(segmentID),
+                 atMinimum, atMaximum)
+                for segmentID, ratio, atMinimum, atMaximum in zip(plan.tumourSegmentIDs, plan.tumourToNormalRatios,
+                                                                  tumourDosesAtMinimum, tumourDosesAtMaximum)]
+        rows.append(("Normal Liver", "1.00", plan.activityLimits.get("normalLiver"), normalDoseAtMinimum, normalDoseAtMaximum))
+        rows.append(("Lungs", "", plan.activityLimits.get("lung"), lungDoseAtMinimum, lungDoseAtMaximum))
+
+        self.partitionTable.setRowCount(len(rows))
+        for row, (name, ratio, activityLimit, atMinimum, atMaximum) in enumerate(rows):
+            values = [name, ratio, "" if activityLimit is None else f"{activityLimit:.2f}", f"{atMinimum:.2f}", f"{atMaximum:.2f}"]
+            for column, value in enumerate(values):
+                self.partitionTable.setItem(row, column, qt.QTableWidgetItem(value))
+
+    def updateSweepTable(self):
+        sweep = self.sweep
+        numberOfRows = min(len(sweep.activityMBq), SWEEP_TABLE_MAX_ROWS)
+        if numberOfRows < len(sweep.activityMBq):
+            logging.info(f"Showing {numberOfRows} of {len(sweep.activityMBq)} scenarios, export the sweep to see all of them.")
+        self.sweepTable.setRowCount(0)
+        self.sweepTable.setColumnCount(5 + len(self.sweepSegmentNames))
+        self.sweepTable.setHorizontalHeaderLabels(["Activity (MBq)", "Lung Shunt (%)", "Conv. Factor", "Density (g/mL)",
+                                                   "Lung Dose (Gy)"] + [f"{name} (Gy)" for name in self.sweepSegmentNames])
+        self.sweepTable.setRowCount(numberOfRows)
+        for row in range(numberOfRows):
+            values = [sweep.activityMBq[row], sweep.lungShuntFraction[row] * 100, sweep.conversionFactor[row],
+                      sweep.densityGPerML[row], sweep.lungDoseGy[row]] + list(sweep.segmentDoses[row])
+            for column, value in enumerate(values):
+                self.sweepTable.setItem(row, column, qt.QTableWidgetItem(f"{value:.2f}"))
+
+    def onExportSweepClicked(self):
+        if self.sweep is None:
+            return
+        fileName = qt.QFileDialog.getSaveFileName(None, "Export Activity Sweep", "", "CSV Files (*.csv)")
+        if not fileName:
+            return
+        if not fileName.lower().endswith(".csv"):
+            fileName += ".csv"
+        writeDoseSweepCsv(fileName, self.sweep, self.sweepSegmentNames)
+        slicer.util.infoDisplay("Activity sweep exported successfully.")
+
     def onSegmentationNodeChanged(self, node):
         self.liverSegmentSelector.setCurrentNode(node)
+        self.tumourSegmentSelector.setCurrentNode(node)
+        self.observeSegmentation(node)
 
     def onCalculateButton(self):
         spectVolumeNode = self.spectSelector.currentNode()
@@ -279,10 +704,6 @@ class RadioembolizationDosimetryWidget(ScriptedLoadableModuleWidget):
         outputVolumeNode = self.outputVolumeSelector.currentNode()
         lungShuntFractionPercent = self.lungShuntSlider.value
 
-        sliceWidget = slicer.app.layoutManager().sliceWidget("Red")
-        sliceCompositeNode = sliceWidget.mrmlSliceCompositeNode()
-        backgroundVolumeid = slicer.app.layoutManager().sliceWidget("Red").mrmlSliceCompositeNode().GetBackgroundVolumeID()
-
         missingInputs = []
         if not spectVolumeNode:
             missingInputs.append("Input SPECT/PET Volume")
@@ -296,130 +717,316 @@ class RadioembolizationDosimetryWidget(ScriptedLoadableModuleWidget):
             slicer.util.errorDisplay("Please select " + ", ".join(missingInputs) + ".")
             return
 
-        # Perform dosimetric calculations
-        self.calculateDose(spectVolumeNode, segmentationNode, liverSegmentID, activityMBq, outputVolumeNode, lungShuntFractionPercent)
-        self.outputVolumeSelector.currentNode().SetName("Dose Map (Gy)")
-        foregroundVolumeid = self.outputVolumeSelector.currentNode().GetID()
-        sliceCompositeNode.SetBackgroundVolumeID(backgroundVolumeid)
-        sliceCompositeNode.SetForegroundVolumeID(foregroundVolumeid)
+        # Perform dosimetric calculations in the background
+        parameters = self.getDosimetryParameters(activityMBq, lungShuntFractionPercent)
+        self.startDoseCalculation(spectVolumeNode, segmentationNode, liverSegmentID, outputVolumeNode, parameters)
+
+    def showDoseMap(self, outputVolumeNode, backgroundVolumeID):
+        """
+        Show the dose map over backgroundVolumeID, the background volume from before the calculation.
+        """
+        sliceCompositeNode = slicer.app.layoutManager().sliceWidget("Red").mrmlSliceCompositeNode()
+        sliceCompositeNode.SetBackgroundVolumeID(backgroundVolumeID)
+        outputVolumeNode.SetName("Dose Map (Gy)")
+        sliceCompositeNode.SetForegroundVolumeID(outputVolumeNode.GetID())
         sliceCompositeNode.SetForegroundOpacity(0.5)
-            
-    def calculateDose(self, spectVolumeNode, segmentationNode, liverSegmentID, activityMBq, outputVolumeNode, lungShuntFractionPercent):
+
+    def getDoseStateKey(self, spectVolumeNode, segmentationNode, liverSegmentID):
         """
-        Perform dosimetric calculations using the given inputs.
+        Key identifying the images and segments that a cached dose state was computed from.
         """
-        logging.info("Starting dosimetric calculations.")
+        imageData = spectVolumeNode.GetImageData()
+        inputsKey = (spectVolumeNode.GetID(), spectVolumeNode.GetMTime(), imageData.GetMTime() if imageData else 0,
+                     liverSegmentID, self.getDoseKernel(), self.getSegmentOversampling())
+        return inputsKey, getSegmentationStateKey(segmentationNode)
 
-        # Validate inputs
-        if not spectVolumeNode or not segmentationNode or not liverSegmentID or not outputVolumeNode:
-            raise ValueError("Invalid inputs. Please select valid nodes and ensure the liver segment is specified.")
+    def getEditedSegmentIDs(self, key, liverSegmentID):
+        """
+        Segments edited since the cached dose state, if the inputs and the liver segment are unchanged
+        so that only their statistics need recomputing. None if the dose state must be recomputed.
+        """
+        if self.doseState is None or self.doseState.key is None:
+            return None
+        inputsKey, segmentationStateKey = key
+        cachedInputsKey, cachedSegmentationStateKey = self.doseState.key
+        if inputsKey != cachedInputsKey:
+            return None
+        changedSegmentIDs = getChangedSegmentIDs(cachedSegmentationStateKey, segmentationStateKey)
+        # Changes that were not observed, e.g. made while another segmentation was selected, need a full update
+        if changedSegmentIDs is None or liverSegmentID in changedSegmentIDs or \
+                not self.editedSegmentIDs.issuperset(changedSegmentIDs):
+            return None
+        return changedSegmentIDs
+
+    def getDoseOutputKey(self, outputVolumeNode, doseState, parameters):
+        """
+        Key of the dose map that the output volume holds after a calculation with these parameters.
+        """
+        imageData = outputVolumeNode.GetImageData()
+        return (outputVolumeNode.GetID(), imageData.GetMTime() if imageData else 0, parameters.doseDtype,
+                doseState.rescaleFactor(parameters.activityMBq, parameters.lungShuntFraction, parameters.conversionFactor,
+                                        parameters.densityGPerML))
 
-        # Export the liver segment to a label map aligned with the input volume
-        labelMapVolumeNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLabelMapVolumeNode")
-        slicer.modules.segmentations.logic().ExportSegmentsToLabelmapNode(
-            segmentationNode, [liverSegmentID], labelMapVolumeNode, spectVolumeNode
-        )
+    def isDoseOutputCurrent(self, outputVolumeNode, doseState, parameters):
+        """
+        True if the output volume still holds the dose map of these liver-masked counts and parameters.
+        """
+        if self.doseOutput is None or doseState is None:
+            return False
+        maskedArray, outputKey = self.doseOutput
+        return maskedArray is doseState.maskedArray and outputKey == self.getDoseOutputKey(outputVolumeNode, doseState, parameters)
 
-        # Apply the label map to mask the input volume
-        maskedVolumeNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode", "MaskedVolume")
-        parameters = {
-            "InputVolume": spectVolumeNode.GetID(),
-            "MaskVolume": labelMapVolumeNode.GetID(),
-            "OutputVolume": maskedVolumeNode.GetID(),
-            "Label": 1,  # Label value corresponding to the liver segment
-            "Replace": 0  # Set voxels outside the segment to 0
-        }
-        slicer.cli.runSync(slicer.modules.maskscalarvolume, None, parameters)
-
-        # Clone the masked volume to the output volume to inherit spatial properties
-        volumesLogic = slicer.modules.volumes.logic()
-        clonedOutputVolumeNode = volumesLogic.CloneVolume(slicer.mrmlScene, maskedVolumeNode, outputVolumeNode.GetName())
-        outputVolumeNode.Copy(clonedOutputVolumeNode)
-        outputVolumeNode.SetAttribute("DicomRtImport.DoseVolume", "1")
-        slicer.mrmlScene.RemoveNode(clonedOutputVolumeNode)
-
-        # Get the masked volume array
-        maskedArray = slicer.util.arrayFromVolume(maskedVolumeNode)
-        if maskedArray is None:
-            raise ValueError("Unable to access data from the masked volume.")
-
-        # Calculate total volume in mL
-        spacing = spectVolumeNode.GetSpacing()  # spacing is in mm
-        voxelVolumeML = (spacing[0] * spacing[1] * spacing[2]) / 1000.0  # convert mm^3 to mL
-        totalVolumeML = maskedArray.size * voxelVolumeML
-
-        # Adjust activity based on lung shunt fraction
-        lungShuntFraction = lungShuntFractionPercent / 100.0
-        ncorr_activityMBq = activityMBq
-        activityMBq = activityMBq * (1 - lungShuntFraction)
-        if totalVolumeML == 0:
-            raise ValueError("Total volume is zero. Ensure the liver segment is correctly defined.")
-
-        # Calculate mean input value within the liver segment
-        meanInputValue = np.sum(maskedArray) / maskedArray.size
-
-        # Constants for Y-90 dosimetry
-        conversionFactor = self.conversionFactorSpinBox.value
-        lungMassg = self.lungMassSpinBox.value
-        densityGPerML = self.liverDensitySpinBox.value
+    def getDoseKernel(self):
+        """
+        Nuclide of the selected dose kernel, None for local deposition.
+        """
+        return DOSE_ENGINES[self.doseEngineComboBox.currentIndex][1]
 
-        # Calculate mean output dose
-        meanOutputDoseGy = (activityMBq / (totalVolumeML * densityGPerML)) * conversionFactor
+    def getSegmentOversampling(self):
+        """
+        Oversampling argument of getSegmentMasks: PARTIAL_VOLUME_AUTO for partial-volume masks, None for binary masks.
+        """
+        return PARTIAL_VOLUME_AUTO if self.partialVolumeCheckBox.checked else None
 
-        # Rescale factor to normalize dose
-        rescaleFactor = meanOutputDoseGy / meanInputValue
+    def getDoseSegmentMasks(self, segmentationNode, spectVolumeNode, timer=None):
+        """
+        Masks of all segments on the SPECT grid.
+        """
+        # Segment masks come from the shared labelmap cache, so unchanged segments are not exported again.
+        # Segment statistics only read the bounding box of each mask.
+        segmentIDs = getSegmentIDs(segmentationNode.GetSegmentation())
+        with timedStage(timer, "labelmapExport"):
+            return getSegmentMasks(segmentationNode, segmentIDs, spectVolumeNode, oversampling=self.getSegmentOversampling())
 
-        # Write rescaled dose values to output volume
-        doseArray = maskedArray * rescaleFactor
-        slicer.util.updateVolumeFromArray(outputVolumeNode, doseArray)
+    def getDoseStateInputs(self, spectVolumeNode, segmentationNode, liverSegmentID, timer=None):
+        """
+        Arguments of computeRelativeDoseState: the SPECT array, spacing, liver SegmentMask and segment masks.
+        Reads the scene, so it must run on the main thread.
+        """
+        segmentMasks = self.getDoseSegmentMasks(segmentationNode, spectVolumeNode, timer)
+        spectArray = slicer.util.arrayFromVolume(spectVolumeNode)
+        if spectArray is None:
+            raise ValueError("Unable to access data from the input SPECT volume.")
+        liverMask = segmentMasks[liverSegmentID]
+        if liverMask.shape != spectArray.shape:
+            # The relative model only sums counts, so the non-zero masked voxels stand in for the liver mask
+            spectArray = self.maskWithLiverLabelmap(spectVolumeNode, segmentationNode, liverSegmentID)
+            liverMask = spectArray != 0
+        return spectArray, spectVolumeNode.GetSpacing(), liverMask, segmentMasks
+
+    def maskWithLiverLabelmap(self, spectVolumeNode, segmentationNode, liverSegmentID):
+        """
+        SPECT counts masked with a label map of the liver exported on its own grid, outside the labelmap
+        cache, for liver masks that do not match the SPECT grid. The MaskScalarVolume CLI resamples it.
+        """
+        labelMapVolumeNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLabelMapVolumeNode")
+        try:
+            slicer.modules.segmentations.logic().ExportSegmentsToLabelmapNode(segmentationNode, [liverSegmentID],
+                                                                              labelMapVolumeNode)
+            return maskVolumeWithLabelmap(spectVolumeNode, labelMapVolumeNode)
+        finally:
+            slicer.mrmlScene.RemoveNode(labelMapVolumeNode)
+
+    def updateDoseState(self, spectVolumeNode, segmentationNode, liverSegmentID, timer=None):
+        """
+        Return the cached liver-masked counts and per-segment statistics, recomputing them
+        only if the SPECT volume, the liver segment or any segment changed. If only other segments
+        were edited, only their statistics are recomputed.
+        """
+        key = self.getDoseStateKey(spectVolumeNode, segmentationNode, liverSegmentID)
+        if self.doseState is not None and self.doseState.key == key:
+            return self.doseState
+        editedSegmentIDs = self.getEditedSegmentIDs(key, liverSegmentID)
+        self.editedSegmentIDs = set()
+        if editedSegmentIDs is not None:
+            segmentMasks = self.getDoseSegmentMasks(segmentationNode, spectVolumeNode, timer)
+            with timedStage(timer, "segmentStatistics"):
+                self.doseState = self.doseState.updateSegments(segmentMasks, editedSegmentIDs, key)
+            return self.doseState
+
+        # Mask with the liver and sum the liver-masked counts of all segments
+        inputs = self.getDoseStateInputs(spectVolumeNode, segmentationNode, liverSegmentID, timer)
+        with timedStage(timer, "maskAndSegmentStatistics"):
+            self.doseState = computeRelativeDoseState(*inputs, key=key, doseKernel=self.getDoseKernel())
+        return self.doseState
+
+    def startDoseCalculation(self, spectVolumeNode, segmentationNode, liverSegmentID, outputVolumeNode, parameters,
+                             targetSegmentID=None, targetDoseGy=0):
+        """
+        Run a dose calculation as a background job. Label map export and all scene updates stay on
+        the main thread; masking, segment statistics and rescaling run on a worker thread.
+        If targetSegmentID is given, the activity is first solved for targetDoseGy in that segment.
+        """
+        if self.job is not None:
+            slicer.util.errorDisplay("A dose calculation is already running.")
+            return
+        outputVolumeID = outputVolumeNode.GetID()
+        if not acquireOutputVolume(outputVolumeID):
+            slicer.util.errorDisplay(f"Another calculation is writing to {outputVolumeNode.GetName()}. "
+                                     "Wait until it finishes or select another output volume.")
+            return
 
-        # Set window/level for the output volume display
-        displayNode = outputVolumeNode.GetDisplayNode()
-        if displayNode:
-            maxDoseGy = np.max(doseArray)
-            window = 250
-            level = 125
-            displayNode.SetAutoWindowLevel(False)
-            displayNode.SetWindow(window)
-            displayNode.SetLevel(level)
-            colorNode = slicer.util.getNode('PET-Rainbow2')
-            displayNode.SetAndObserveColorNodeID(colorNode.GetID())
-            
-        # Calculate mean dose for each segment
-        segmentation = segmentationNode.GetSegmentation()
-        segmentIDs = vtk.vtkStringArray()
-        segmentation.GetSegmentIDs(segmentIDs)
+        timer = StageTimer("RadioembolizationDosimetry")
+        timer.start()
+        backgroundVolumeID = slicer.app.layoutManager().sliceWidget("Red").mrmlSliceCompositeNode().GetBackgroundVolumeID()
+        key = self.getDoseStateKey(spectVolumeNode, segmentationNode, liverSegmentID)
+        previousState = self.doseState
+        doseState = previousState if previousState is not None and previousState.key == key else None
+        # If only segments other than the liver were edited, the liver-masked counts, the other rows
+        # and, for unchanged parameters, the dose volume are reused
+        editedSegmentIDs = None
+        if doseState is None:
+            editedSegmentIDs = self.getEditedSegmentIDs(key, liverSegmentID)
+            self.editedSegmentIDs = set()
+        reuseDoseOutput = (not targetSegmentID and outputVolumeNode is not spectVolumeNode
+                           and (doseState is not None or editedSegmentIDs is not None)
+                           and self.isDoseOutputCurrent(outputVolumeNode, previousState, parameters))
+        inputs = None
+        segmentMasks = None
+        uncertaintyModel = self.getUncertaintyModel()
+        self.setCalculationRunning(True)
+        try:
+            if doseState is None:
+                self.progressBar.value = 0
+                self.progressBar.format = "labelmapExport: %p%"
+                slicer.app.processEvents()
+                if editedSegmentIDs is not None:
+                    segmentMasks = self.getDoseSegmentMasks(segmentationNode, spectVolumeNode, timer)
+                else:
+                    inputs = self.getDoseStateInputs(spectVolumeNode, segmentationNode, liverSegmentID, timer)
+        except Exception as e:
+            releaseOutputVolume(outputVolumeID)
+            self.setCalculationRunning(False)
+            timer.error = f"{type(e).__name__}: {e}"
+            timer.finish()
+            slicer.util.errorDisplay(f"Dose calculation failed: {e}")
+            return
+
+        def calculate(job):
+            state = doseState
+            if state is None and segmentMasks is not None:
+                job.setStage("segmentStatistics")
+                with timer.stage("segmentStatistics"):
+                    state = previousState.updateSegments(segmentMasks, editedSegmentIDs, key)
+            elif state is None:
+                job.setStage("maskAndSegmentStatistics")
+                with timer.stage("maskAndSegmentStatistics"):
+                    state = computeRelativeDoseState(*inputs, key=key, doseKernel=parameters.doseKernel)
+            if targetSegmentID:
+                # Dose is linear in activity, so the permitted activity follows directly from the target dose per MBq
+                job.setStage("solveActivity")
+                parameters.activityMBq = 1000
+                if targetDoseGy > 0:
+                    with timer.stage("solveActivity"):
+                        parameters.activityMBq = state.solveActivityForTargetDose(targetSegmentID, targetDoseGy, parameters)
+            job.setStage("rescale")
+            with timer.stage("rescale"):
+                result = state.calculate(parameters, computeDoseArray=not reuseDoseOutput)
+            if uncertaintyModel:
+                job.setStage("uncertainty")
+                with timer.stage("uncertainty"):
+                    result.doseUncertainty = propagateRelativeDoseUncertainty(state, parameters, uncertaintyModel)
+            job.setStage("writeOutput")
+            return state, result
+
+        def onFinished(job):
+            state, result = job.result
+            self.doseState = state
+            if targetSegmentID:
+                self.activitySlider.value = parameters.activityMBq
+            if reuseDoseOutput:
+                result.doseArray = slicer.util.arrayFromVolume(outputVolumeNode)
+            self.writeDoseOutputs(spectVolumeNode, segmentationNode, outputVolumeNode, result, timer)
+            self.doseOutput = None
+            if outputVolumeNode is not spectVolumeNode:
+                self.doseOutput = (state.maskedArray, self.getDoseOutputKey(outputVolumeNode, state, parameters))
+            self.showDoseMap(outputVolumeNode, backgroundVolumeID)
+
+        stageNames = (["maskAndSegmentStatistics"] if inputs is not None else []) + \
+            (["segmentStatistics"] if segmentMasks is not None else []) + \
+            (["solveActivity"] if targetSegmentID else []) + ["rescale"] + \
+            (["uncertainty"] if uncertaintyModel else []) + ["writeOutput"]
+        self.runJob(BackgroundJob(calculate, stageNames, "Dose calculation"), outputVolumeID, timer, onFinished)
+
+    def setCalculationRunning(self, running):
+        super().setCalculationRunning(running)
+        self.calculateButtonlim.enabled = not running
+
+    def onDoseParameterChanged(self, value=None):
+        """
+        Update the segment dose table while activity, lung shunt or tissue parameters are changed.
+        The dose volume itself is rescaled only when Calculate is pressed.
+        """
+        spectVolumeNode = self.spectSelector.currentNode()
+        segmentationNode = self.segmentationSelector.currentNode()
+        liverSegmentID = self.liverSegmentSelector.currentSegmentID()
+        if self.doseState is None or not spectVolumeNode or not segmentationNode or not liverSegmentID:
+            return
+        if self.doseState.key != self.getDoseStateKey(spectVolumeNode, segmentationNode, liverSegmentID):
+            return
+        parameters = self.getDosimetryParameters(self.activitySlider.value, self.lungShuntSlider.value)
+        result = self.doseState.calculate(parameters, computeDoseArray=False)
+        uncertaintyModel = self.getUncertaintyModel()
+        if uncertaintyModel:
+            result.doseUncertainty = propagateRelativeDoseUncertainty(self.doseState, parameters, uncertaintyModel)
+        self.updateSegmentDoseTable(segmentationNode, result)
+
+    def getUncertaintyModel(self):
+        """
+        UncertaintyModel from the widgets, or None if confidence intervals are not requested.
+        """
+        if not self.uncertaintyCheckBox.checked:
+            return None
+        parameterUncertainties = {}
+        for name, _, _, scale in UNCERTAINTY_PARAMETERS:
+            distributionComboBox, spreadSpinBox = self.uncertaintyWidgets[name]
+            parameterUncertainties[name] = ParameterUncertainty(distributionComboBox.currentText, spreadSpinBox.value * scale)
+        return UncertaintyModel(
+            parameters=parameterUncertainties,
+            numberOfSamples=self.uncertaintySamplesSpinBox.value,
+            seed=self.uncertaintySeedSpinBox.value,
+            confidencePercent=self.confidenceSpinBox.value,
+        )
+
+    def getDosimetryParameters(self, activityMBq, lungShuntFractionPercent):
+        """
+        Collect the dose model parameters from the widgets.
+        """
+        return DosimetryParameters(
+            activityMBq=activityMBq,
+            lungShuntFraction=lungShuntFractionPercent / 100.0,
+            conversionFactor=self.conversionFactorSpinBox.value,
+            densityGPerML=self.liverDensitySpinBox.value,
+            lungMassG=self.lungMassSpinBox.value,
+            doseDtype=self.outputPrecisionComboBox.currentText,
+            doseKernel=self.getDoseKernel(),
+        )
 
+    def updateSegmentDoseTable(self, segmentationNode, result):
+        """
+        Fill the segment dose table from a DosimetryResult and return the segment doses by name.
+        """
+        segmentation = segmentationNode.GetSegmentation()
         segmentDoses = {}
         segmentVolumes = {}
         segmentActivity = {}
-        for i in range(segmentIDs.GetNumberOfValues()):
-            segmentID = segmentIDs.GetValue(i)
+        segmentMetrics = {}
+        segmentIndices = {}
+        metrics = result.doseVolumeHistograms.metrics(DEFAULT_DVH_METRICS) if result.doseVolumeHistograms else {}
+        if result.radiobiology is None and result.segmentMeanSquareDoses is not None:
+            result.radiobiology = computeSegmentRadiobiology(result, self.getSegmentTissues(), self.halfLifeSpinBox.value,
+                                                             self.getTissueParameters(self.normalTissueWidgets))
+        radiobiology = result.radiobiology
+        for index, segmentID in enumerate(result.segmentIDs):
             segmentName = segmentation.GetSegment(segmentID).GetName()
+            segmentIndices[segmentName] = index
+            segmentDoses[segmentName] = result.segmentDoses[index]
+            segmentVolumes[segmentName] = result.segmentVolumes[index]
+            segmentActivity[segmentName] = result.segmentActivities[index]
+            segmentMetrics[segmentName] = [values[index] for values in metrics.values()]
+            if radiobiology:
+                segmentMetrics[segmentName] += [radiobiology.meanBed[index], radiobiology.meanEqd2[index], radiobiology.eud[index]]
 
-            # Create label map for segment
-            segmentLabelMapNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLabelMapVolumeNode")
-            slicer.modules.segmentations.logic().ExportSegmentsToLabelmapNode(
-                segmentationNode, [segmentID], segmentLabelMapNode, spectVolumeNode
-            )
-
-            # Mask dose array to calculate mean dose for the segment
-            segmentLabelMapArray = slicer.util.arrayFromVolume(segmentLabelMapNode)
-            maskedDoseArray = doseArray[segmentLabelMapArray == 1]
-            segmentDoses[segmentName] = np.mean(maskedDoseArray)
-            segmentVolumes[segmentName] = voxelVolumeML*maskedDoseArray.size
-            segmentActivity[segmentName] = (((voxelVolumeML*maskedDoseArray.size)*segmentDoses[segmentName])/conversionFactor)*densityGPerML
-            # Remove temporary label map node
-            slicer.mrmlScene.RemoveNode(segmentLabelMapNode)
-
-        # Clean up temporary nodes
-        slicer.mrmlScene.RemoveNode(labelMapVolumeNode)
-        slicer.mrmlScene.RemoveNode(maskedVolumeNode)
-
-        logging.info("Dosimetric calculations completed.")
-         # Estimate lung absorbed dose
-        lungDoseGy = (ncorr_activityMBq * lungShuntFractionPercent * 0.01 * conversionFactor) / lungMassg
-   
         # Update segment dose table
         # Clear existing table contents
         self.segmentDoseTable.setRowCount(0)
@@ -427,7 +1034,12 @@ class RadioembolizationDosimetryWidget(ScriptedLoadableModuleWidget):
         # Insert lung dose at the top
         self.segmentDoseTable.insertRow(0)
         self.segmentDoseTable.setItem(0, 0, qt.QTableWidgetItem("Estimated Lung Dose"))
-        self.segmentDoseTable.setItem(0, 1, qt.QTableWidgetItem(f"{lungDoseGy:.2f}"))
+        self.segmentDoseTable.setItem(0, 1, qt.QTableWidgetItem(f"{result.lungDoseGy:.2f}"))
+        uncertainty = result.doseUncertainty
+        if uncertainty:
+            lower, upper = uncertainty.lungDoseInterval
+            self.segmentDoseTable.setItem(0, self.uncertaintyColumn, qt.QTableWidgetItem(f"{lower:.2f} - {upper:.2f}"))
+            segmentLower, segmentUpper = uncertainty.segmentIntervals
 
         # Populate table with segment doses
         for segmentName, dose in segmentDoses.items():
@@ -436,14 +1048,47 @@ class RadioembolizationDosimetryWidget(ScriptedLoadableModuleWidget):
             self.segmentDoseTable.setItem(rowPosition, 0, qt.QTableWidgetItem(segmentName))
             self.segmentDoseTable.setItem(rowPosition, 1, qt.QTableWidgetItem(f"{dose:.2f}"))
             self.segmentDoseTable.setItem(rowPosition, 2, qt.QTableWidgetItem(f"{segmentVolumes[segmentName]:.2f}"))
-            self.segmentDoseTable.setItem(rowPosition, 3, qt.QTableWidgetItem(f"{segmentActivity[segmentName]:.2f}"))     
-       
-        
-        return segmentDoses
-
+            self.segmentDoseTable.setItem(rowPosition, 3, qt.QTableWidgetItem(f"{segmentActivity[segmentName]:.2f}"))
+            for column, value in enumerate(segmentMetrics[segmentName], 4):
+                self.segmentDoseTable.setItem(rowPosition, column, qt.QTableWidgetItem(f"{value:.2f}"))
+            if uncertainty:
+                index = segmentIndices[segmentName]
+                self.segmentDoseTable.setItem(rowPosition, self.uncertaintyColumn, qt.QTableWidgetItem(
+                    f"{segmentLower[index]:.2f} - {segmentUpper[index]:.2f}"))
 
+        return segmentDoses
 
+    def writeDoseOutputs(self, spectVolumeNode, segmentationNode, outputVolumeNode, result, timer=None):
+        """
+        Write the dose array of a DosimetryResult to the output volume and fill the segment dose table.
+        """
+        # The output volume is only touched once the dose is complete, so a cancelled or failed
+        # calculation leaves it as it was. A reused dose array is the output buffer and is not copied.
+        doseArray = result.doseArray
+        with timedStage(timer, "writeOutputVolume"):
+            if outputVolumeNode is not spectVolumeNode:
+                prepareOutputVolume(spectVolumeNode, outputVolumeNode, doseArray.dtype)
+            outputVolumeNode.SetAttribute("DicomRtImport.DoseVolume", "1")
+            finishOutputVolume(outputVolumeNode, doseArray)
 
+        # Set window/level for the output volume display
+        with timedStage(timer, "display"):
+            displayNode = outputVolumeNode.GetDisplayNode()
+            if displayNode:
+                window = 250
+                level = 125
+                displayNode.SetAutoWindowLevel(False)
+                displayNode.SetWindow(window)
+                displayNode.SetLevel(level)
+                colorNode = slicer.util.getNode('PET-Rainbow2')
+                displayNode.SetAndObserveColorNodeID(colorNode.GetID())
+
+        with timedStage(timer, "segmentTable"):
+            segmentDoses = self.updateSegmentDoseTable(segmentationNode, result)
+
+        if self.isodoseAfterCalculationCheckBox.checked:
+            self.createIsodoseSegmentsFromDose(outputVolumeNode, segmentationNode, timer)
+        return segmentDoses
 
     def limonCalculateButton(self):
         spectVolumeNode = self.spectSelector.currentNode()
@@ -453,141 +1098,28 @@ class RadioembolizationDosimetryWidget(ScriptedLoadableModuleWidget):
         outputVolumeNode = self.outputVolumeSelector.currentNode()
         lungShuntFractionPercent = self.lungShuntSlider.value
 
-        sliceWidget = slicer.app.layoutManager().sliceWidget("Red")
-        sliceCompositeNode = sliceWidget.mrmlSliceCompositeNode()
-        backgroundVolumeid = slicer.app.layoutManager().sliceWidget("Red").mrmlSliceCompositeNode().GetBackgroundVolumeID()
-
         if not spectVolumeNode or not segmentationNode or not liverSegmentID or not outputVolumeNode:
             slicer.util.errorDisplay("Please select valid input and output nodes, and ensure the liver segment is specified.")
             return
+        if not self.targetSegmentSelector.currentSegmentID():
+            slicer.util.errorDisplay("Please select the target segment.")
+            return
 
 
-        # Perform dosimetric calculations
-        self.limcalculateDose(spectVolumeNode, segmentationNode, liverSegmentID, activityMBq, outputVolumeNode, lungShuntFractionPercent)
-        self.outputVolumeSelector.currentNode().SetName("Dose Map (Gy)")
-        foregroundVolumeid = self.outputVolumeSelector.currentNode().GetID()
-        sliceCompositeNode.SetBackgroundVolumeID(backgroundVolumeid)
-        sliceCompositeNode.SetForegroundVolumeID(foregroundVolumeid)
-        sliceCompositeNode.SetForegroundOpacity(0.5)
+        # Perform dosimetric calculations in the background
+        parameters = self.getDosimetryParameters(activityMBq, lungShuntFractionPercent)
+        self.startDoseCalculation(spectVolumeNode, segmentationNode, liverSegmentID, outputVolumeNode, parameters,
+                                  self.targetSegmentSelector.currentSegmentID(), self.targetdoseSlider.value)
 
-    def limcalculateDose(self, spectVolumeNode, segmentationNode, liverSegmentID, activityMBq, outputVolumeNode, lungShuntFractionPercent):
+    def getSegmentTableRows(self):
         """
-        Perform dosimetric calculations using the given inputs.
+        Texts of the segment dose table rows as (segment, dose, volume, activity, *DVH metrics), None for empty cells.
         """
-        logging.info("Starting dosimetric calculations.")
-
-        # Validate inputs
-        if not spectVolumeNode or not segmentationNode or not liverSegmentID or not outputVolumeNode:
-            raise ValueError("Invalid inputs. Please select valid nodes and ensure the liver segment is specified.")
-
-        # Export the liver segment to a label map aligned with the input volume
-        labelMapVolumeNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLabelMapVolumeNode")
-        slicer.modules.segmentations.logic().ExportSegmentsToLabelmapNode(
-            segmentationNode, [liverSegmentID], labelMapVolumeNode, spectVolumeNode
-        )
-
-        # Apply the label map to mask the input volume
-        maskedVolumeNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode", "MaskedVolume")
-        parameters = {
-            "InputVolume": spectVolumeNode.GetID(),
-            "MaskVolume": labelMapVolumeNode.GetID(),
-            "OutputVolume": maskedVolumeNode.GetID(),
-            "Label": 1,  # Label value corresponding to the liver segment
-            "Replace": 0  # Set voxels outside the segment to 0
-        }
-        slicer.cli.runSync(slicer.modules.maskscalarvolume, None, parameters)
-
-        # Clone the masked volume to the output volume to inherit spatial properties
-        volumesLogic = slicer.modules.volumes.logic()
-        clonedOutputVolumeNode = volumesLogic.CloneVolume(slicer.mrmlScene, maskedVolumeNode, outputVolumeNode.GetName())
-        outputVolumeNode.Copy(clonedOutputVolumeNode)
-        outputVolumeNode.SetAttribute("DicomRtImport.DoseVolume", "1")
-        slicer.mrmlScene.RemoveNode(clonedOutputVolumeNode)
-
-        # Get the masked volume array
-        maskedArray = slicer.util.arrayFromVolume(maskedVolumeNode)
-        if maskedArray is None:
-            raise ValueError("Unable to access data from the masked volume.")
-
-        # Calculate total volume in mL
-        spacing = spectVolumeNode.GetSpacing()  # spacing is in mm
-        voxelVolumeML = (spacing[0] * spacing[1] * spacing[2]) / 1000.0  # convert mm^3 to mL
-        totalVolumeML = maskedArray.size * voxelVolumeML
-
-        #SET ACTIVITY TO 1000 MBQ
-        activityMBq=1000
-
-        # Constants for Y-90 dosimetry
-        conversionFactor = self.conversionFactorSpinBox.value
-        lungMassg = self.lungMassSpinBox.value
-        densityGPerML = self.liverDensitySpinBox.value
-
-        NsegmentID = self.targetSegmentSelector.currentSegmentID()
-        
-        
-        # Adjust activity based on lung shunt fraction
-        lungShuntFraction = lungShuntFractionPercent / 100.0
-        activityMBq = activityMBq * (1 - lungShuntFraction)
-        if totalVolumeML == 0:
-            raise ValueError("Total volume is zero. Ensure the liver segment is correctly defined.")
-
-        # Calculate mean input value within the liver segment
-        meanInputValue = np.sum(maskedArray) / maskedArray.size
-
-
-
-        # Calculate mean output dose
-        meanOutputDoseGy = (activityMBq / (totalVolumeML * densityGPerML)) * conversionFactor
-
-        # Rescale factor to normalize dose
-        rescaleFactor = meanOutputDoseGy / meanInputValue
-
-        # Write rescaled dose values to output volume
-        doseArray = maskedArray * rescaleFactor
-        slicer.util.updateVolumeFromArray(outputVolumeNode, doseArray)
-
-        # Set window/level for the output volume display
-        displayNode = outputVolumeNode.GetDisplayNode()
-        if displayNode:
-            maxDoseGy = np.max(doseArray)
-            window = 250
-            level = 125
-            displayNode.SetAutoWindowLevel(False)
-            displayNode.SetWindow(window)
-            displayNode.SetLevel(level)
-            colorNode = slicer.util.getNode('PET-Rainbow2')
-            displayNode.SetAndObserveColorNodeID(colorNode.GetID())
-            
-        segmentation = segmentationNode.GetSegmentation()
-
-        # Calculate NDOSE for LSF corrected 1000mbq
-        NsegmentName = segmentation.GetSegment(NsegmentID).GetName()
-        segmentLabelMapNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLabelMapVolumeNode")
-        slicer.modules.segmentations.logic().ExportSegmentsToLabelmapNode(
-        segmentationNode, [NsegmentID], segmentLabelMapNode, spectVolumeNode
-        )
-        segmentLabelMapArray = slicer.util.arrayFromVolume(segmentLabelMapNode)
-        maskedDoseArray = doseArray[segmentLabelMapArray == 1]
-        NDOSE = np.mean(maskedDoseArray)
-        # Remove temporary label map node
-        slicer.mrmlScene.RemoveNode(segmentLabelMapNode)
-        slicer.mrmlScene.RemoveNode(maskedVolumeNode)
-        slicer.mrmlScene.RemoveNode(labelMapVolumeNode)
-
-
-        permittedMBq = 1000
-        if self.targetdoseSlider.value>0:
-            permittedMBq = ((self.targetdoseSlider.value/NDOSE)*1000)
-                
-        self.activitySlider.value = permittedMBq
-
-
-        self.calculateDose(spectVolumeNode, segmentationNode, liverSegmentID, permittedMBq, outputVolumeNode, lungShuntFractionPercent)
-        
- 
-       
-        
-        return 0
+        rows = []
+        for row in range(self.segmentDoseTable.rowCount):
+            items = [self.segmentDoseTable.item(row, column) for column in range(self.segmentDoseTable.columnCount)]
+            rows.append(tuple(item.text() if item else None for item in items))
+        return rows
 
     def onSaveReportClicked(self):
         # Open file dialog to select save path
@@ -599,49 +1131,32 @@ class RadioembolizationDosimetryWidget(ScriptedLoadableModuleWidget):
             fileName += ".rtf"
 
         # Build RTF content
-        import datetime
-        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         conversionFactor = self.conversionFactorSpinBox.value
         lungMass = self.lungMassSpinBox.value
         liverDensity = self.liverDensitySpinBox.value
         activity = self.activitySlider.value
         lungShunt = self.lungShuntSlider.value
+        parameters = [
+            ("Activity", f"{activity:.2f} MBq"),
+            ("Lung Shunt", f"{lungShunt:.2f}%"),
+            ("Conversion Factor", f"{conversionFactor:.2f} Gy/MBq/g"),
+            ("Lung Mass", f"{lungMass:.2f} g"),
+            ("Liver Density", f"{liverDensity:.2f} g/mL"),
+        ]
+        parameters += self.getRadiobiologyReportParameters()
+        metricColumns = self.dvhMetricColumns + self.radiobiologyColumns + ["Dose CI (Gy)"]
+        uncertaintyModel = self.getUncertaintyModel()
+        if uncertaintyModel:
+            for name, label, _, _ in UNCERTAINTY_PARAMETERS:
+                distributionComboBox, spreadSpinBox = self.uncertaintyWidgets[name]
+                if distributionComboBox.currentText != "fixed" and spreadSpinBox.value > 0:
+                    parameters.append((f"{label} Uncertainty", f"{distributionComboBox.currentText}, {spreadSpinBox.value:.3f}"))
+            parameters.append(("Confidence Interval", f"{uncertaintyModel.confidencePercent:.1f}% from "
+                                                      f"{uncertaintyModel.numberOfSamples} samples (seed {uncertaintyModel.seed})"))
+            metricColumns[-1] = f"{uncertaintyModel.confidencePercent:.1f}% CI (Gy)"
+        rtf = formatRtfReport("Taranis - Patient Relative Quantification", parameters, self.getSegmentTableRows(),
+                              metricColumns=metricColumns)
 
-        rtf = r"""{\rtf1\ansi\deff0
-{\b Taranis - Patient Relative Quantification\line
-\b Radioembolization Dosimetry Report}\line
-Generated: """ + now + r"""\line
-\line
-{\b Parameters}\line
-Activity: """ + f"{activity:.2f} MBq" + r"""\line
-Lung Shunt: """ + f"{lungShunt:.2f}%" + r"""\line
-Conversion Factor: """ + f"{conversionFactor:.2f} Gy/MBq/g" + r"""\line
-Lung Mass: """ + f"{lungMass:.2f} g" + r"""\line
-Liver Density: """ + f"{liverDensity:.2f} g/mL" + r"""\line
-\line
-{\b Segment Doses}\line
-"""
-
-        rowCount = self.segmentDoseTable.rowCount
-        colCount = self.segmentDoseTable.columnCount
-        for row in range(rowCount):
-            segment = self.segmentDoseTable.item(row, 0)
-            dose = self.segmentDoseTable.item(row, 1)
-            vol = self.segmentDoseTable.item(row, 2) if colCount > 2 else None
-            act = self.segmentDoseTable.item(row, 3) if colCount > 3 else None
-            
-            rtf += f"Segment: {segment.text()}, "
-
-            if dose:
-                rtf += f"Dose = {dose.text()} Gy"
-            if vol:
-                rtf += f", Volume = {vol.text()} mL"
-            if act:
-                rtf += f", Activity = {act.text()} MBq"
-            rtf += r"\line\n "
-
-        rtf += r"\line\n End of Report}"
-        
         # Write to file
         with open(fileName, "w") as file:
             file.write(rtf)
@@ -0,0 +1,100 @@
+import dataclasses
+
+import numpy as np
+
+from .DoseVolumeHistograms import computeDoseVolumeHistograms, updateDoseVolumeHistograms
+from .Parameters import DosimetryResult, computeVoxelVolumeML
+from .SegmentStatistics import computeSegmentStatistics
+from .VoxelSValues import convolveWithDoseKernel
+
+
+def computeTotalActivityMBq(petArray, voxelVolumeML):
+    """
+    Total activity (MBq) of a volume of activity concentrations in Bq/mL.
+    """
+    totalVolumeML = petArray.size * voxelVolumeML
+    meanInputValue = np.sum(petArray, dtype=np.float64) / petArray.size
+    return totalVolumeML * meanInputValue / 1000000
+
+
+def calculateAbsoluteDose(petArray, spacing, labelLayers, parameters, out=None):
+    """
+    Absolute-quantification dosimetry on arrays. petArray holds activity concentrations in Bq/mL.
+    Returns a DosimetryResult with the dose array, per-segment doses, volumes, activities and DVHs
+    and the total and decay-corrected activity. The dose array is written into out if given, otherwise
+    into a new array with the precision of parameters.doseDtype. labelLayers is a list of
+    (labelArray, segmentIDs) pairs or a {segmentID: SegmentMask} dict. If parameters.doseKernel
+    names a nuclide, the locally deposited dose is convolved with its voxel kernel.
+    """
+    voxelVolumeML = computeVoxelVolumeML(spacing)
+    totalVolumeML = petArray.size * voxelVolumeML
+    if totalVolumeML == 0:
+        raise ValueError("Total volume is zero. Ensure the SPECT volume contains valid data.")
+
+    # Total activity in the field of view, from a single pass over the image
+    totalActivityMBq = computeTotalActivityMBq(petArray, voxelVolumeML)
+    meanInputValue = totalActivityMBq * 1000000 / totalVolumeML
+
+    # Decay correction to the time of treatment
+    decayCorrectedActivityMBq = totalActivityMBq * (2.0 ** (parameters.hoursElapsed / parameters.halfLifeHours))
+
+    # Mean dose over the field of view, and the factor that maps the image values to it
+    meanOutputDoseGy = (decayCorrectedActivityMBq / (totalVolumeML * parameters.densityGPerML)) * parameters.conversionFactor
+    rescaleFactor = meanOutputDoseGy / meanInputValue
+    if out is None:
+        out = np.empty(petArray.shape, dtype=parameters.doseDtype)
+    if parameters.doseKernel:
+        localDoseArray = np.multiply(petArray, rescaleFactor, dtype=np.float32)
+        doseArray = convolveWithDoseKernel(localDoseArray, parameters.doseKernel, spacing, out=out)
+        del localDoseArray
+    else:
+        doseArray = np.multiply(petArray, rescaleFactor, out=out, casting="unsafe")
+
+    statistics = computeSegmentStatistics(doseArray, labelLayers, voxelVolumeML, squares=True)
+    doseVolumeHistograms = computeDoseVolumeHistograms(doseArray, labelLayers)
+    return DosimetryResult(
+        segmentIDs=statistics.segmentIDs,
+        segmentDoses=statistics.means,
+        segmentVolumes=statistics.volumes,
+        segmentActivities=statistics.activities(parameters.conversionFactor, parameters.densityGPerML),
+        doseArray=doseArray,
+        totalActivityMBq=totalActivityMBq,
+        decayCorrectedActivityMBq=decayCorrectedActivityMBq,
+        doseVolumeHistograms=doseVolumeHistograms,
+        segmentMeanSquareDoses=statistics.meanSquares,
+    )
+
+
+def updateAbsoluteDoseSegments(result, segmentMasks, segmentIDs, spacing, parameters):
+    """
+    DosimetryResult of calculateAbsoluteDose with the rows of segmentIDs recomputed from their masks in a
+    {segmentID: SegmentMask} dict on the existing dose array, for segments edited while the inputs stayed
+    the same. All other rows, the dose array and the activities of the field of view are reused.
+    segmentMasks must contain every segment if the histograms have to be rebinned.
+    """
+    updatedMasks = {segmentID: segmentMasks[segmentID] for segmentID in segmentIDs}
+    statistics = computeSegmentStatistics(result.doseArray, updatedMasks, computeVoxelVolumeML(spacing), squares=True)
+    rows = [result.segmentIDs.index(segmentID) for segmentID in statistics.segmentIDs]
+
+    def updateRows(values, updatedValues):
+        values = np.array(values, dtype=np.float64)
+        values[rows] = updatedValues
+        return values
+
+    doseVolumeHistograms = result.doseVolumeHistograms
+    if doseVolumeHistograms is not None:
+        doseVolumeHistograms = updateDoseVolumeHistograms(doseVolumeHistograms, result.doseArray, segmentMasks, segmentIDs)
+    segmentMeanSquareDoses = result.segmentMeanSquareDoses
+    if segmentMeanSquareDoses is not None:
+        segmentMeanSquareDoses = updateRows(segmentMeanSquareDoses, statistics.meanSquares)
+    return dataclasses.replace(
+        result,
+        segmentDoses=updateRows(result.segmentDoses, statistics.means),
+        segmentVolumes=updateRows(result.segmentVolumes, statistics.volumes),
+        segmentActivities=updateRows(result.segmentActivities,
+                                     statistics.activities(parameters.conversionFactor, parameters.densityGPerML)),
+        doseVolumeHistograms=doseVolumeHistograms,
+        segmentMeanSquareDoses=segmentMeanSquareDoses,
+        doseUncertainty=None,
+        radiobiology=None,
+    )
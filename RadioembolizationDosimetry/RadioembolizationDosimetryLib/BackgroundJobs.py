@@ -0,0 +1,95 @@
+import threading
+
+
+class CalculationCancelled(Exception):
+    """
+    Raised inside a background job when it was cancelled.
+    """
+
+
+class BackgroundJob:
+    """
+    Runs function(job) on a worker thread. The function announces its stages with
+    job.setStage(name); a cancelled job stops with CalculationCancelled at the next stage.
+    The job does not touch the MRML scene or Qt, so the caller polls done/progress from
+    the main thread (e.g. with a QTimer) and applies the result there.
+    """
+
+    def __init__(self, function, stageNames, name="Calculation"):
+        self.function = function
+        self.stageNames = list(stageNames)
+        self.name = name
+        self.stageName = None
+        self.stageIndex = 0
+        self.result = None
+        self.error = None
+        self._cancelEvent = threading.Event()
+        self._doneEvent = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        try:
+            self.result = self.function(self)
+        except BaseException as e:
+            self.error = e
+        finally:
+            self._doneEvent.set()
+
+    def setStage(self, stageName):
+        """
+        Called by the job function when it starts a new stage.
+        """
+        if self._cancelEvent.is_set():
+            raise CalculationCancelled(f"{self.name} was cancelled.")
+        self.stageName = stageName
+        if stageName in self.stageNames:
+            self.stageIndex = self.stageNames.index(stageName)
+
+    def cancel(self):
+        self._cancelEvent.set()
+
+    @property
+    def cancelled(self):
+        return isinstance(self.error, CalculationCancelled)
+
+    @property
+    def done(self):
+        return self._doneEvent.is_set()
+
+    @property
+    def progress(self):
+        """
+        Fraction (0-1) of the stages that are finished.
+        """
+        if self.done:
+            return 1.0
+        return self.stageIndex / max(len(self.stageNames), 1)
+
+    def wait(self, timeout=None):
+        return self._doneEvent.wait(timeout)
+
+
+# IDs of the output volumes that a running calculation will write to, shared by all Taranis modules
+_busyOutputVolumeIDs = set()
+_busyOutputVolumeLock = threading.Lock()
+
+
+def acquireOutputVolume(nodeID):
+    """
+    Reserve an output volume for one calculation. Returns False if it is already in use.
+    """
+    with _busyOutputVolumeLock:
+        if nodeID in _busyOutputVolumeIDs:
+            return False
+        _busyOutputVolumeIDs.add(nodeID)
+        return True
+
+
+def releaseOutputVolume(nodeID):
+    with _busyOutputVolumeLock:
+        _busyOutputVolumeIDs.discard(nodeID)
@@ -0,0 +1,223 @@
+"""
+Headless batch dosimetry over a cohort of NRRD studies.
+
+Usage (plain Python or Slicer):
+
+    python -m RadioembolizationDosimetryLib.BatchDosimetry manifest.csv outputDir
+    Slicer --no-main-window --python-script .../RadioembolizationDosimetryLib/BatchDosimetry.py manifest.csv outputDir
+
+The manifest is a CSV file with one study per row and the columns
+PatientID, Mode (relative or absolute), Image, Segmentation and, for relative dosimetry,
+LiverSegment and ActivityMBq. Optional columns LungShuntPercent, HoursElapsed, ConversionFactor,
+LiverDensity, LungMass and HalfLife override the command line defaults.
+Dose maps are written with the precision of --dose-precision (float32 by default).
+With --dose-kernel Y-90 or Ho-166 the activity is convolved with an approximate beta dose kernel instead of
+being deposited locally.
+Result and dose map files are named by PatientID, Mode and a hash of the study inputs and resolved
+parameters. Studies with a finished result for the same hash are skipped when the batch is run again,
+so an interrupted run can be resumed; --force runs all studies again.
+"""
+
+import argparse
+import csv
+import dataclasses
+import logging
+import os
+import sys
+
+if __name__ == "__main__" and not __package__:
+    # Allow running this file directly, e.g. with Slicer --python-script
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from RadioembolizationDosimetryLib.AbsoluteDosimetry import calculateAbsoluteDose
+from RadioembolizationDosimetryLib.BatchProcessing import (
+    addBatchArguments,
+    getParameterHash,
+    getResultPath,
+    isFinished,
+    logRecord,
+    readManifest,
+    readRecord,
+    runInProcessPool,
+    runRecordedCase,
+)
+from RadioembolizationDosimetryLib.DoseVolumeHistograms import DEFAULT_DVH_METRICS
+from RadioembolizationDosimetryLib.NrrdIO import getLabelLayers, readSegmentation, readVolume, resampleLabelsToReference, writeVolume
+from RadioembolizationDosimetryLib.Parameters import DosimetryParameters
+from RadioembolizationDosimetryLib.RelativeDosimetry import calculateRelativeDose
+from RadioembolizationDosimetryLib.VoxelSValues import DOSE_KERNEL_NUCLIDES
+
+
+RESULT_COLUMNS = ["PatientID", "Mode", "Segment", "DoseGy", "VolumeML", "ActivityMBq", *DEFAULT_DVH_METRICS,
+                  "LungDoseGy", "TotalActivityMBq", "DecayCorrectedActivityMBq"]
+
+
+def readDosimetryManifest(manifestPath):
+    """
+    Read the manifest rows; relative file paths are resolved against the manifest folder.
+    """
+    cases = readManifest(manifestPath)
+    for row in cases:
+        row["Mode"] = row.get("Mode", "relative").lower() or "relative"
+        if row["Mode"] not in ("relative", "absolute"):
+            raise ValueError(f"Unknown mode '{row['Mode']}' for patient {row['PatientID']}.")
+    return cases
+
+
+def _getParameters(case, defaults):
+    def value(column, default):
+        return float(case[column]) if case.get(column) else default
+
+    return DosimetryParameters(
+        activityMBq=value("ActivityMBq", 0.0),
+        lungShuntFraction=value("LungShuntPercent", 0.0) / 100.0,
+        conversionFactor=value("ConversionFactor", defaults.conversionFactor),
+        densityGPerML=value("LiverDensity", defaults.densityGPerML),
+        lungMassG=value("LungMass", defaults.lungMassG),
+        hoursElapsed=value("HoursElapsed", 0.0),
+        halfLifeHours=value("HalfLife", defaults.halfLifeHours),
+        doseDtype=defaults.doseDtype,
+        doseKernel=defaults.doseKernel,
+    )
+
+
+def _getParameterHash(case, parameters):
+    return getParameterHash({
+        "Mode": case["Mode"],
+        "Image": case["Image"],
+        "Segmentation": case["Segmentation"],
+        "LiverSegment": case.get("LiverSegment", "") if case["Mode"] == "relative" else "",
+        "Parameters": dataclasses.asdict(parameters),
+    })
+
+
+def _getResultName(case, parameterHash):
+    return f"{case['PatientID']}_{case['Mode']}_{parameterHash}"
+
+
+def _toFloat(value):
+    return None if value is None else float(value)
+
+
+def runCase(case, defaults, outputDir, writeDoseMap=True, traceDirectory=None):
+    """
+    Run relative or absolute dosimetry for one manifest row and store the result as JSON.
+    Executed in a worker process.
+    """
+    patientID = case["PatientID"]
+    parameters = _getParameters(case, defaults)
+    parameterHash = _getParameterHash(case, parameters)
+    resultName = _getResultName(case, parameterHash)
+
+    def compute(timer):
+        with timer.stage("read"):
+            image = readVolume(case["Image"])
+            labelVolume, segments = readSegmentation(case["Segmentation"])
+        with timer.stage("resampleLabels"):
+            layerArrays = resampleLabelsToReference(labelVolume, image)
+            labelLayers = getLabelLayers(layerArrays, segments)
+        segmentNames = {segment.segmentID: segment.name for segment in segments}
+
+        with timer.stage("dose"):
+            if case["Mode"] == "relative":
+                liverSegments = [segment for segment in segments if segment.name == case.get("LiverSegment")]
+                if not liverSegments:
+                    raise ValueError(f"Liver segment '{case.get('LiverSegment')}' not found in {case['Segmentation']}.")
+                liverMask = layerArrays[liverSegments[0].layer] == liverSegments[0].labelValue
+                result = calculateRelativeDose(image.array, image.spacing, liverMask, labelLayers, parameters)
+            else:
+                result = calculateAbsoluteDose(image.array, image.spacing, labelLayers, parameters)
+
+        if writeDoseMap:
+            with timer.stage("writeDoseMap"):
+                writeVolume(os.path.join(outputDir, f"{resultName}_dose.nrrd"), result.doseArray, image)
+
+        metrics = result.doseVolumeHistograms.metrics(DEFAULT_DVH_METRICS)
+        return {
+            "LungDoseGy": _toFloat(result.lungDoseGy),
+            "TotalActivityMBq": _toFloat(result.totalActivityMBq),
+            "DecayCorrectedActivityMBq": _toFloat(result.decayCorrectedActivityMBq),
+            "Segments": [
+                {"Segment": segmentNames[segmentID], "DoseGy": float(result.segmentDoses[index]),
+                 "VolumeML": float(result.segmentVolumes[index]), "ActivityMBq": float(result.segmentActivities[index]),
+                 **{name: float(values[index]) for name, values in metrics.items()}}
+                for index, segmentID in enumerate(result.segmentIDs)
+            ],
+        }
+
+    return runRecordedCase(f"BatchDosimetry_{resultName}", getResultPath(outputDir, resultName, "result"),
+                           {"PatientID": patientID, "Mode": case["Mode"], "ParameterHash": parameterHash},
+                           traceDirectory, compute)
+
+
+def writeResultsTable(resultPaths, tablePath):
+    """
+    Combine the per-patient results into one CSV table with a row per segment.
+    """
+    with open(tablePath, "w", newline="") as file:
+        writer = csv.DictWriter(file, fieldnames=RESULT_COLUMNS)
+        writer.writeheader()
+        for resultPath in resultPaths:
+            record = readRecord(resultPath)
+            if record is None or record.get("Status") != "ok":
+                continue
+            for segment in record["Segments"]:
+                row = {column: record.get(column) for column in RESULT_COLUMNS}
+                row.update(segment)
+                writer.writerow(row)
+
+
+def runBatch(manifestPath, outputDir, defaults=None, workers=None, writeDoseMaps=True, traceDirectory=None, force=False):
+    """
+    Run all manifest rows that do not have a finished result for their parameters yet (all rows if force is set)
+    across a process pool, then write the combined results table. Returns the list of records produced in this run.
+    """
+    if defaults is None:
+        defaults = DosimetryParameters()
+    os.makedirs(outputDir, exist_ok=True)
+    cases = readDosimetryManifest(manifestPath)
+    resultPaths = []
+    pendingCases = []
+    for case in cases:
+        parameterHash = _getParameterHash(case, _getParameters(case, defaults))
+        resultPath = getResultPath(outputDir, _getResultName(case, parameterHash), "result")
+        resultPaths.append(resultPath)
+        if force or not isFinished(resultPath, parameterHash):
+            pendingCases.append(case)
+    logging.info(f"{len(cases) - len(pendingCases)} of {len(cases)} studies already finished, running {len(pendingCases)}.")
+
+    records = []
+    for record in runInProcessPool(runCase, [(case, defaults, outputDir, writeDoseMaps, traceDirectory)
+                                             for case in pendingCases], workers):
+        records.append(record)
+        logRecord(record)
+
+    writeResultsTable(resultPaths, os.path.join(outputDir, "results.csv"))
+    return records
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Batch radioembolization dosimetry on NRRD studies.")
+    addBatchArguments(parser, "folder for dose maps, per-patient results and results.csv")
+    parser.add_argument("--conversion-factor", type=float, default=49.67, help="Gy/MBq/g (default: Y-90)")
+    parser.add_argument("--liver-density", type=float, default=1.05, help="g/mL")
+    parser.add_argument("--lung-mass", type=float, default=1000.0, help="g")
+    parser.add_argument("--half-life", type=float, default=64.2, help="hours (default: Y-90)")
+    parser.add_argument("--dose-precision", choices=["float32", "float64"], default="float32",
+                        help="precision of the dose maps (default: float32)")
+    parser.add_argument("--dose-kernel", choices=list(DOSE_KERNEL_NUCLIDES), default=None,
+                        help="convolve with the approximate dose kernel of this nuclide (default: local deposition)")
+    parser.add_argument("--no-dose-maps", action="store_true", help="do not write the dose map volumes")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    defaults = DosimetryParameters(conversionFactor=args.conversion_factor, densityGPerML=args.liver_density,
+                                   lungMassG=args.lung_mass, halfLifeHours=args.half_life, doseDtype=args.dose_precision,
+                                   doseKernel=args.dose_kernel)
+    records = runBatch(args.manifest, args.outputDir, defaults, args.workers, not args.no_dose_maps, args.trace_dir,
+                       args.force)
+    return 1 if any(record["Status"] != "ok" for record in records) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,160 @@
+"""
+Headless batch lung shunt fraction over a cohort of 99mTc-MAA SPECT studies stored as NRRD.
+
+Usage (plain Python or Slicer):
+
+    python -m RadioembolizationDosimetryLib.BatchLungShunt manifest.csv outputDir
+    Slicer --no-main-window --python-script .../RadioembolizationDosimetryLib/BatchLungShunt.py manifest.csv outputDir
+
+The manifest is a CSV file with one study per row and the columns
+PatientID, Image, Segmentation, LiverSegment and LungSegment (segment names).
+Lung counts, liver counts and LSF% are written to lsf_results.csv in the output folder,
+and with --sqlite also to a lung_shunt table of an SQLite database.
+Result files are named by PatientID and a hash of the study inputs. Studies with a finished result for
+the same hash are skipped when the batch is run again, so an interrupted run can be resumed;
+--force runs all studies again.
+"""
+
+import argparse
+import csv
+import logging
+import os
+import sqlite3
+import sys
+
+if __name__ == "__main__" and not __package__:
+    # Allow running this file directly, e.g. with Slicer --python-script
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from RadioembolizationDosimetryLib.BatchProcessing import (
+    addBatchArguments,
+    getParameterHash,
+    getResultPath,
+    isFinished,
+    logRecord,
+    readManifest,
+    readRecord,
+    runInProcessPool,
+    runRecordedCase,
+)
+from RadioembolizationDosimetryLib.LabelmapCache import SegmentMask
+from RadioembolizationDosimetryLib.LungShunt import calculateLungShuntFraction
+from RadioembolizationDosimetryLib.NrrdIO import readSegmentation, readVolume, resampleLabelsToReference
+
+
+RESULT_COLUMNS = ["PatientID", "Status", "LungCounts", "LiverCounts", "LSFPercent", "Seconds", "Error"]
+
+
+def _getParameterHash(case):
+    return getParameterHash({column: case[column] for column in ("Image", "Segmentation", "LiverSegment", "LungSegment")})
+
+
+def _getResultPath(outputDir, case, parameterHash):
+    return getResultPath(outputDir, f"{case['PatientID']}_{parameterHash}", "lsf")
+
+
+def _getSegmentMask(layerArrays, segments, segmentName, segmentationPath):
+    matches = [segment for segment in segments if segment.name == segmentName]
+    if not matches:
+        raise ValueError(f"Segment '{segmentName}' not found in {segmentationPath}.")
+    return SegmentMask(layerArrays[matches[0].layer] == matches[0].labelValue)
+
+
+def runCase(case, outputDir, traceDirectory=None):
+    """
+    Compute the lung shunt fraction for one manifest row and store the result as JSON.
+    Executed in a worker process.
+    """
+    patientID = case["PatientID"]
+    parameterHash = _getParameterHash(case)
+
+    def compute(timer):
+        with timer.stage("read"):
+            image = readVolume(case["Image"])
+            labelVolume, segments = readSegmentation(case["Segmentation"])
+        with timer.stage("resampleLabels"):
+            layerArrays = resampleLabelsToReference(labelVolume, image)
+            liverMask = _getSegmentMask(layerArrays, segments, case["LiverSegment"], case["Segmentation"])
+            lungMask = _getSegmentMask(layerArrays, segments, case["LungSegment"], case["Segmentation"])
+        with timer.stage("lsfSums"):
+            lungcounts, livercounts, lsf = calculateLungShuntFraction(image.array, liverMask, lungMask)
+        return {"LungCounts": float(lungcounts), "LiverCounts": float(livercounts), "LSFPercent": float(lsf)}
+
+    return runRecordedCase(f"BatchLungShunt_{patientID}_{parameterHash}", _getResultPath(outputDir, case, parameterHash),
+                           {"PatientID": patientID, "ParameterHash": parameterHash}, traceDirectory, compute)
+
+
+def _readRecords(cases, outputDir):
+    records = [readRecord(_getResultPath(outputDir, case, _getParameterHash(case))) for case in cases]
+    return [record for record in records if record is not None]
+
+
+def writeResultsTable(records, tablePath):
+    """
+    Write one CSV row per study, including failed studies with their error.
+    """
+    with open(tablePath, "w", newline="") as file:
+        writer = csv.DictWriter(file, fieldnames=RESULT_COLUMNS)
+        writer.writeheader()
+        for record in records:
+            writer.writerow({column: record.get(column) for column in RESULT_COLUMNS})
+
+
+def writeResultsDatabase(records, databasePath):
+    """
+    Store the study results in the lung_shunt table of an SQLite database, replacing earlier rows of the same patient.
+    """
+    connection = sqlite3.connect(databasePath)
+    try:
+        with connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS lung_shunt (PatientID TEXT PRIMARY KEY, Status TEXT, LungCounts REAL, "
+                "LiverCounts REAL, LSFPercent REAL, Seconds REAL, Error TEXT)"
+            )
+            connection.executemany(
+                f"INSERT OR REPLACE INTO lung_shunt ({', '.join(RESULT_COLUMNS)}) VALUES ({', '.join('?' * len(RESULT_COLUMNS))})",
+                [tuple(record.get(column) for column in RESULT_COLUMNS) for record in records],
+            )
+    finally:
+        connection.close()
+
+
+def runBatch(manifestPath, outputDir, workers=None, databasePath=None, traceDirectory=None, force=False):
+    """
+    Run all manifest rows that do not have a finished result for their inputs yet (all rows if force is set)
+    across a process pool, then write the combined results table. Returns the list of records produced in this run.
+    """
+    os.makedirs(outputDir, exist_ok=True)
+    cases = readManifest(manifestPath, requiredColumns=("LiverSegment", "LungSegment"))
+    pendingCases = []
+    for case in cases:
+        parameterHash = _getParameterHash(case)
+        if force or not isFinished(_getResultPath(outputDir, case, parameterHash), parameterHash):
+            pendingCases.append(case)
+    logging.info(f"{len(cases) - len(pendingCases)} of {len(cases)} studies already finished, running {len(pendingCases)}.")
+
+    records = []
+    for record in runInProcessPool(runCase, [(case, outputDir, traceDirectory) for case in pendingCases], workers):
+        records.append(record)
+        logRecord(record, f", LSF {record['LSFPercent']:.2f}%" if record["Status"] == "ok" else "")
+
+    allRecords = _readRecords(cases, outputDir)
+    writeResultsTable(allRecords, os.path.join(outputDir, "lsf_results.csv"))
+    if databasePath:
+        writeResultsDatabase(allRecords, databasePath)
+    return records
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Batch lung shunt fraction on 99mTc-MAA SPECT studies stored as NRRD.")
+    addBatchArguments(parser, "folder for per-study results and lsf_results.csv")
+    parser.add_argument("--sqlite", default=None, help="also store the results in this SQLite database")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    records = runBatch(args.manifest, args.outputDir, args.workers, args.sqlite, args.trace_dir, args.force)
+    return 1 if any(record["Status"] != "ok" for record in records) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,130 @@
+"""
+Shared parts of the headless batch runners: manifest reading, per-study result files that allow
+an interrupted run to be resumed, and the process pool that runs the studies.
+"""
+
+import csv
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from .Profiling import StageTimer
+
+
+def readManifest(manifestPath, requiredColumns=(), pathColumns=("Image", "Segmentation")):
+    """
+    Read the manifest rows; relative file paths are resolved against the manifest folder.
+    Rows without a value in one of requiredColumns raise a ValueError.
+    """
+    manifestDir = os.path.dirname(os.path.abspath(manifestPath))
+    cases = []
+    with open(manifestPath, newline="") as file:
+        for row in csv.DictReader(file):
+            row = {key.strip(): (value or "").strip() for key, value in row.items() if key}
+            for column in pathColumns:
+                row[column] = os.path.join(manifestDir, row[column])
+            for column in requiredColumns:
+                if not row.get(column):
+                    raise ValueError(f"Missing {column} for patient {row['PatientID']}.")
+            cases.append(row)
+    return cases
+
+
+def getParameterHash(values):
+    """
+    Short hash of the JSON-serialisable values that determine the result of a study.
+    """
+    text = json.dumps(values, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:12]
+
+
+def getResultPath(outputDir, resultName, suffix):
+    return os.path.join(outputDir, f"{resultName}_{suffix}.json")
+
+
+def writeRecord(resultPath, record):
+    """
+    Write a result record as JSON atomically, so that an interrupted run never leaves a half-written result behind.
+    """
+    with open(resultPath + ".tmp", "w") as file:
+        json.dump(record, file, indent=2)
+    os.replace(resultPath + ".tmp", resultPath)
+
+
+def readRecord(resultPath):
+    """
+    The result record stored at resultPath, or None if there is none.
+    """
+    try:
+        with open(resultPath) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def isFinished(resultPath, parameterHash):
+    """
+    True if resultPath holds a successful result that was computed with the parameters of parameterHash.
+    """
+    record = readRecord(resultPath)
+    return record is not None and record.get("Status") == "ok" and record.get("ParameterHash") == parameterHash
+
+
+def runRecordedCase(timerName, resultPath, record, traceDirectory, compute):
+    """
+    Run compute(timer), which returns the result fields of one study, and store them in record with the
+    status, the wall time and the stage timings. Failures are recorded instead of raised.
+    The record is written to resultPath and returned.
+    """
+    startTime = time.perf_counter()
+    timer = StageTimer(timerName, traceDirectory=traceDirectory)
+    timer.start()
+    try:
+        record.update(compute(timer))
+        record["Status"] = "ok"
+    except Exception as e:
+        record.update({"Status": "failed", "Error": f"{type(e).__name__}: {e}"})
+        timer.error = record["Error"]
+    timer.finish()
+    record["Seconds"] = time.perf_counter() - startTime
+    record["Stages"] = timer.stages
+    writeRecord(resultPath, record)
+    return record
+
+
+def runInProcessPool(function, argumentsList, workers=None):
+    """
+    Call function(*arguments) for every entry of argumentsList in worker processes and yield the results
+    in the order they finish. function must be importable at module level.
+    """
+    if not argumentsList:
+        return
+    # Spawned workers behave the same in plain Python and in Slicer's Python
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count(), mp_context=context) as executor:
+        futures = [executor.submit(function, *arguments) for arguments in argumentsList]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def logRecord(record, details=""):
+    message = f"{record['PatientID']}: {record['Status']} in {record['Seconds']:.2f} s"
+    if record["Status"] == "ok":
+        logging.info(message + details)
+    else:
+        logging.error(f"{message} ({record['Error']})")
+
+
+def addBatchArguments(parser, outputDirHelp):
+    """
+    Add the manifest, output folder, worker and trace arguments shared by the batch runners.
+    """
+    parser.add_argument("manifest", help="CSV manifest with one study per row")
+    parser.add_argument("outputDir", help=outputDirHelp)
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes (default: all cores)")
+    parser.add_argument("--trace-dir", default=None, help="folder for per-study JSON timing traces")
+    parser.add_argument("--force", action="store_true", help="run all studies again, including finished ones")
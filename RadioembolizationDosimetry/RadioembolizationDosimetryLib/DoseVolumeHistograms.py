@@ -0,0 +1,158 @@
+import numpy as np
+
+from .SegmentStatistics import STATISTICS_CHUNK_SIZE
+
+
+# Metrics reported in the segment tables and reports: Dx in Gy and Vx in percent of the segment volume
+DEFAULT_DVH_METRICS = ("D70", "D50", "V100", "V205")
+DEFAULT_DVH_BINS = 1000
+
+
+class DoseVolumeHistograms:
+    """
+    Cumulative dose-volume histograms of several segments on common fixed-width bins.
+    voxelCounts[i, b] is the number of voxels of segment i with a value in [binEdges[b], binEdges[b + 1]),
+    fractional (float64) for partial-volume masks.
+    """
+
+    def __init__(self, segmentIDs, binEdges, voxelCounts):
+        self.segmentIDs = list(segmentIDs)
+        self.binEdges = np.asarray(binEdges, dtype=np.float64)
+        voxelCounts = np.asarray(voxelCounts)
+        self.voxelCounts = voxelCounts.astype(np.float64 if voxelCounts.dtype.kind == "f" else np.int64)
+
+    @property
+    def cumulative(self):
+        """
+        Fraction of each segment's volume with a value of at least binEdges[b], shape (segments, bins + 1).
+        Empty segments get NaN.
+        """
+        totals = self.voxelCounts.sum(axis=1)
+        counts = np.zeros((len(self.segmentIDs), self.binEdges.size), dtype=self.voxelCounts.dtype)
+        counts[:, :-1] = np.cumsum(self.voxelCounts[:, ::-1], axis=1)[:, ::-1]
+        fractions = np.full(counts.shape, np.nan)
+        np.divide(counts, totals[:, np.newaxis], out=fractions, where=totals[:, np.newaxis] > 0)
+        return fractions
+
+    def scaled(self, factor):
+        """
+        Histograms of the values multiplied by a positive factor, e.g. counts rescaled to Gy.
+        """
+        return DoseVolumeHistograms(self.segmentIDs, self.binEdges * factor, self.voxelCounts)
+
+    def doseAtVolume(self, volumePercent):
+        """
+        Dx: the minimum dose received by the hottest volumePercent of each segment.
+        """
+        cumulative = self.cumulative
+        fraction = volumePercent / 100.0
+        # Last bin whose lower edge is still reached by the fraction, then linear interpolation inside it
+        rows = np.arange(cumulative.shape[0])
+        bins = np.clip(np.sum(cumulative >= fraction, axis=1) - 1, 0, self.binEdges.size - 2)
+        upper = cumulative[rows, bins]
+        lower = cumulative[rows, bins + 1]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            position = np.clip((upper - fraction) / (upper - lower), 0.0, 1.0)
+        return self.binEdges[bins] + position * (self.binEdges[bins + 1] - self.binEdges[bins])
+
+    def volumeAtDose(self, doseGy):
+        """
+        Vx: percentage of each segment's volume that receives at least doseGy.
+        """
+        return np.array([np.interp(doseGy, self.binEdges, row) * 100.0 for row in self.cumulative])
+
+    def metrics(self, names=DEFAULT_DVH_METRICS):
+        """
+        {name: per-segment values} for metric names such as "D70" (Gy) and "V100" (%).
+        """
+        values = {}
+        for name in names:
+            kind, value = name[0].upper(), float(name[1:])
+            if kind == "D":
+                values[name] = self.doseAtVolume(value)
+            elif kind == "V":
+                values[name] = self.volumeAtDose(value)
+            else:
+                raise ValueError(f"Unknown dose-volume metric '{name}'. Use Dx (Gy) or Vx (%).")
+        return values
+
+
+def getMetricUnit(name):
+    """
+    Unit of a dose-volume metric: Gy for Dx, % for Vx.
+    """
+    return "Gy" if name[0].upper() == "D" else "%"
+
+
+def _getBinIndices(values, binWidth, numberOfBins):
+    indices = values / binWidth
+    np.clip(indices, 0, numberOfBins - 1, out=indices)
+    return indices.astype(np.intp)
+
+
+def computeDoseVolumeHistograms(valueArray, labelLayers, numberOfBins=DEFAULT_DVH_BINS, maxValue=None):
+    """
+    Histograms of valueArray for all segments of a list of (labelArray, segmentIDs) label layers,
+    or of a {segmentID: SegmentMask} dict, in one bincount pass per layer or per segment bounding box.
+    Bins span [0, maxValue], by default the largest value of valueArray (inside the segments for
+    SegmentMasks); values outside are counted in the first or last bin. Voxels of a FractionalSegmentMask
+    are weighted by the fraction the segment covers.
+    """
+    if isinstance(labelLayers, dict):
+        masks = labelLayers
+        regions = []
+        for segmentID, mask in masks.items():
+            if mask.shape != valueArray.shape:
+                raise ValueError("Label map geometry does not match the input volume.")
+            regions.append(valueArray[mask.slices][mask.croppedArray()] if mask.voxelCount else np.empty(0, valueArray.dtype))
+        if maxValue is None:
+            maxValue = max((float(np.max(region)) for region in regions if region.size), default=0.0)
+        binWidth = maxValue / numberOfBins if maxValue > 0 else 1.0
+        voxelCounts = [np.bincount(_getBinIndices(region, binWidth, numberOfBins), weights=mask.weights, minlength=numberOfBins)
+                       for region, mask in zip(regions, masks.values())]
+        if any(mask.weights is not None for mask in masks.values()):
+            voxelCounts = [counts.astype(np.float64) for counts in voxelCounts]
+        return DoseVolumeHistograms(list(masks), np.arange(numberOfBins + 1) * binWidth,
+                                    np.reshape(voxelCounts, (len(regions), numberOfBins)))
+
+    if maxValue is None:
+        maxValue = float(np.max(valueArray)) if valueArray.size else 0.0
+    binWidth = maxValue / numberOfBins if maxValue > 0 else 1.0
+    segmentIDs = []
+    voxelCounts = []
+    for labelArray, layerSegmentIDs in labelLayers:
+        if labelArray.shape != valueArray.shape:
+            raise ValueError("Label map geometry does not match the input volume.")
+        # Label and bin are combined into one index, so each chunk needs a single bincount
+        labels = labelArray.ravel()
+        values = valueArray.ravel()
+        numberOfLabels = len(layerSegmentIDs) + 1
+        layerCounts = np.zeros(numberOfLabels * numberOfBins, dtype=np.int64)
+        for start in range(0, values.size, STATISTICS_CHUNK_SIZE):
+            stop = start + STATISTICS_CHUNK_SIZE
+            indices = labels[start:stop].astype(np.intp) * numberOfBins
+            indices += _getBinIndices(values[start:stop], binWidth, numberOfBins)
+            layerCounts += np.bincount(indices, minlength=layerCounts.size)
+        segmentIDs.extend(layerSegmentIDs)
+        voxelCounts.extend(layerCounts.reshape(numberOfLabels, numberOfBins)[1:])
+    return DoseVolumeHistograms(segmentIDs, np.arange(numberOfBins + 1) * binWidth,
+                                np.reshape(voxelCounts, (len(segmentIDs), numberOfBins)))
+
+
+def updateDoseVolumeHistograms(histograms, valueArray, segmentMasks, segmentIDs):
+    """
+    Histograms with the rows of segmentIDs recomputed from their masks in a {segmentID: SegmentMask} dict,
+    on the bins of histograms. If an updated segment has values above the last bin, all rows are
+    recomputed from segmentMasks, which must then contain every segment of histograms.
+    """
+    updatedMasks = {segmentID: segmentMasks[segmentID] for segmentID in segmentIDs}
+    numberOfBins = histograms.binEdges.size - 1
+    maxValue = float(histograms.binEdges[-1])
+    for mask in updatedMasks.values():
+        if mask.voxelCount and mask.shape == valueArray.shape and np.max(valueArray[mask.slices][mask.croppedArray()]) > maxValue:
+            return computeDoseVolumeHistograms(valueArray, {segmentID: segmentMasks[segmentID] for segmentID in histograms.segmentIDs},
+                                               numberOfBins)
+    updated = computeDoseVolumeHistograms(valueArray, updatedMasks, numberOfBins, maxValue)
+    voxelCounts = histograms.voxelCounts.astype(np.result_type(histograms.voxelCounts, updated.voxelCounts))
+    voxelCounts[[histograms.segmentIDs.index(segmentID) for segmentID in updated.segmentIDs]] = updated.voxelCounts
+    return DoseVolumeHistograms(histograms.segmentIDs, histograms.binEdges, voxelCounts)
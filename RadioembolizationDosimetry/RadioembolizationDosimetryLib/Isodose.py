@@ -0,0 +1,128 @@
+import numpy as np
+
+from .SegmentStatistics import STATISTICS_CHUNK_SIZE
+
+
+# Isodose levels offered by default in the modules (Gy)
+DEFAULT_ISODOSE_LEVELS = (70.0, 120.0, 205.0)
+
+
+def parseIsodoseLevels(text):
+    """
+    Sorted unique isodose levels (Gy) from a comma or space separated text such as "70, 120, 205".
+    """
+    try:
+        levels = sorted({float(value) for value in text.replace(",", " ").split()})
+    except ValueError:
+        raise ValueError(f"Invalid isodose levels '{text}'. Enter doses in Gy separated by commas.")
+    if not levels or levels[0] <= 0:
+        raise ValueError("Enter at least one positive isodose level.")
+    if len(levels) > 255:
+        raise ValueError("At most 255 isodose levels are supported.")
+    return levels
+
+
+class IsodoseRegions:
+    """
+    Isodose regions of a dose map. levelIndices holds for every voxel the number of levels its dose reaches,
+    so the region of levelsGy[k] is levelIndices > k. voxelCounts[k] is the size of that region and
+    segmentVoxelCounts[s, k] its overlap with segment s of segmentIDs, which has segmentTotals[s] voxels.
+    Segment counts are fractional (float64) for partial-volume masks.
+    """
+
+    def __init__(self, levelsGy, levelIndices, voxelCounts, segmentIDs, segmentVoxelCounts, segmentTotals, voxelVolumeML):
+        self.levelsGy = list(levelsGy)
+        self.levelIndices = levelIndices
+        self.voxelCounts = np.asarray(voxelCounts, dtype=np.int64)
+        self.segmentIDs = list(segmentIDs)
+        segmentVoxelCounts = np.asarray(segmentVoxelCounts)
+        countType = np.float64 if segmentVoxelCounts.dtype.kind == "f" else np.int64
+        self.segmentVoxelCounts = segmentVoxelCounts.astype(countType).reshape(len(self.segmentIDs), len(self.levelsGy))
+        self.segmentTotals = np.asarray(segmentTotals).astype(countType)
+        self.voxelVolumeML = voxelVolumeML
+
+    @property
+    def volumesML(self):
+        return self.voxelCounts * self.voxelVolumeML
+
+    @property
+    def segmentOverlapPercent(self):
+        """
+        Percentage of each segment's volume inside each isodose region, shape (segments, levels).
+        Empty segments get NaN.
+        """
+        percent = np.full(self.segmentVoxelCounts.shape, np.nan)
+        np.divide(self.segmentVoxelCounts * 100.0, self.segmentTotals[:, np.newaxis], out=percent,
+                  where=self.segmentTotals[:, np.newaxis] > 0)
+        return percent
+
+    def mask(self, levelIndex):
+        """
+        Boolean array of the voxels that receive at least levelsGy[levelIndex].
+        """
+        return self.levelIndices > levelIndex
+
+
+def _getCumulativeCounts(counts):
+    # counts[..., i] voxels reach exactly i levels; voxels reaching level k are those with i > k
+    return np.cumsum(counts[..., :0:-1], axis=-1)[..., ::-1]
+
+
+def computeIsodoseRegions(doseArray, levelsGy, voxelVolumeML, labelLayers=()):
+    """
+    Digitise the dose map against all isodose levels at once with one sorted search per voxel,
+    in a single chunked pass that also counts the voxels per level and, for a list of
+    (labelArray, segmentIDs) label layers, per segment and level. For a {segmentID: SegmentMask}
+    dict the overlaps are counted from the digitised levels inside each segment's bounding box,
+    weighted by the covered fraction for a FractionalSegmentMask.
+    """
+    levels = np.asarray(sorted(levelsGy), dtype=np.float64)
+    numberOfLevels = levels.size
+    levelIndices = np.empty(doseArray.shape, dtype=np.uint8)
+    flatDoses = doseArray.reshape(-1)
+    flatIndices = levelIndices.reshape(-1)
+    counts = np.zeros(numberOfLevels + 1, dtype=np.int64)
+
+    isMaskDict = isinstance(labelLayers, dict)
+    layers = [] if isMaskDict else list(labelLayers)
+    for labelArray, _ in layers:
+        if labelArray.shape != doseArray.shape:
+            raise ValueError("Label map geometry does not match the dose map.")
+    layerCounts = [np.zeros((len(layerSegmentIDs) + 1) * (numberOfLevels + 1), dtype=np.int64)
+                   for _, layerSegmentIDs in layers]
+
+    for start in range(0, flatDoses.size, STATISTICS_CHUNK_SIZE):
+        stop = start + STATISTICS_CHUNK_SIZE
+        chunkIndices = np.searchsorted(levels, flatDoses[start:stop], side="right")
+        flatIndices[start:stop] = chunkIndices
+        counts += np.bincount(chunkIndices, minlength=numberOfLevels + 1)
+        for (labelArray, _), layerCount in zip(layers, layerCounts):
+            # Label and level are combined into one index, so each layer needs a single bincount
+            combined = labelArray.reshape(-1)[start:stop].astype(np.intp) * (numberOfLevels + 1) + chunkIndices
+            layerCount += np.bincount(combined, minlength=layerCount.size)
+
+    segmentIDs = []
+    segmentCounts = []
+    if isMaskDict:
+        for segmentID, mask in labelLayers.items():
+            if mask.shape != doseArray.shape:
+                raise ValueError("Label map geometry does not match the dose map.")
+            region = levelIndices[mask.slices][mask.croppedArray()] if mask.voxelCount else np.empty(0, np.uint8)
+            segmentIDs.append(segmentID)
+            segmentCounts.append(np.bincount(region, weights=mask.weights if mask.voxelCount else None,
+                                             minlength=numberOfLevels + 1))
+    else:
+        for (_, layerSegmentIDs), layerCount in zip(layers, layerCounts):
+            segmentIDs.extend(layerSegmentIDs)
+            segmentCounts.extend(layerCount.reshape(len(layerSegmentIDs) + 1, numberOfLevels + 1)[1:])
+    segmentCounts = np.reshape(segmentCounts, (len(segmentIDs), numberOfLevels + 1))
+
+    return IsodoseRegions(
+        levelsGy=levels.tolist(),
+        levelIndices=levelIndices,
+        voxelCounts=_getCumulativeCounts(counts),
+        segmentIDs=segmentIDs,
+        segmentVoxelCounts=_getCumulativeCounts(segmentCounts),
+        segmentTotals=segmentCounts.sum(axis=1),
+        voxelVolumeML=voxelVolumeML,
+    )
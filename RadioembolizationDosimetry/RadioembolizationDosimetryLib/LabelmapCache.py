@@ -0,0 +1,228 @@
+import collections
+
+import numpy as np
+
+
+class SegmentMask:
+    """
+    Binary mask of one segment on a reference grid, stored compactly as the
+    bounding box of the segment and the bit-packed voxels inside it.
+    mask may also be a block of the grid: offset is then the index of its first voxel
+    and shape that of the grid, so the full grid is never allocated.
+    """
+
+    def __init__(self, mask, offset=None, shape=None):
+        mask = np.asarray(mask, dtype=bool)
+        if offset is None:
+            offset = (0,) * mask.ndim
+        self.shape = mask.shape if shape is None else tuple(shape)
+        blockBounds = self._findBounds(mask)
+        self.bounds = blockBounds
+        if any(stop > start for start, stop in blockBounds):
+            self.bounds = tuple((start + origin, stop + origin) for (start, stop), origin in zip(blockBounds, offset))
+        cropped = mask[tuple(slice(start, stop) for start, stop in blockBounds)]
+        self.croppedShape = cropped.shape
+        self.voxelCount = int(np.count_nonzero(cropped))
+        self.packedMask = np.packbits(cropped, axis=None)
+
+    @staticmethod
+    def _findBounds(mask):
+        bounds = []
+        for axis in range(mask.ndim):
+            otherAxes = tuple(a for a in range(mask.ndim) if a != axis)
+            indices = np.flatnonzero(np.any(mask, axis=otherAxes))
+            if indices.size == 0:
+                return tuple((0, 0) for _ in range(mask.ndim))
+            bounds.append((int(indices[0]), int(indices[-1]) + 1))
+        return tuple(bounds)
+
+    @property
+    def slices(self):
+        return tuple(slice(start, stop) for start, stop in self.bounds)
+
+    @property
+    def nbytes(self):
+        return self.packedMask.nbytes
+
+    @property
+    def weights(self):
+        """
+        Weight of each voxel of croppedArray(), in C order, or None if every voxel counts fully.
+        """
+        return None
+
+    @property
+    def volumeVoxels(self):
+        """
+        Volume of the segment in voxels.
+        """
+        return self.voxelCount
+
+    def croppedArray(self):
+        """
+        Boolean mask of the bounding box region.
+        """
+        count = int(np.prod(self.croppedShape))
+        return np.unpackbits(self.packedMask, count=count).view(bool).reshape(self.croppedShape)
+
+    def toArray(self):
+        """
+        Boolean mask of the full reference grid.
+        """
+        mask = np.zeros(self.shape, dtype=bool)
+        mask[self.slices] = self.croppedArray()
+        return mask
+
+    def regionArray(self, bounds):
+        """
+        Boolean mask of the region given by bounds, a (start, stop) pair per axis that contains the bounding box.
+        """
+        mask = np.zeros(tuple(stop - start for start, stop in bounds), dtype=bool)
+        if self.voxelCount:
+            offset = tuple(slice(own[0] - region[0], own[1] - region[0]) for own, region in zip(self.bounds, bounds))
+            mask[offset] = self.croppedArray()
+        return mask
+
+    def regionWeights(self, bounds):
+        """
+        Weight of each voxel of the region given by bounds, a (start, stop) pair per axis that may cut the
+        bounding box: 1 or the covered fraction inside the segment and 0 outside it.
+        """
+        weights = np.zeros(tuple(stop - start for start, stop in bounds), dtype=np.float32)
+        overlap = [(max(own[0], region[0]), min(own[1], region[1])) for own, region in zip(self.bounds, bounds)]
+        if self.voxelCount == 0 or any(start >= stop for start, stop in overlap):
+            return weights
+        cropped = np.zeros(self.croppedShape, dtype=np.float32)
+        cropped[self.croppedArray()] = 1.0 if self.weights is None else self.weights
+        weights[tuple(slice(start - region[0], stop - region[0]) for (start, stop), region in zip(overlap, bounds))] = \
+            cropped[tuple(slice(start - own[0], stop - own[0]) for (start, stop), own in zip(overlap, self.bounds))]
+        return weights
+
+    def sumValues(self, valueArray):
+        """
+        Sum of valueArray over the segment. Only the bounding box region of valueArray is read.
+        """
+        if valueArray.shape != self.shape:
+            raise ValueError("Label map geometry does not match the input volume.")
+        if self.voxelCount == 0:
+            return 0.0
+        return float(np.sum(valueArray[self.slices], where=self.croppedArray(), dtype=np.float64))
+
+
+class FractionalSegmentMask(SegmentMask):
+    """
+    Partial-volume mask of one segment: the fraction of each voxel covered by the segment.
+    Stored sparsely as the bit-packed voxels with a non-zero fraction inside the bounding box
+    and the fractions of those voxels in C order. croppedArray() and the other boolean views
+    contain every voxel that the segment touches.
+    """
+
+    def __init__(self, fractions, offset=None, shape=None):
+        fractions = np.asarray(fractions, dtype=np.float32)
+        super().__init__(fractions > 0, offset, shape)
+        if self.voxelCount == 0:
+            self.fractions = np.zeros(0, dtype=np.float32)
+            return
+        if offset is None:
+            offset = (0,) * fractions.ndim
+        cropped = fractions[tuple(slice(start - origin, stop - origin) for (start, stop), origin in zip(self.bounds, offset))]
+        self.fractions = np.clip(cropped[cropped > 0], 0.0, 1.0)
+
+    @property
+    def nbytes(self):
+        return self.packedMask.nbytes + self.fractions.nbytes
+
+    @property
+    def weights(self):
+        return self.fractions
+
+    @property
+    def volumeVoxels(self):
+        return float(np.sum(self.fractions, dtype=np.float64))
+
+    def sumValues(self, valueArray):
+        """
+        Sum of valueArray over the segment, each voxel weighted by its fraction.
+        """
+        if valueArray.shape != self.shape:
+            raise ValueError("Label map geometry does not match the input volume.")
+        if self.voxelCount == 0:
+            return 0.0
+        return float(np.dot(valueArray[self.slices][self.croppedArray()].astype(np.float64), self.fractions))
+
+
+def getUnionBounds(masks):
+    """
+    Smallest bounds that contain the bounding boxes of all non-empty SegmentMasks.
+    """
+    bounds = [mask.bounds for mask in masks if mask.voxelCount]
+    if not bounds:
+        return tuple((0, 0) for _ in masks[0].shape)
+    return tuple((min(axis[0] for axis in axes), max(axis[1] for axis in axes)) for axes in zip(*bounds))
+
+
+def getUnionMask(masks):
+    """
+    Boolean array of the voxels that are in any of the SegmentMasks, on their common reference grid.
+    """
+    masks = list(masks)
+    union = np.zeros(masks[0].shape, dtype=bool)
+    for mask in masks:
+        if mask.voxelCount:
+            union[mask.slices] |= mask.croppedArray()
+    return union
+
+
+class LabelmapCache:
+    """
+    Least-recently-used cache of segment masks with a memory budget in bytes.
+    """
+
+    def __init__(self, memoryBudgetBytes=512 * 1024 * 1024):
+        self._entries = collections.OrderedDict()
+        self._memoryBudgetBytes = memoryBudgetBytes
+        self.memoryUsedBytes = 0
+
+    @property
+    def memoryBudgetBytes(self):
+        return self._memoryBudgetBytes
+
+    @memoryBudgetBytes.setter
+    def memoryBudgetBytes(self, value):
+        self._memoryBudgetBytes = value
+        self._evict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        mask = self._entries.get(key)
+        if mask is not None:
+            self._entries.move_to_end(key)
+        return mask
+
+    def put(self, key, mask):
+        if key in self._entries:
+            self.memoryUsedBytes -= self._entries.pop(key).nbytes
+        if mask.nbytes > self._memoryBudgetBytes:
+            # Would evict everything else and still not fit
+            return
+        self._entries[key] = mask
+        self.memoryUsedBytes += mask.nbytes
+        self._evict()
+
+    def clear(self):
+        self._entries.clear()
+        self.memoryUsedBytes = 0
+
+    def _evict(self):
+        while self._entries and self.memoryUsedBytes > self._memoryBudgetBytes:
+            _, mask = self._entries.popitem(last=False)
+            self.memoryUsedBytes -= mask.nbytes
+
+
+# Shared by all Taranis modules, so a segment exported by one module is reused by the others
+labelmapCache = LabelmapCache()
@@ -0,0 +1,37 @@
+import numpy as np
+
+from .LabelmapCache import SegmentMask, getUnionBounds
+
+
+def calculateLungShuntFraction(spectArray, liverMask, lungMask):
+    """
+    Lung and liver counts and the lung shunt fraction (%) of a 99mTc-MAA SPECT.
+    The masks are boolean arrays or SegmentMask objects. Both sums come from one weighted bincount;
+    for SegmentMasks it only covers the union of the two bounding boxes. Partial-volume masks are summed
+    per segment with their voxel fractions as weights.
+    """
+    if isinstance(liverMask, SegmentMask) and isinstance(lungMask, SegmentMask) and (
+            liverMask.weights is not None or lungMask.weights is not None):
+        lungcounts = lungMask.sumValues(spectArray)
+        livercounts = liverMask.sumValues(spectArray)
+        return lungcounts, livercounts, (lungcounts / (lungcounts + livercounts)) * 100
+    if isinstance(liverMask, SegmentMask) and isinstance(lungMask, SegmentMask):
+        if liverMask.shape != spectArray.shape or lungMask.shape != spectArray.shape:
+            raise ValueError("Label map geometry does not match the input volume.")
+        bounds = getUnionBounds([liverMask, lungMask])
+        values = spectArray[tuple(slice(start, stop) for start, stop in bounds)]
+        liverMask = liverMask.regionArray(bounds)
+        lungMask = lungMask.regionArray(bounds)
+    else:
+        values = spectArray
+        liverMask = liverMask.toArray() if isinstance(liverMask, SegmentMask) else np.asarray(liverMask, dtype=bool)
+        lungMask = lungMask.toArray() if isinstance(lungMask, SegmentMask) else np.asarray(lungMask, dtype=bool)
+
+    # Label 1 is liver only, 2 lung only and 3 both, so overlapping voxels count for both organs
+    labels = liverMask.astype(np.uint8)
+    labels[lungMask] += 2
+    sums = np.bincount(labels.ravel(), weights=values.ravel(), minlength=4)
+    livercounts = sums[1] + sums[3]
+    lungcounts = sums[2] + sums[3]
+    lsf = (lungcounts / (lungcounts + livercounts)) * 100
+    return lungcounts, livercounts, lsf
@@ -0,0 +1,46 @@
+import logging
+
+import numpy as np
+
+
+def maskArray(inputArray, labelArray, label=1, replace=0):
+    """
+    Keep voxels where labelArray equals label and set all others to replace,
+    the same operation as the MaskScalarVolume CLI but without leaving the process.
+    """
+    if labelArray.shape != inputArray.shape:
+        raise ValueError("Label map geometry does not match the input volume.")
+    return np.where(labelArray == label, inputArray, np.asarray(replace, dtype=inputArray.dtype))
+
+
+
+def maskVolumeWithLabelmap(inputVolumeNode, labelMapVolumeNode, label=1, replace=0):
+    """
+    Return the masked voxel array of inputVolumeNode. The arrays are masked in memory;
+    the MaskScalarVolume CLI is only used if the label map is not on the grid of the input volume,
+    e.g. a label map that was not exported through the labelmap cache.
+    """
+    import slicer
+
+    inputArray = slicer.util.arrayFromVolume(inputVolumeNode)
+    labelArray = slicer.util.arrayFromVolume(labelMapVolumeNode)
+    if inputArray is not None and labelArray is not None and inputArray.shape == labelArray.shape:
+        return maskArray(inputArray, labelArray, label, replace)
+
+    logging.warning("Label map does not match the input volume grid, falling back to the MaskScalarVolume CLI.")
+    maskedVolumeNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode", "MaskedVolume")
+    try:
+        parameters = {
+            "InputVolume": inputVolumeNode.GetID(),
+            "MaskVolume": labelMapVolumeNode.GetID(),
+            "OutputVolume": maskedVolumeNode.GetID(),
+            "Label": label,
+            "Replace": replace
+        }
+        slicer.cli.runSync(slicer.modules.maskscalarvolume, None, parameters)
+        maskedArray = slicer.util.arrayFromVolume(maskedVolumeNode)
+        if maskedArray is None:
+            raise ValueError("Unable to access data from the masked volume.")
+        return maskedArray.copy()
+    finally:
+        slicer.mrmlScene.RemoveNode(maskedVolumeNode)
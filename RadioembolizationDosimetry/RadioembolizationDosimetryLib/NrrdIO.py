@@ -0,0 +1,149 @@
+import numpy as np
+
+
+def _importNrrd():
+    try:
+        import nrrd
+    except ImportError as e:
+        raise ImportError(
+            "Reading and writing NRRD files outside the Slicer scene requires the pynrrd package "
+            "(pip install pynrrd, or slicer.util.pip_install('pynrrd') in Slicer)."
+        ) from e
+    return nrrd
+
+
+class ImageVolume:
+    """
+    Voxel array in KJI order (like slicer.util.arrayFromVolume) with its IJK to LPS matrix.
+    Label volumes read from a segmentation have an extra leading layer axis.
+    """
+
+    def __init__(self, array, ijkToLps):
+        self.array = array
+        self.ijkToLps = ijkToLps
+
+    @property
+    def spacing(self):
+        return tuple(float(s) for s in np.linalg.norm(self.ijkToLps[:3, :3], axis=0))
+
+    @property
+    def shape(self):
+        return self.array.shape[-3:]
+
+
+class SegmentInfo:
+    """
+    Name, ID, layer and label value of one segment stored in a .seg.nrrd file.
+    """
+
+    def __init__(self, segmentID, name, layer, labelValue):
+        self.segmentID = segmentID
+        self.name = name
+        self.layer = layer
+        self.labelValue = labelValue
+
+
+def _getIjkToLps(header):
+    kinds = header.get("kinds", ["domain"] * header["dimension"])
+    spatialAxes = [axis for axis, kind in enumerate(kinds) if kind in ("domain", "space")]
+    directions = np.asarray(header["space directions"], dtype=float)[spatialAxes]
+    ijkToLps = np.eye(4)
+    ijkToLps[:3, :3] = directions.T
+    ijkToLps[:3, 3] = np.asarray(header.get("space origin", np.zeros(3)), dtype=float)
+    if header.get("space", "left-posterior-superior") in ("right-anterior-superior", "RAS"):
+        ijkToLps[:2, :] *= -1
+    return ijkToLps
+
+
+def readVolume(path):
+    """
+    Read a scalar NRRD volume.
+    """
+    nrrd = _importNrrd()
+    data, header = nrrd.read(path)
+    return ImageVolume(np.ascontiguousarray(data.transpose(2, 1, 0)), _getIjkToLps(header))
+
+
+def readSegmentation(path):
+    """
+    Read a .seg.nrrd file. Returns the label layers as an ImageVolume with array shape
+    (layers, K, J, I) and the list of SegmentInfo.
+    """
+    nrrd = _importNrrd()
+    data, header = nrrd.read(path)
+    if data.ndim == 3:
+        layers = data.transpose(2, 1, 0)[np.newaxis]
+    else:
+        # Slicer writes the layer axis first ("list domain domain domain")
+        layers = data.transpose(0, 3, 2, 1)
+
+    segments = []
+    index = 0
+    while f"Segment{index}_ID" in header:
+        prefix = f"Segment{index}_"
+        segments.append(SegmentInfo(
+            header[prefix + "ID"],
+            header.get(prefix + "Name", header[prefix + "ID"]),
+            # Files written before shared layers have one layer per segment with label value 1
+            int(header.get(prefix + "Layer", index if layers.shape[0] > 1 else 0)),
+            int(header.get(prefix + "LabelValue", 1)),
+        ))
+        index += 1
+    return ImageVolume(np.ascontiguousarray(layers), _getIjkToLps(header)), segments
+
+
+def resampleLabelsToReference(labelVolume, referenceVolume):
+    """
+    Nearest-neighbour resampling of label layers onto the reference volume grid, slice by slice.
+    Voxels that fall outside the label volume are set to 0.
+    """
+    referenceToLabel = np.linalg.inv(labelVolume.ijkToLps) @ referenceVolume.ijkToLps
+    if np.allclose(referenceToLabel, np.eye(4)) and labelVolume.shape == referenceVolume.shape:
+        return labelVolume.array
+
+    layers = labelVolume.array
+    labelShape = np.asarray(labelVolume.shape)  # K, J, I
+    kSize, jSize, iSize = referenceVolume.shape
+    resampled = np.zeros((layers.shape[0],) + tuple(referenceVolume.shape), dtype=layers.dtype)
+    jj, ii = np.meshgrid(np.arange(jSize), np.arange(iSize), indexing="ij")
+    for k in range(kSize):
+        points = np.stack([ii.ravel(), jj.ravel(), np.full(ii.size, k), np.ones(ii.size)])
+        ijk = np.rint(referenceToLabel[:3] @ points).astype(np.int64)
+        kji = ijk[::-1]
+        inside = np.all((kji >= 0) & (kji < labelShape[:, np.newaxis]), axis=0)
+        sliceValues = np.zeros((layers.shape[0], ii.size), dtype=layers.dtype)
+        sliceValues[:, inside] = layers[:, kji[0, inside], kji[1, inside], kji[2, inside]]
+        resampled[:, k] = sliceValues.reshape(layers.shape[0], jSize, iSize)
+    return resampled
+
+
+def getLabelLayers(layerArrays, segments):
+    """
+    Convert .seg.nrrd label layers to the (labelArray, segmentIDs) pairs used by
+    computeSegmentStatistics, where segmentIDs[i] has label value i+1.
+    """
+    labelLayers = []
+    for layer in range(layerArrays.shape[0]):
+        layerSegments = [segment for segment in segments if segment.layer == layer]
+        if not layerSegments:
+            continue
+        lookup = np.zeros(max(int(layerArrays[layer].max()), max(s.labelValue for s in layerSegments)) + 1, dtype=np.uint16)
+        for index, segment in enumerate(layerSegments):
+            lookup[segment.labelValue] = index + 1
+        labelLayers.append((lookup[layerArrays[layer]], [segment.segmentID for segment in layerSegments]))
+    return labelLayers
+
+
+def writeVolume(path, array, referenceVolume):
+    """
+    Write a KJI array as a NRRD volume with the geometry of the reference volume.
+    """
+    nrrd = _importNrrd()
+    header = {
+        "space": "left-posterior-superior",
+        "space directions": referenceVolume.ijkToLps[:3, :3].T,
+        "space origin": referenceVolume.ijkToLps[:3, 3],
+        "kinds": ["domain", "domain", "domain"],
+        "encoding": "gzip",
+    }
+    nrrd.write(path, np.ascontiguousarray(array.transpose(2, 1, 0)), header)
@@ -0,0 +1,53 @@
+import numpy as np
+
+
+def prepareOutputVolume(referenceVolumeNode, outputVolumeNode, dtype=np.float32):
+    """
+    Give outputVolumeNode the geometry (IJK to RAS, spacing, origin and parent transform) of
+    referenceVolumeNode and return its voxel array, to be filled in place.
+    The existing image buffer is reused if its dimensions and scalar type already match,
+    otherwise one new buffer is allocated. No voxels are copied from the reference volume.
+    Call slicer.util.arrayFromVolumeModified(outputVolumeNode) after writing the voxels.
+    """
+    import slicer
+    import vtk
+    from vtk.util import numpy_support
+
+    referenceImageData = referenceVolumeNode.GetImageData()
+    if referenceImageData is None:
+        raise ValueError("The reference volume has no image data.")
+    dimensions = referenceImageData.GetDimensions()
+    scalarType = numpy_support.get_vtk_array_type(np.dtype(dtype))
+
+    ijkToRas = vtk.vtkMatrix4x4()
+    referenceVolumeNode.GetIJKToRASMatrix(ijkToRas)
+    outputVolumeNode.SetIJKToRASMatrix(ijkToRas)
+    outputVolumeNode.SetAndObserveTransformNodeID(referenceVolumeNode.GetTransformNodeID())
+
+    imageData = outputVolumeNode.GetImageData()
+    if (imageData is None or imageData.GetDimensions() != dimensions
+            or imageData.GetScalarType() != scalarType or imageData.GetNumberOfScalarComponents() != 1):
+        imageData = vtk.vtkImageData()
+        imageData.SetDimensions(dimensions)
+        imageData.AllocateScalars(scalarType, 1)
+        outputVolumeNode.SetAndObserveImageData(imageData)
+
+    if outputVolumeNode.GetDisplayNode() is None:
+        outputVolumeNode.CreateDefaultDisplayNodes()
+    return slicer.util.arrayFromVolume(outputVolumeNode)
+
+
+def finishOutputVolume(outputVolumeNode, array):
+    """
+    Make array the voxels of outputVolumeNode, which prepareOutputVolume has set up.
+    If array was computed into the voxel buffer of the volume it is not copied again.
+    """
+    import slicer
+
+    outputArray = slicer.util.arrayFromVolume(outputVolumeNode)
+    if outputArray is None or outputArray.shape != array.shape or outputArray.dtype != array.dtype:
+        slicer.util.updateVolumeFromArray(outputVolumeNode, array)
+        return
+    if not np.shares_memory(outputArray, array):
+        np.copyto(outputArray, array, casting="unsafe")
+    slicer.util.arrayFromVolumeModified(outputVolumeNode)
@@ -0,0 +1,62 @@
+from dataclasses import dataclass, field
+from typing import Optional
+
+import numpy as np
+
+
+@dataclass
+class DosimetryParameters:
+    """
+    Physical parameters of the dose models and the precision of the dose array. Defaults are for Y-90.
+    """
+    activityMBq: float = 0.0
+    lungShuntFraction: float = 0.0  # fraction, not percent
+    conversionFactor: float = 49.67  # Gy/MBq/g
+    densityGPerML: float = 1.05
+    lungMassG: float = 1000.0
+    hoursElapsed: float = 0.0
+    halfLifeHours: float = 64.2
+    doseDtype: str = "float32"  # float32 or float64
+    doseKernel: Optional[str] = None  # nuclide of the approximate dose kernel (Y-90, Ho-166), None for local deposition
+
+
+@dataclass
+class DosimetryResult:
+    """
+    Output of a dose calculation. Per-segment arrays are in the order of segmentIDs.
+    """
+    segmentIDs: list = field(default_factory=list)
+    segmentDoses: np.ndarray = None
+    segmentVolumes: np.ndarray = None
+    segmentActivities: np.ndarray = None
+    doseArray: Optional[np.ndarray] = None
+    lungDoseGy: Optional[float] = None
+    totalActivityMBq: Optional[float] = None
+    decayCorrectedActivityMBq: Optional[float] = None
+    doseVolumeHistograms: Optional[object] = None  # DoseVolumeHistograms in Gy
+    doseUncertainty: Optional[object] = None  # DoseUncertainty, if an uncertainty model was evaluated
+    segmentEffectiveHalfLivesHours: Optional[np.ndarray] = None  # fitted from several timepoints
+    segmentMeanSquareDoses: Optional[np.ndarray] = None  # mean of the squared voxel doses (Gy^2)
+    radiobiology: Optional[object] = None  # SegmentRadiobiology, if tissue parameters were given
+
+
+@dataclass
+class DoseSweep:
+    """
+    Segment mean doses and lung dose for a grid of scenarios. Parameter arrays have one value per
+    scenario; segmentDoses has shape (scenarios, segments) with segments in the order of segmentIDs.
+    """
+    activityMBq: np.ndarray
+    lungShuntFraction: np.ndarray
+    conversionFactor: np.ndarray
+    densityGPerML: np.ndarray
+    segmentIDs: list
+    segmentDoses: np.ndarray
+    lungDoseGy: np.ndarray
+
+
+def computeVoxelVolumeML(spacing):
+    """
+    Voxel volume in mL from the voxel spacing in mm.
+    """
+    return (spacing[0] * spacing[1] * spacing[2]) / 1000.0
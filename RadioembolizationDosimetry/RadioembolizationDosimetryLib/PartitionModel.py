@@ -0,0 +1,132 @@
+from dataclasses import dataclass, field
+
+import numpy as np
+
+from .LabelmapCache import getUnionBounds
+from .RelativeDosimetry import estimateLungDose
+
+
+@dataclass
+class PartitionConstraints:
+    """
+    Dose limits of the partition model in Gy. A limit of None is not applied.
+    """
+    maxLungDoseGy: float = 30.0
+    maxNormalLiverDoseGy: float = 70.0
+    minTumourDoseGy: float = 120.0
+
+
+@dataclass
+class PartitionPlan:
+    """
+    Allowed activity range of the partition model and the compartment doses per MBq.
+    Tumour arrays are in the order of tumourSegmentIDs. activityLimits maps every constraint to the
+    activity at which it is reached, e.g. "lung" or a tumour segment ID, in MBq.
+    """
+    tumourSegmentIDs: list
+    tumourToNormalRatios: np.ndarray
+    tumourDosesPerMBq: np.ndarray
+    normalLiverDosePerMBq: float
+    lungDosePerMBq: float
+    minimumActivityMBq: float
+    maximumActivityMBq: float
+    activityLimits: dict = field(default_factory=dict)
+
+    @property
+    def feasible(self):
+        return self.minimumActivityMBq <= self.maximumActivityMBq
+
+    def doses(self, activityMBq):
+        """
+        (tumour doses, normal liver dose, lung dose) in Gy for an activity.
+        """
+        return (self.tumourDosesPerMBq * activityMBq, self.normalLiverDosePerMBq * activityMBq,
+                self.lungDosePerMBq * activityMBq)
+
+
+def computeTumourLiverOverlap(valueArray, liverMask, tumourMasks):
+    """
+    Sum of valueArray and volume in voxels of the part of the liver that any of the tumour SegmentMasks covers.
+    Overlapping tumours count once and tumour voxels outside the liver not at all; a partial-volume voxel
+    counts with the smaller of its liver fraction and its largest tumour fraction. Only the bounding box of
+    the tumours inside the liver is read.
+    """
+    if any(mask.shape != valueArray.shape for mask in [liverMask, *tumourMasks]):
+        raise ValueError("Label map geometry does not match the input volume.")
+    bounds = tuple((max(tumour[0], liver[0]), min(tumour[1], liver[1]))
+                   for tumour, liver in zip(getUnionBounds(tumourMasks), liverMask.bounds))
+    if liverMask.voxelCount == 0 or any(start >= stop for start, stop in bounds):
+        return 0.0, 0.0
+    weights = np.zeros(tuple(stop - start for start, stop in bounds), dtype=np.float32)
+    for mask in tumourMasks:
+        np.maximum(weights, mask.regionWeights(bounds), out=weights)
+    np.minimum(weights, liverMask.regionWeights(bounds), out=weights)
+    values = valueArray[tuple(slice(start, stop) for start, stop in bounds)]
+    return (float(np.dot(values.ravel().astype(np.float64), weights.ravel())),
+            float(np.sum(weights, dtype=np.float64)))
+
+
+def planPartitionActivity(doseState, liverSegmentID, parameters, constraints, tumourSegmentIDs, segmentMasks):
+    """
+    Partition model over the given tumour segments and the normal liver, i.e. the liver without the tumours.
+    segmentMasks is the {segmentID: SegmentMask} dict of the dose state; only the tumours inside the liver are
+    read from it, the tumour doses use the cached per-segment count sums and voxel counts of the RelativeDoseState.
+    Tumours may overlap each other and extend beyond the liver. parameters.activityMBq is not used.
+    Returns a PartitionPlan with the activity range that satisfies all constraints.
+    """
+    if not tumourSegmentIDs:
+        raise ValueError("Select the tumour segments.")
+    if liverSegmentID in tumourSegmentIDs:
+        raise ValueError("The liver segment cannot be a tumour segment.")
+    statistics = doseState.segmentStatistics
+    indices = [statistics.segmentIDs.index(segmentID) for segmentID in tumourSegmentIDs]
+    liverIndex = statistics.segmentIDs.index(liverSegmentID)
+
+    # Normal liver is the liver without the union of the tumours
+    tumourSums = statistics.sums[indices]
+    tumourCounts = statistics.counts[indices]
+    overlapSum, overlapCount = computeTumourLiverOverlap(
+        doseState.maskedArray, segmentMasks[liverSegmentID], [segmentMasks[segmentID] for segmentID in tumourSegmentIDs])
+    normalSum = statistics.sums[liverIndex] - overlapSum
+    normalCount = statistics.counts[liverIndex] - overlapCount
+    if normalCount <= 0:
+        raise ValueError("The tumour segments cover the whole liver; no normal liver remains.")
+    normalMean = normalSum / normalCount
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        tumourMeans = np.where(tumourCounts > 0, tumourSums / tumourCounts, np.nan)
+        tumourToNormalRatios = tumourMeans / normalMean
+
+    # All compartment doses are linear in the activity
+    rescaleFactor = doseState.rescaleFactor(1.0, parameters.lungShuntFraction, parameters.conversionFactor,
+                                            parameters.densityGPerML)
+    tumourDosesPerMBq = tumourMeans * rescaleFactor
+    normalLiverDosePerMBq = normalMean * rescaleFactor
+    lungDosePerMBq = estimateLungDose(1.0, parameters.lungShuntFraction, parameters.conversionFactor, parameters.lungMassG)
+
+    activityLimits = {}
+    maximumActivityMBq = np.inf
+    if constraints.maxLungDoseGy is not None and lungDosePerMBq > 0:
+        activityLimits["lung"] = float(constraints.maxLungDoseGy / lungDosePerMBq)
+        maximumActivityMBq = min(maximumActivityMBq, activityLimits["lung"])
+    if constraints.maxNormalLiverDoseGy is not None and normalLiverDosePerMBq > 0:
+        activityLimits["normalLiver"] = float(constraints.maxNormalLiverDoseGy / normalLiverDosePerMBq)
+        maximumActivityMBq = min(maximumActivityMBq, activityLimits["normalLiver"])
+
+    minimumActivityMBq = 0.0
+    if constraints.minTumourDoseGy is not None:
+        with np.errstate(divide="ignore"):
+            tumourActivities = np.where(tumourDosesPerMBq > 0, constraints.minTumourDoseGy / tumourDosesPerMBq, np.inf)
+        activityLimits.update(zip(tumourSegmentIDs, tumourActivities.tolist()))
+        minimumActivityMBq = float(np.max(tumourActivities))
+
+    return PartitionPlan(
+        tumourSegmentIDs=list(tumourSegmentIDs),
+        tumourToNormalRatios=tumourToNormalRatios,
+        tumourDosesPerMBq=tumourDosesPerMBq,
+        normalLiverDosePerMBq=float(normalLiverDosePerMBq),
+        lungDosePerMBq=float(lungDosePerMBq),
+        minimumActivityMBq=minimumActivityMBq,
+        maximumActivityMBq=float(maximumActivityMBq),
+        activityLimits=activityLimits,
+    )
@@ -0,0 +1,125 @@
+import contextlib
+import datetime
+import json
+import logging
+import os
+import time
+import tracemalloc
+
+
+# Folder for the JSON traces of every run; traces are only written if this is set
+TRACE_DIRECTORY_ENVIRONMENT_VARIABLE = "TARANIS_TRACE_DIR"
+
+
+class StageTimer:
+    """
+    Wall time and peak allocated memory of the stages of one calculation.
+    Memory is measured with tracemalloc, which sees NumPy arrays but not VTK or ITK buffers.
+    tracemalloc slows down every allocation, so memory is only traced if traceMemory is True or,
+    by default, if a trace directory is set.
+
+        with StageTimer("LSFcalc") as timer:
+            with timer.stage("labelmapExport"):
+                ...
+
+    On exit a summary is logged and, if a trace directory is set (argument or the
+    TARANIS_TRACE_DIR environment variable), a JSON trace of the run is written there.
+    """
+
+    def __init__(self, name, traceDirectory=None, traceMemory=None):
+        self.name = name
+        self.traceDirectory = traceDirectory or os.environ.get(TRACE_DIRECTORY_ENVIRONMENT_VARIABLE)
+        self.traceMemory = bool(self.traceDirectory) if traceMemory is None else traceMemory
+        self.stages = []
+        self.info = {}
+        self.startTime = None
+        self.startedAt = None
+        self.totalSeconds = None
+        self.error = None
+        self._startedTracemalloc = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        if excValue is not None:
+            self.error = f"{excType.__name__}: {excValue}"
+        self.finish()
+        return False
+
+    def start(self):
+        self.startTime = time.perf_counter()
+        self.startedAt = datetime.datetime.now().isoformat(timespec="seconds")
+        if self.traceMemory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._startedTracemalloc = True
+
+    @contextlib.contextmanager
+    def stage(self, stageName):
+        """
+        Time the enclosed block as one stage. Stages may be entered repeatedly but not nested.
+        """
+        if self.traceMemory and tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+            startMemory = tracemalloc.get_traced_memory()[0]
+        startTime = time.perf_counter()
+        try:
+            yield
+        finally:
+            record = {"stage": stageName, "seconds": time.perf_counter() - startTime}
+            if self.traceMemory and tracemalloc.is_tracing():
+                currentMemory, peakMemory = tracemalloc.get_traced_memory()
+                record["peakAllocatedMB"] = max(peakMemory - startMemory, 0) / 1024 ** 2
+                record["retainedMB"] = (currentMemory - startMemory) / 1024 ** 2
+            self.stages.append(record)
+
+    def summary(self):
+        lines = [f"{self.name}: {self.totalSeconds:.2f} s" + (f" (failed: {self.error})" if self.error else "")]
+        for record in self.stages:
+            line = f"  {record['stage']:<24}{record['seconds']:8.3f} s"
+            if "peakAllocatedMB" in record:
+                line += f"{record['peakAllocatedMB']:10.1f} MB peak"
+            lines.append(line)
+        return "\n".join(lines)
+
+    def toDict(self):
+        return {
+            "name": self.name,
+            "startedAt": self.startedAt,
+            "totalSeconds": self.totalSeconds,
+            "error": self.error,
+            "info": self.info,
+            "stages": self.stages,
+        }
+
+    def finish(self):
+        """
+        Stop timing, log the summary and write the JSON trace.
+        """
+        self.totalSeconds = time.perf_counter() - self.startTime
+        if self._startedTracemalloc:
+            tracemalloc.stop()
+            self._startedTracemalloc = False
+        logging.info(self.summary())
+        if self.traceDirectory:
+            self.writeTrace(self.traceDirectory)
+
+    def writeTrace(self, traceDirectory):
+        timestamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+        tracePath = os.path.join(traceDirectory, f"{self.name}_{timestamp}.json")
+        try:
+            os.makedirs(traceDirectory, exist_ok=True)
+            with open(tracePath, "w") as file:
+                json.dump(self.toDict(), file, indent=2)
+        except OSError as e:
+            logging.warning(f"Could not write trace {tracePath}: {e}")
+            return None
+        return tracePath
+
+
+def timedStage(timer, stageName):
+    """
+    timer.stage(stageName), or a no-op if timer is None.
+    """
+    return timer.stage(stageName) if timer is not None else contextlib.nullcontext()
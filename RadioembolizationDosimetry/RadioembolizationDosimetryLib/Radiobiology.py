@@ -0,0 +1,129 @@
+from dataclasses import dataclass
+
+import numpy as np
+
+from .SegmentStatistics import STATISTICS_CHUNK_SIZE
+
+
+@dataclass
+class TissueParameters:
+    """
+    Linear-quadratic parameters of a tissue: alpha/beta (Gy), repair half-time (h) and the
+    radiosensitivity alpha (1/Gy) used for the equivalent uniform dose. Defaults are for normal liver.
+    """
+    alphaBetaGy: float = 2.5
+    repairHalfTimeHours: float = 2.5
+    alphaPerGy: float = 0.01
+
+
+# Values commonly used for radioembolization; edit them in the modules for other tissues
+NORMAL_LIVER_TISSUE = TissueParameters(alphaBetaGy=2.5, repairHalfTimeHours=2.5, alphaPerGy=0.01)
+TUMOUR_TISSUE = TissueParameters(alphaBetaGy=10.0, repairHalfTimeHours=1.5, alphaPerGy=0.005)
+
+# Maps that BiologicalDoseMaps can materialise
+BIOLOGICAL_DOSE_KINDS = ("BED", "EQD2")
+
+
+def getBedQuadraticFactor(tissue, halfLifeHours):
+    """
+    Factor k of BED = D + k * D^2 for a permanent implant that decays with halfLifeHours (Dale 1985).
+    """
+    decayConstant = np.log(2.0) / halfLifeHours
+    repairConstant = np.log(2.0) / tissue.repairHalfTimeHours
+    return decayConstant / ((repairConstant + decayConstant) * tissue.alphaBetaGy)
+
+
+def getEqd2Factor(tissue):
+    """
+    EQD2 = BED * factor, the dose in 2 Gy fractions with the same BED.
+    """
+    return 1.0 / (1.0 + 2.0 / tissue.alphaBetaGy)
+
+
+@dataclass
+class SegmentRadiobiology:
+    """
+    Per-segment mean BED, mean EQD2 and BED-based equivalent uniform dose (Gy), in the order of segmentIDs.
+    """
+    segmentIDs: list
+    meanBed: np.ndarray
+    meanEqd2: np.ndarray
+    eud: np.ndarray
+
+
+def computeSegmentRadiobiology(result, segmentTissues, halfLifeHours, defaultTissue=NORMAL_LIVER_TISSUE):
+    """
+    Mean BED, mean EQD2 and EUD of every segment of a DosimetryResult. segmentTissues maps segment IDs to
+    TissueParameters; other segments use defaultTissue. The mean BED follows exactly from the segment mean
+    and mean squared dose of the dose statistics; the EUD, -ln(mean(exp(-alpha * BED))) / alpha, is
+    evaluated on the dose-volume histogram bins, so no voxel is read again.
+    """
+    tissues = [segmentTissues.get(segmentID, defaultTissue) for segmentID in result.segmentIDs]
+    quadraticFactors = np.array([getBedQuadraticFactor(tissue, halfLifeHours) for tissue in tissues])
+    eqd2Factors = np.array([getEqd2Factor(tissue) for tissue in tissues])
+    alphas = np.array([tissue.alphaPerGy for tissue in tissues])
+
+    meanBed = result.segmentDoses + quadraticFactors * result.segmentMeanSquareDoses
+    eud = np.full(len(tissues), np.nan)
+    histograms = result.doseVolumeHistograms
+    if histograms is not None:
+        # Histogram rows follow the same segment order as the statistics
+        centers = (histograms.binEdges[:-1] + histograms.binEdges[1:]) / 2.0
+        binBed = centers[np.newaxis, :] + quadraticFactors[:, np.newaxis] * centers[np.newaxis, :] ** 2
+        totals = histograms.voxelCounts.sum(axis=1)
+        survival = np.sum(histograms.voxelCounts * np.exp(-alphas[:, np.newaxis] * binBed), axis=1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            eud = np.where(totals > 0, -np.log(survival / totals) / alphas, np.nan)
+    return SegmentRadiobiology(
+        segmentIDs=list(result.segmentIDs),
+        meanBed=meanBed,
+        meanEqd2=meanBed * eqd2Factors,
+        eud=eud,
+    )
+
+
+class BiologicalDoseMaps:
+    """
+    BED and EQD2 maps derived from a dose array. Nothing is computed until a map is materialised,
+    e.g. when it is shown or exported, and then only chunk by chunk into the given output buffer.
+    tumourMask marks the voxels of tumourTissue (None for none); all other voxels use normalTissue.
+    """
+
+    def __init__(self, doseArray, halfLifeHours, tumourMask=None, tumourTissue=TUMOUR_TISSUE,
+                 normalTissue=NORMAL_LIVER_TISSUE):
+        if tumourMask is not None and tumourMask.shape != doseArray.shape:
+            raise ValueError("Tumour mask geometry does not match the dose map.")
+        self.doseArray = doseArray
+        self.halfLifeHours = halfLifeHours
+        self.tumourMask = tumourMask
+        self.tumourTissue = tumourTissue
+        self.normalTissue = normalTissue
+
+    def _getFactors(self, kind, tissue):
+        quadraticFactor = getBedQuadraticFactor(tissue, self.halfLifeHours)
+        scale = getEqd2Factor(tissue) if kind == "EQD2" else 1.0
+        return quadraticFactor, scale
+
+    def materialize(self, kind, out=None, dtype=np.float32, chunkSize=STATISTICS_CHUNK_SIZE):
+        """
+        Compute the BED or EQD2 map (Gy) into out, or into a new array of the given dtype.
+        """
+        if kind not in BIOLOGICAL_DOSE_KINDS:
+            raise ValueError(f"Unknown map '{kind}'. Use {' or '.join(BIOLOGICAL_DOSE_KINDS)}.")
+        if out is None:
+            out = np.empty(self.doseArray.shape, dtype=dtype)
+        normalFactors = self._getFactors(kind, self.normalTissue)
+        tumourFactors = self._getFactors(kind, self.tumourTissue)
+        doses = self.doseArray.reshape(-1)
+        tumour = self.tumourMask.reshape(-1) if self.tumourMask is not None else None
+        flatOut = out.reshape(-1)
+        for start in range(0, doses.size, chunkSize):
+            stop = start + chunkSize
+            dose = doses[start:stop].astype(np.float64)
+            if tumour is None:
+                quadraticFactor, scale = normalFactors
+            else:
+                quadraticFactor = np.where(tumour[start:stop], tumourFactors[0], normalFactors[0])
+                scale = np.where(tumour[start:stop], tumourFactors[1], normalFactors[1])
+            flatOut[start:stop] = (dose + quadraticFactor * dose * dose) * scale
+        return out
@@ -0,0 +1,183 @@
+import numpy as np
+
+from .DoseVolumeHistograms import computeDoseVolumeHistograms, updateDoseVolumeHistograms
+from .LabelmapCache import SegmentMask
+from .Masking import maskArray
+from .Parameters import DoseSweep, DosimetryResult, computeVoxelVolumeML
+from .SegmentStatistics import computeSegmentStatistics
+from .VoxelSValues import convolveWithDoseKernel
+
+
+def relativeDoseRescaleFactor(activityMBq, lungShuntFraction, liverCountSum, voxelVolumeML, conversionFactor, densityGPerML):
+    """
+    Dose (Gy) per count in the patient-relative model. The activity that is not shunted to
+    the lungs is distributed over the liver in proportion to the counts inside the liver mask.
+    """
+    if liverCountSum <= 0:
+        raise ValueError("No counts inside the liver segment. Ensure the liver segment is correctly defined.")
+    return (activityMBq * (1 - lungShuntFraction) * conversionFactor) / (densityGPerML * voxelVolumeML * liverCountSum)
+
+
+def solveActivityForTargetDose(targetDoseGy, targetMeanCounts, liverCountSum, lungShuntFraction, voxelVolumeML, conversionFactor, densityGPerML):
+    """
+    Activity (MBq) that gives targetDoseGy as mean dose in the target segment.
+    Dose is linear in activity, so this is the target dose divided by the target dose per MBq.
+    targetMeanCounts is the mean liver-masked count of the target segment.
+    """
+    dosePerMBq = targetMeanCounts * relativeDoseRescaleFactor(
+        1.0, lungShuntFraction, liverCountSum, voxelVolumeML, conversionFactor, densityGPerML
+    )
+    if not np.isfinite(dosePerMBq) or dosePerMBq <= 0:
+        raise ValueError("The target segment receives no dose. Ensure it lies inside the liver segment.")
+    return targetDoseGy / dosePerMBq
+
+
+def estimateLungDose(activityMBq, lungShuntFraction, conversionFactor, lungMassG):
+    """
+    Lung absorbed dose (Gy) assuming the shunted activity is deposited uniformly in the lungs.
+    """
+    return (activityMBq * lungShuntFraction * conversionFactor) / lungMassG
+
+
+class RelativeDoseState:
+    """
+    Image-derived part of the patient-relative model for one SPECT and segmentation:
+    the liver-masked counts, the per-segment count sums and voxel counts and the per-segment
+    count histograms. Activity, lung shunt fraction, conversion factor and density only scale
+    these linearly, so parameter changes never need the label maps again.
+    """
+
+    def __init__(self, maskedArray, segmentStatistics, voxelVolumeML, key=None, countHistograms=None, liverCountSum=None):
+        self.maskedArray = maskedArray
+        if liverCountSum is None:
+            liverCountSum = float(np.sum(maskedArray, dtype=np.float64))
+        self.liverCountSum = liverCountSum
+        self.segmentStatistics = segmentStatistics
+        self.voxelVolumeML = voxelVolumeML
+        self.key = key
+        self.countHistograms = countHistograms
+
+    def rescaleFactor(self, activityMBq, lungShuntFraction, conversionFactor, densityGPerML):
+        return relativeDoseRescaleFactor(
+            activityMBq, lungShuntFraction, self.liverCountSum, self.voxelVolumeML, conversionFactor, densityGPerML
+        )
+
+    def segmentDoses(self, activityMBq, lungShuntFraction, conversionFactor, densityGPerML):
+        return self.segmentStatistics.means * self.rescaleFactor(activityMBq, lungShuntFraction, conversionFactor, densityGPerML)
+
+    def segmentActivities(self, activityMBq, lungShuntFraction, conversionFactor, densityGPerML):
+        doses = self.segmentDoses(activityMBq, lungShuntFraction, conversionFactor, densityGPerML)
+        return ((self.segmentStatistics.volumes * doses) / conversionFactor) * densityGPerML
+
+    def doseArray(self, activityMBq, lungShuntFraction, conversionFactor, densityGPerML, out=None, dtype=np.float32):
+        """
+        Dose (Gy) per voxel, computed in a single pass without a float64 intermediate.
+        If out is given, the dose is written into it (e.g. the voxel buffer of the output volume),
+        otherwise into a new array of the given dtype.
+        """
+        rescaleFactor = self.rescaleFactor(activityMBq, lungShuntFraction, conversionFactor, densityGPerML)
+        if out is None:
+            out = np.empty(self.maskedArray.shape, dtype=dtype)
+        return np.multiply(self.maskedArray, rescaleFactor, out=out, casting="unsafe")
+
+    def calculate(self, parameters, computeDoseArray=True, out=None):
+        """
+        Evaluate the model for a DosimetryParameters object and return a DosimetryResult.
+        The full-size dose array is only computed if computeDoseArray is set, into out if given.
+        """
+        args = (parameters.activityMBq, parameters.lungShuntFraction, parameters.conversionFactor, parameters.densityGPerML)
+        return DosimetryResult(
+            segmentIDs=self.segmentStatistics.segmentIDs,
+            segmentDoses=self.segmentDoses(*args),
+            segmentVolumes=self.segmentStatistics.volumes,
+            segmentActivities=self.segmentActivities(*args),
+            doseArray=self.doseArray(*args, out=out, dtype=parameters.doseDtype) if computeDoseArray else None,
+            lungDoseGy=estimateLungDose(parameters.activityMBq, parameters.lungShuntFraction,
+                                        parameters.conversionFactor, parameters.lungMassG),
+            doseVolumeHistograms=self.countHistograms.scaled(self.rescaleFactor(*args)) if self.countHistograms else None,
+            segmentMeanSquareDoses=self.segmentMeanSquareDoses(*args),
+        )
+
+    def segmentMeanSquareDoses(self, activityMBq, lungShuntFraction, conversionFactor, densityGPerML):
+        meanSquares = self.segmentStatistics.meanSquares
+        if meanSquares is None:
+            return None
+        return meanSquares * self.rescaleFactor(activityMBq, lungShuntFraction, conversionFactor, densityGPerML) ** 2
+
+    def sweep(self, activitiesMBq, lungShuntFractions, conversionFactors, densitiesGPerML, lungMassG):
+        """
+        Evaluate the model for every combination of the given parameter values as one array operation.
+        Returns a DoseSweep; activity varies slowest and density fastest.
+        """
+        grid = np.meshgrid(np.atleast_1d(activitiesMBq), np.atleast_1d(lungShuntFractions),
+                           np.atleast_1d(conversionFactors), np.atleast_1d(densitiesGPerML), indexing="ij")
+        activityMBq, lungShuntFraction, conversionFactor, densityGPerML = (values.ravel().astype(np.float64) for values in grid)
+        rescaleFactors = self.rescaleFactor(activityMBq, lungShuntFraction, conversionFactor, densityGPerML)
+        return DoseSweep(
+            activityMBq=activityMBq,
+            lungShuntFraction=lungShuntFraction,
+            conversionFactor=conversionFactor,
+            densityGPerML=densityGPerML,
+            segmentIDs=self.segmentStatistics.segmentIDs,
+            segmentDoses=rescaleFactors[:, np.newaxis] * self.segmentStatistics.means[np.newaxis, :],
+            lungDoseGy=estimateLungDose(activityMBq, lungShuntFraction, conversionFactor, lungMassG),
+        )
+
+    def updateSegments(self, segmentMasks, segmentIDs, key=None):
+        """
+        New state with the statistics and histograms of segmentIDs recomputed from their masks in a
+        {segmentID: SegmentMask} dict, for segments edited while the liver segment stayed the same.
+        The liver-masked counts and all other rows are shared with this state.
+        """
+        updatedMasks = {segmentID: segmentMasks[segmentID] for segmentID in segmentIDs}
+        statistics = computeSegmentStatistics(self.maskedArray, updatedMasks, self.voxelVolumeML, squares=True)
+        countHistograms = self.countHistograms
+        if countHistograms is not None:
+            countHistograms = updateDoseVolumeHistograms(countHistograms, self.maskedArray, segmentMasks, segmentIDs)
+        return RelativeDoseState(self.maskedArray, self.segmentStatistics.updated(statistics), self.voxelVolumeML,
+                                 key, countHistograms, self.liverCountSum)
+
+    def solveActivityForTargetDose(self, targetSegmentID, targetDoseGy, parameters):
+        """
+        Activity (MBq) that gives targetDoseGy as mean dose of a segment.
+        """
+        targetIndex = self.segmentStatistics.segmentIDs.index(targetSegmentID)
+        return solveActivityForTargetDose(
+            targetDoseGy, self.segmentStatistics.means[targetIndex], self.liverCountSum, parameters.lungShuntFraction,
+            self.voxelVolumeML, parameters.conversionFactor, parameters.densityGPerML
+        )
+
+
+def computeRelativeDoseState(spectArray, spacing, liverMask, labelLayers, key=None, doseKernel=None):
+    """
+    Mask the SPECT/PET counts with the liver, sum them and their squares per segment and build their per-segment histograms.
+    liverMask is a SegmentMask or a boolean (or 0/1) array and labelLayers a list of (labelArray, segmentIDs)
+    pairs or a {segmentID: SegmentMask} dict. The liver count sum is weighted like the segment statistics,
+    so with a FractionalSegmentMask of the liver its mean dose is the liver activity over its mass. If doseKernel
+    names a nuclide, the liver-masked counts are convolved with its voxel kernel before the segment statistics;
+    the liver count sum is unchanged.
+    """
+    liverCountSum = None
+    if isinstance(liverMask, SegmentMask):
+        liverCountSum = liverMask.sumValues(spectArray)
+        liverMask = liverMask.toArray()
+    maskedArray = maskArray(spectArray, liverMask)
+    if maskedArray.size == 0:
+        raise ValueError("Total volume is zero. Ensure the liver segment is correctly defined.")
+    voxelVolumeML = computeVoxelVolumeML(spacing)
+    if liverCountSum is None:
+        liverCountSum = float(np.sum(maskedArray, dtype=np.float64))
+    if doseKernel:
+        maskedArray = convolveWithDoseKernel(maskedArray, doseKernel, spacing)
+    statistics = computeSegmentStatistics(maskedArray, labelLayers, voxelVolumeML, squares=True)
+    countHistograms = computeDoseVolumeHistograms(maskedArray, labelLayers)
+    return RelativeDoseState(maskedArray, statistics, voxelVolumeML, key, countHistograms, liverCountSum)
+
+
+def calculateRelativeDose(spectArray, spacing, liverMask, labelLayers, parameters):
+    """
+    Patient-relative dosimetry on arrays: returns a DosimetryResult with the dose array,
+    per-segment doses, volumes, activities and DVHs and the estimated lung dose.
+    """
+    state = computeRelativeDoseState(spectArray, spacing, liverMask, labelLayers, doseKernel=parameters.doseKernel)
+    return state.calculate(parameters)
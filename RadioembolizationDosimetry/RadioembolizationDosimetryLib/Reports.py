@@ -0,0 +1,57 @@
+import csv
+import datetime
+
+
+def formatRtfReport(title, parameters, segmentRows, generated=None, metricColumns=()):
+    """
+    Build the RTF dosimetry report.
+    parameters is a list of (label, text) pairs and segmentRows a list of
+    (segment, dose, volume, activity, *metrics) texts, where missing values are None.
+    metricColumns labels the dose-volume metrics that follow the activity, e.g. "D70 (Gy)".
+    """
+    if generated is None:
+        generated = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    rtf = r"""{\rtf1\ansi\deff0
+{\b """ + title + r"""\line
+\b Radioembolization Dosimetry Report}\line
+Generated: """ + generated + r"""\line
+\line
+{\b Parameters}\line
+"""
+    for label, text in parameters:
+        rtf += f"{label}: {text}" + "\\line\n"
+    rtf += r"""\line
+{\b Segment Doses}\line
+"""
+
+    for segment, dose, volume, activity, *metrics in segmentRows:
+        rtf += f"Segment: {segment}, "
+        if dose is not None:
+            rtf += f"Dose = {dose} Gy"
+        if volume is not None:
+            rtf += f", Volume = {volume} mL"
+        if activity is not None:
+            rtf += f", Activity = {activity} MBq"
+        for label, value in zip(metricColumns, metrics):
+            if value is not None:
+                rtf += f", {label} = {value}"
+        rtf += r"\line\n "
+
+    rtf += r"\line\n End of Report}"
+    return rtf
+
+
+def writeDoseSweepCsv(path, sweep, segmentNames):
+    """
+    Write a DoseSweep as CSV with one row per scenario and one dose column per segment.
+    segmentNames are the column titles of the segments, in the order of sweep.segmentIDs.
+    """
+    with open(path, "w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(["Activity (MBq)", "Lung Shunt (%)", "Conversion Factor (Gy/MBq/g)", "Liver Density (g/mL)",
+                         "Lung Dose (Gy)"] + [f"{name} Dose (Gy)" for name in segmentNames])
+        for index in range(len(sweep.activityMBq)):
+            writer.writerow([f"{sweep.activityMBq[index]:.2f}", f"{sweep.lungShuntFraction[index] * 100:.2f}",
+                             f"{sweep.conversionFactor[index]:.2f}", f"{sweep.densityGPerML[index]:.2f}",
+                             f"{sweep.lungDoseGy[index]:.2f}"] + [f"{dose:.2f}" for dose in sweep.segmentDoses[index]])
@@ -0,0 +1,334 @@
+import numpy as np
+
+from .LabelmapCache import FractionalSegmentMask, SegmentMask, labelmapCache
+
+
+# getSegmentMasks oversampling that derives the sub-voxels per axis of each partial-volume mask from the
+# spacing the segment is stored at, e.g. 5 for a 1 mm CT segmentation on a 4.8 mm SPECT grid
+PARTIAL_VOLUME_AUTO = "auto"
+
+# Upper limit of the derived sub-voxels per axis
+PARTIAL_VOLUME_MAX_OVERSAMPLING = 8
+
+# Sub-voxels rasterised at once; larger segments are rasterised in slabs of reference slices
+PARTIAL_VOLUME_MAX_FINE_VOXELS = 1 << 25
+
+
+def groupSegmentIDsByLayer(segmentation, segmentIDs):
+    """
+    Group segment IDs so that segments sharing a binary labelmap layer (and therefore never
+    overlapping) are exported together. Segments without a layer get a group of their own.
+    """
+    layers = {}
+    groups = []
+    for segmentID in segmentIDs:
+        layerIndex = segmentation.GetLayerIndex(segmentID)
+        if layerIndex < 0:
+            groups.append([segmentID])
+            continue
+        if layerIndex not in layers:
+            layers[layerIndex] = []
+            groups.append(layers[layerIndex])
+        layers[layerIndex].append(segmentID)
+    return groups
+
+
+def exportSegmentLabelLayers(segmentationNode, segmentIDs, referenceVolumeNode):
+    """
+    Export segments to label arrays on the reference volume grid, one export per layer.
+    Returns a list of (labelArray, segmentIDs) pairs, segmentIDs[i] has label value i+1.
+    """
+    import slicer
+
+    segmentation = segmentationNode.GetSegmentation()
+    segmentationsLogic = slicer.modules.segmentations.logic()
+    labelLayers = []
+    labelMapVolumeNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLabelMapVolumeNode")
+    try:
+        for layerSegmentIDs in groupSegmentIDsByLayer(segmentation, segmentIDs):
+            segmentationsLogic.ExportSegmentsToLabelmapNode(
+                segmentationNode, layerSegmentIDs, labelMapVolumeNode, referenceVolumeNode
+            )
+            # The node is reused for the next layer, so keep a copy of the voxels
+            labelLayers.append((slicer.util.arrayFromVolume(labelMapVolumeNode).copy(), layerSegmentIDs))
+    finally:
+        slicer.mrmlScene.RemoveNode(labelMapVolumeNode)
+    return labelLayers
+
+
+def getSegmentIDs(segmentation):
+    """
+    List of all segment IDs of a vtkSegmentation, in display order.
+    """
+    import vtk
+
+    segmentIDs = vtk.vtkStringArray()
+    segmentation.GetSegmentIDs(segmentIDs)
+    return [segmentIDs.GetValue(i) for i in range(segmentIDs.GetNumberOfValues())]
+
+
+def getSegmentModifiedTime(segmentation, segmentID):
+    """
+    Modification time of a segment's content, taken from the segment and its source representation.
+    """
+    segment = segmentation.GetSegment(segmentID)
+    if hasattr(segmentation, "GetSourceRepresentationName"):
+        representationName = segmentation.GetSourceRepresentationName()
+    else:
+        representationName = segmentation.GetMasterRepresentationName()
+    representation = segment.GetRepresentation(representationName)
+    representationTime = representation.GetMTime() if representation else 0
+    return max(segment.GetMTime(), representationTime)
+
+
+def getSegmentationStateKey(segmentationNode):
+    """
+    Hashable key that changes whenever a segment is added, removed or edited.
+    """
+    segmentation = segmentationNode.GetSegmentation()
+    return (segmentationNode.GetID(),) + tuple(
+        (segmentID, getSegmentModifiedTime(segmentation, segmentID)) for segmentID in getSegmentIDs(segmentation)
+    )
+
+
+def getChangedSegmentIDs(previousStateKey, stateKey):
+    """
+    IDs of the segments whose content changed between two getSegmentationStateKey keys, or None if
+    the keys belong to different segmentation nodes or segments were added, removed or reordered.
+    """
+    if previousStateKey[0] != stateKey[0]:
+        return None
+    previousTimes = dict(previousStateKey[1:])
+    times = dict(stateKey[1:])
+    if list(previousTimes) != list(times):
+        return None
+    return [segmentID for segmentID, modifiedTime in times.items() if previousTimes[segmentID] != modifiedTime]
+
+
+def _getTransformKey(node):
+    transformNode = node.GetParentTransformNode()
+    if not transformNode:
+        return None
+    return (transformNode.GetID(), transformNode.GetMTime())
+
+
+def getReferenceGeometryKey(referenceVolumeNode):
+    """
+    Hashable key of the voxel grid of a reference volume: dimensions, IJK to RAS matrix and parent transform.
+    """
+    import vtk
+
+    ijkToRas = vtk.vtkMatrix4x4()
+    referenceVolumeNode.GetIJKToRASMatrix(ijkToRas)
+    imageData = referenceVolumeNode.GetImageData()
+    dimensions = tuple(imageData.GetDimensions()) if imageData else None
+    return (dimensions, tuple(ijkToRas.GetElement(row, column) for row in range(4) for column in range(4)),
+            _getTransformKey(referenceVolumeNode))
+
+
+def getSegmentMaskKey(segmentationNode, segmentID, referenceGeometryKey, oversampling=None):
+    """
+    Labelmap cache key of one segment exported to a reference geometry, as a partial-volume mask
+    if oversampling is given.
+    """
+    segmentation = segmentationNode.GetSegmentation()
+    return (segmentationNode.GetID(), segmentID, getSegmentModifiedTime(segmentation, segmentID),
+            _getTransformKey(segmentationNode), referenceGeometryKey, oversampling)
+
+
+def getSegmentVoxelBounds(segmentationNode, segmentID, referenceVolumeNode):
+    """
+    KJI (start, stop) bounds on the reference volume grid that contain the segment, with a margin of
+    one voxel, or None if the segment is empty or outside the grid.
+    """
+    import slicer
+    import vtk
+
+    segmentBounds = [0.0] * 6
+    segmentationNode.GetSegmentation().GetSegment(segmentID).GetBounds(segmentBounds)
+    if segmentBounds[0] > segmentBounds[1]:
+        return None
+    segmentToReference = vtk.vtkGeneralTransform()
+    slicer.vtkMRMLTransformNode.GetTransformBetweenNodes(
+        segmentationNode.GetParentTransformNode(), referenceVolumeNode.GetParentTransformNode(), segmentToReference
+    )
+    rasToIjk = vtk.vtkMatrix4x4()
+    referenceVolumeNode.GetRASToIJKMatrix(rasToIjk)
+    corners = []
+    for r in segmentBounds[0:2]:
+        for a in segmentBounds[2:4]:
+            for s in segmentBounds[4:6]:
+                point = segmentToReference.TransformPoint(r, a, s)
+                corners.append(rasToIjk.MultiplyPoint(list(point) + [1.0])[:3])
+    corners = np.array(corners)
+    dimensions = referenceVolumeNode.GetImageData().GetDimensions()
+    starts = np.maximum(np.floor(corners.min(axis=0)).astype(int) - 1, 0)
+    stops = np.minimum(np.ceil(corners.max(axis=0)).astype(int) + 2, dimensions)
+    if np.any(stops <= starts):
+        return None
+    return tuple((int(start), int(stop)) for start, stop in zip(starts[::-1], stops[::-1]))
+
+
+def getSegmentSpacing(segmentationNode, segmentID):
+    """
+    Finest voxel spacing (mm) the segment is stored at: that of its binary labelmap, otherwise that of the
+    reference image geometry of the segmentation. None if neither is known.
+    """
+    import slicer
+
+    converter = slicer.vtkSegmentationConverter
+    segmentation = segmentationNode.GetSegmentation()
+    labelmap = segmentation.GetSegment(segmentID).GetRepresentation(converter.GetSegmentationBinaryLabelmapRepresentationName())
+    if labelmap is None or labelmap.IsEmpty():
+        geometry = segmentation.GetConversionParameter(converter.GetReferenceImageGeometryParameterName())
+        labelmap = slicer.vtkOrientedImageData()
+        if not geometry or not converter.DeserializeImageGeometry(geometry, labelmap, False):
+            return None
+    return min(labelmap.GetSpacing())
+
+
+def getPartialVolumeOversampling(segmentationNode, segmentID, referenceVolumeNode):
+    """
+    Sub-voxels per axis (KJI) of the reference grid that resolve the segment at the spacing it is stored at,
+    between 1 and PARTIAL_VOLUME_MAX_OVERSAMPLING.
+    """
+    segmentSpacing = getSegmentSpacing(segmentationNode, segmentID)
+    if not segmentSpacing:
+        return (PARTIAL_VOLUME_MAX_OVERSAMPLING,) * 3
+    # The tolerance keeps e.g. a 4.8 mm grid over a 1.2 mm segmentation at 4 instead of 5
+    ratios = np.asarray(referenceVolumeNode.GetSpacing(), dtype=np.float64)[::-1] / segmentSpacing
+    return tuple(int(factor) for factor in np.clip(np.ceil(ratios - 1e-3), 1, PARTIAL_VOLUME_MAX_OVERSAMPLING))
+
+
+def _exportFineFractions(segmentationNode, segmentID, referenceVolumeNode, bounds, oversampling, fineVolumeNode, labelMapVolumeNode):
+    """
+    Covered fraction of the reference voxels within bounds, from the segment rasterised on a grid
+    oversampling[axis] times finer along each KJI axis.
+    """
+    import slicer
+    import vtk
+
+    sizes = [stop - start for start, stop in bounds]
+
+    # Sub-voxel centers of the fine grid in reference IJK coordinates
+    fineToReference = np.eye(4)
+    for axis, ((start, _), factor) in enumerate(zip(reversed(bounds), reversed(oversampling))):
+        fineToReference[axis, axis] = 1.0 / factor
+        fineToReference[axis, 3] = start - 0.5 + 0.5 / factor
+    ijkToRas = vtk.vtkMatrix4x4()
+    referenceVolumeNode.GetIJKToRASMatrix(ijkToRas)
+    fineIjkToRas = slicer.util.arrayFromVTKMatrix(ijkToRas) @ fineToReference
+
+    imageData = vtk.vtkImageData()
+    imageData.SetDimensions(*(size * factor for size, factor in zip(reversed(sizes), reversed(oversampling))))
+    imageData.AllocateScalars(vtk.VTK_UNSIGNED_CHAR, 1)
+    fineVolumeNode.SetAndObserveImageData(imageData)
+    fineVolumeNode.SetIJKToRASMatrix(slicer.util.vtkMatrixFromArray(fineIjkToRas))
+    slicer.modules.segmentations.logic().ExportSegmentsToLabelmapNode(
+        segmentationNode, [segmentID], labelMapVolumeNode, fineVolumeNode
+    )
+    fineArray = slicer.util.arrayFromVolume(labelMapVolumeNode)
+    covered = (fineArray > 0).reshape(sizes[0], oversampling[0], sizes[1], oversampling[1], sizes[2], oversampling[2])
+    return np.count_nonzero(covered, axis=(1, 3, 5)) / float(np.prod(oversampling))
+
+
+def exportFractionalSegmentMask(segmentationNode, segmentID, referenceVolumeNode, oversampling=None):
+    """
+    Rasterise a segment on a grid finer than the reference volume, covering only the segment's bounds,
+    and return the covered fraction of every reference voxel as a FractionalSegmentMask.
+    oversampling is the number of sub-voxels per axis, one number or a KJI triple; by default it
+    follows from the spacing the segment is stored at. Bounds with more than PARTIAL_VOLUME_MAX_FINE_VOXELS
+    sub-voxels are rasterised in slabs of reference slices, which bounds the memory of the fine grid.
+    """
+    import slicer
+
+    shape = tuple(reversed(referenceVolumeNode.GetImageData().GetDimensions()))
+    bounds = getSegmentVoxelBounds(segmentationNode, segmentID, referenceVolumeNode)
+    if bounds is None:
+        return FractionalSegmentMask(np.zeros((0,) * len(shape), dtype=np.float32), shape=shape)
+    if oversampling is None:
+        oversampling = getPartialVolumeOversampling(segmentationNode, segmentID, referenceVolumeNode)
+    oversampling = tuple(int(factor) for factor in np.broadcast_to(oversampling, (3,)))
+
+    (kStart, kStop), (jStart, jStop), (iStart, iStop) = bounds
+    sliceFineVoxels = (jStop - jStart) * (iStop - iStart) * int(np.prod(oversampling))
+    slabSlices = max(1, PARTIAL_VOLUME_MAX_FINE_VOXELS // sliceFineVoxels)
+    # Only the block within the bounds is allocated, not the whole reference grid
+    fractions = np.zeros(tuple(stop - start for start, stop in bounds), dtype=np.float32)
+
+    fineVolumeNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode")
+    fineVolumeNode.SetAndObserveTransformNodeID(referenceVolumeNode.GetTransformNodeID())
+    labelMapVolumeNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLabelMapVolumeNode")
+    try:
+        for slabStart in range(kStart, kStop, slabSlices):
+            slabBounds = ((slabStart, min(slabStart + slabSlices, kStop)),) + bounds[1:]
+            fractions[slabStart - kStart:slabBounds[0][1] - kStart] = _exportFineFractions(
+                segmentationNode, segmentID, referenceVolumeNode, slabBounds, oversampling, fineVolumeNode, labelMapVolumeNode
+            )
+    finally:
+        slicer.mrmlScene.RemoveNode(labelMapVolumeNode)
+        slicer.mrmlScene.RemoveNode(fineVolumeNode)
+    return FractionalSegmentMask(fractions, offset=(kStart, jStart, iStart), shape=shape)
+
+
+def getSegmentMasks(segmentationNode, segmentIDs, referenceVolumeNode, cache=None, oversampling=None):
+    """
+    Return {segmentID: SegmentMask} on the reference volume grid, in the order of segmentIDs.
+    Only segments missing from the labelmap cache are exported, one export per layer.
+    If oversampling is given, each missing segment is rasterised once at sub-voxel resolution
+    and FractionalSegmentMasks with the covered fraction of every voxel are returned instead;
+    PARTIAL_VOLUME_AUTO derives the sub-voxels per axis from the spacing of each segment.
+    """
+    if cache is None:
+        cache = labelmapCache
+    segmentIDs = list(dict.fromkeys(segmentIDs))
+    referenceGeometryKey = getReferenceGeometryKey(referenceVolumeNode)
+    keys = {segmentID: getSegmentMaskKey(segmentationNode, segmentID, referenceGeometryKey, oversampling)
+            for segmentID in segmentIDs}
+
+    masks = {}
+    missingSegmentIDs = []
+    for segmentID in segmentIDs:
+        mask = cache.get(keys[segmentID])
+        if mask is None:
+            missingSegmentIDs.append(segmentID)
+        else:
+            masks[segmentID] = mask
+
+    if missingSegmentIDs and oversampling:
+        for segmentID in missingSegmentIDs:
+            mask = exportFractionalSegmentMask(segmentationNode, segmentID, referenceVolumeNode,
+                                               None if oversampling == PARTIAL_VOLUME_AUTO else oversampling)
+            masks[segmentID] = mask
+            cache.put(keys[segmentID], mask)
+    elif missingSegmentIDs:
+        for labelArray, layerSegmentIDs in exportSegmentLabelLayers(segmentationNode, missingSegmentIDs, referenceVolumeNode):
+            for labelIndex, segmentID in enumerate(layerSegmentIDs):
+                mask = SegmentMask(labelArray == labelIndex + 1)
+                masks[segmentID] = mask
+                cache.put(keys[segmentID], mask)
+    return {segmentID: masks[segmentID] for segmentID in segmentIDs}
+
+
+def createIsodoseSegments(isodoseRegions, referenceVolumeNode, segmentationNode=None):
+    """
+    Write every level of an IsodoseRegions object as a segment "Isodose <level> Gy" on the grid of the reference
+    volume. Segments of the same name are overwritten. A new segmentation node is created if none is given,
+    so the isodose segments do not change the segmentation used for the dose statistics.
+    """
+    import slicer
+
+    if segmentationNode is None:
+        segmentationNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode", "Isodose Segments")
+        segmentationNode.CreateDefaultDisplayNodes()
+    segmentationNode.SetReferenceImageGeometryParameterFromVolumeNode(referenceVolumeNode)
+    segmentation = segmentationNode.GetSegmentation()
+    for levelIndex, levelGy in enumerate(isodoseRegions.levelsGy):
+        segmentName = f"Isodose {levelGy:g} Gy"
+        segmentID = segmentation.GetSegmentIdBySegmentName(segmentName)
+        if not segmentID:
+            segmentID = segmentation.AddEmptySegment("", segmentName)
+        slicer.util.updateSegmentBinaryLabelmapFromArray(
+            isodoseRegions.mask(levelIndex).astype(np.uint8), segmentationNode, segmentID, referenceVolumeNode
+        )
+    return segmentationNode
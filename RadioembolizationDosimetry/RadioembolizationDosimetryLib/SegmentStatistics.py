@@ -0,0 +1,136 @@
+import numpy as np
+
+
+# Voxels per bincount call; bounds the float64 copy of the values that np.bincount makes
+STATISTICS_CHUNK_SIZE = 1 << 22
+
+
+class SegmentStatistics:
+    """
+    Per-segment voxel counts, value sums and optionally sums of squared values, stored as arrays in segment order.
+    Counts of partial-volume masks are fractional and stored as float64.
+    """
+
+    def __init__(self, segmentIDs, sums, counts, voxelVolumeML, sumSquares=None):
+        self.segmentIDs = list(segmentIDs)
+        self.sums = np.asarray(sums, dtype=np.float64)
+        counts = np.asarray(counts)
+        self.counts = counts.astype(np.float64 if counts.dtype.kind == "f" else np.int64)
+        self.voxelVolumeML = voxelVolumeML
+        self.sumSquares = None if sumSquares is None else np.asarray(sumSquares, dtype=np.float64)
+
+    @property
+    def means(self):
+        # Empty segments get NaN, like np.mean of an empty selection
+        means = np.full(self.sums.shape, np.nan)
+        np.divide(self.sums, self.counts, out=means, where=self.counts > 0)
+        return means
+
+    @property
+    def meanSquares(self):
+        # Mean squared value, e.g. for the quadratic term of the BED; None if the squares were not summed
+        if self.sumSquares is None:
+            return None
+        meanSquares = np.full(self.sumSquares.shape, np.nan)
+        np.divide(self.sumSquares, self.counts, out=meanSquares, where=self.counts > 0)
+        return meanSquares
+
+    @property
+    def volumes(self):
+        return self.counts * self.voxelVolumeML
+
+    def activities(self, conversionFactor, densityGPerML):
+        """
+        Activity (MBq) that delivers the mean dose of each segment.
+        """
+        return ((self.volumes * self.means) / conversionFactor) * densityGPerML
+
+    def updated(self, other):
+        """
+        Copy with the rows of the segments in other replaced by those of other, in the order of this object.
+        """
+        rows = [self.segmentIDs.index(segmentID) for segmentID in other.segmentIDs]
+        sums = self.sums.copy()
+        sums[rows] = other.sums
+        counts = self.counts.astype(np.result_type(self.counts, other.counts))
+        counts[rows] = other.counts
+        sumSquares = None
+        if self.sumSquares is not None and other.sumSquares is not None:
+            sumSquares = self.sumSquares.copy()
+            sumSquares[rows] = other.sumSquares
+        return SegmentStatistics(self.segmentIDs, sums, counts, self.voxelVolumeML, sumSquares)
+
+
+def computeLabelStatistics(valueArray, labelArray, numberOfLabels, squares=False):
+    """
+    Sum values and count voxels for every label value in one pass.
+    Returned arrays are indexed by label value, index 0 is the background.
+    With squares=True the sums of the squared values are returned as a third array.
+    """
+    labels = np.asarray(labelArray).ravel()
+    values = np.asarray(valueArray).ravel()
+    counts = np.bincount(labels, minlength=numberOfLabels + 1)
+    if values.size <= STATISTICS_CHUNK_SIZE and not squares:
+        sums = np.bincount(labels, weights=values, minlength=numberOfLabels + 1)
+        return sums, counts
+    sums = np.zeros(counts.shape, dtype=np.float64)
+    sumSquares = np.zeros(counts.shape, dtype=np.float64)
+    for start in range(0, values.size, STATISTICS_CHUNK_SIZE):
+        stop = start + STATISTICS_CHUNK_SIZE
+        chunkValues = values[start:stop].astype(np.float64)
+        sums += np.bincount(labels[start:stop], weights=chunkValues, minlength=counts.size)
+        if squares:
+            np.square(chunkValues, out=chunkValues)
+            sumSquares += np.bincount(labels[start:stop], weights=chunkValues, minlength=counts.size)
+    if squares:
+        return sums, counts, sumSquares
+    return sums, counts
+
+
+def computeSegmentMaskStatistics(valueArray, segmentMasks, voxelVolumeML, squares=False):
+    """
+    Compute statistics for a {segmentID: SegmentMask} dict, in the order of the dict.
+    Only the bounding box of each segment is read, so the cost scales with the segment size.
+    Voxels of a FractionalSegmentMask are weighted by the fraction the segment covers.
+    """
+    segmentIDs = list(segmentMasks)
+    counts = [segmentMasks[segmentID].volumeVoxels for segmentID in segmentIDs]
+    if not squares:
+        sums = [segmentMasks[segmentID].sumValues(valueArray) for segmentID in segmentIDs]
+        return SegmentStatistics(segmentIDs, sums, counts, voxelVolumeML)
+    sums = []
+    sumSquares = []
+    for segmentID in segmentIDs:
+        mask = segmentMasks[segmentID]
+        if mask.shape != valueArray.shape:
+            raise ValueError("Label map geometry does not match the input volume.")
+        values = valueArray[mask.slices][mask.croppedArray()].astype(np.float64) if mask.voxelCount else np.empty(0)
+        weightedValues = values if mask.weights is None else values * mask.weights
+        sums.append(np.sum(weightedValues))
+        sumSquares.append(np.dot(weightedValues, values))
+    return SegmentStatistics(segmentIDs, sums, counts, voxelVolumeML, sumSquares)
+
+
+def computeSegmentStatistics(valueArray, labelLayers, voxelVolumeML, squares=False):
+    """
+    Compute statistics for all segments of a list of label layers.
+    Each layer is a (labelArray, segmentIDs) pair where segmentIDs[i] has label value i+1.
+    labelLayers may also be a {segmentID: SegmentMask} dict, see computeSegmentMaskStatistics.
+    With squares=True the sums of squared values are computed in the same pass.
+    """
+    if isinstance(labelLayers, dict):
+        return computeSegmentMaskStatistics(valueArray, labelLayers, voxelVolumeML, squares)
+    segmentIDs = []
+    sums = []
+    counts = []
+    sumSquares = []
+    for labelArray, layerSegmentIDs in labelLayers:
+        if labelArray.shape != valueArray.shape:
+            raise ValueError("Label map geometry does not match the input volume.")
+        layerStatistics = computeLabelStatistics(valueArray, labelArray, len(layerSegmentIDs), squares)
+        segmentIDs.extend(layerSegmentIDs)
+        sums.extend(layerStatistics[0][1:len(layerSegmentIDs) + 1])
+        counts.extend(layerStatistics[1][1:len(layerSegmentIDs) + 1])
+        if squares:
+            sumSquares.extend(layerStatistics[2][1:len(layerSegmentIDs) + 1])
+    return SegmentStatistics(segmentIDs, sums, counts, voxelVolumeML, sumSquares if squares else None)
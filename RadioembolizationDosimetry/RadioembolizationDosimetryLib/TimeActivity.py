@@ -0,0 +1,159 @@
+import numpy as np
+
+from .DoseVolumeHistograms import computeDoseVolumeHistograms
+from .Parameters import DosimetryResult, computeVoxelVolumeML
+from .SegmentStatistics import STATISTICS_CHUNK_SIZE, computeSegmentStatistics
+from .VoxelSValues import convolveWithDoseKernel
+
+
+# Mono-exponential fit of the time-activity curves: per voxel, or per segment on the segment mean curves
+TIME_ACTIVITY_FIT_MODES = ("voxel", "segment")
+
+
+def fitMonoExponential(hoursElapsed, values, minimumDecayConstant):
+    """
+    Log-linear least-squares fit of values[i] = amplitude * exp(-decayConstant * hoursElapsed[i]) for every
+    column of values (shape (timepoints, curves)). Decay constants (1/h) are at least minimumDecayConstant,
+    the physical decay of the nuclide; curves with a non-positive value, and a single timepoint, are
+    decay-corrected with the physical decay instead. Returns (amplitudes, decayConstants) at treatment time.
+    """
+    times = np.asarray(hoursElapsed, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+    meanTime = times.mean()
+    centeredTimes = times - meanTime
+    sumSquares = np.sum(centeredTimes ** 2)
+
+    positive = np.all(values > 0, axis=0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        logValues = np.log(np.where(positive, values, 1.0))
+    if sumSquares > 0:
+        decayConstants = -(centeredTimes @ logValues) / sumSquares
+    else:
+        decayConstants = np.zeros(values.shape[1:])
+    decayConstants = np.where(positive, np.maximum(decayConstants, minimumDecayConstant), minimumDecayConstant)
+
+    # For a fixed decay constant the least-squares intercept is the mean of log(value) + decayConstant * time
+    amplitudes = np.exp(logValues.mean(axis=0) + decayConstants * meanTime)
+    physicalAmplitudes = np.mean(values * np.exp(minimumDecayConstant * times)[:, np.newaxis], axis=0)
+    amplitudes = np.where(positive, amplitudes, np.maximum(physicalAmplitudes, 0.0))
+    return amplitudes, decayConstants
+
+
+def _getTimeActivityDoseFactor(parameters):
+    # The conversion factor assumes complete physical decay, so the dose of a time-integrated activity
+    # (Bq h/mL) is that of the administered activity with the same integral
+    physicalDecayConstant = np.log(2.0) / parameters.halfLifeHours
+    return physicalDecayConstant * parameters.conversionFactor / (1000000 * parameters.densityGPerML)
+
+
+def computeTimeIntegratedActivity(petArrays, hoursElapsed, halfLifeHours, out=None, chunkSize=STATISTICS_CHUNK_SIZE):
+    """
+    Time-integrated activity concentration (Bq h/mL) of every voxel from registered activity concentration
+    arrays (Bq/mL) acquired hoursElapsed after treatment, by a mono-exponential fit per voxel.
+    The voxels are fitted in chunks, so at most chunkSize voxels of all timepoints are in memory at a time.
+    """
+    shape = petArrays[0].shape
+    if any(array.shape != shape for array in petArrays):
+        raise ValueError("All timepoints must have the same geometry. Register and resample them first.")
+    if out is None:
+        out = np.empty(shape, dtype=np.float32)
+    physicalDecayConstant = np.log(2.0) / halfLifeHours
+    flatArrays = [array.reshape(-1) for array in petArrays]
+    flatOut = out.reshape(-1)
+    chunkSize = max(1, chunkSize // len(petArrays))
+    for start in range(0, flatOut.size, chunkSize):
+        stop = start + chunkSize
+        values = np.stack([array[start:stop] for array in flatArrays])
+        amplitudes, decayConstants = fitMonoExponential(hoursElapsed, values, physicalDecayConstant)
+        flatOut[start:stop] = amplitudes / decayConstants
+    return out
+
+
+def calculateTimeIntegratedDose(petArrays, hoursElapsed, spacing, labelLayers, parameters, fitMode="voxel", out=None):
+    """
+    Absolute dosimetry from several registered timepoints. petArrays hold activity concentrations in Bq/mL
+    acquired hoursElapsed after treatment; parameters.hoursElapsed is not used.
+    In "voxel" mode every voxel gets its own mono-exponential fit and the segment doses are the means of the
+    dose map. In "segment" mode the segment mean curves are fitted, and the dose map uses the effective decay
+    of the whole field of view; with a dose kernel, the fitted segment doses take the spill-in and spill-out of
+    the convolved time-integrated activity. Returns a DosimetryResult like calculateAbsoluteDose, where the total activity
+    is that of the first timepoint and the decay-corrected activity the administered activity with the same
+    time integral. segmentEffectiveHalfLivesHours holds the fitted effective half-life of each segment.
+    """
+    if fitMode not in TIME_ACTIVITY_FIT_MODES:
+        raise ValueError(f"Unknown fit mode '{fitMode}'. Use {' or '.join(TIME_ACTIVITY_FIT_MODES)}.")
+    if len(petArrays) != len(hoursElapsed) or not petArrays:
+        raise ValueError("Each timepoint needs one acquisition time.")
+    order = np.argsort(hoursElapsed)
+    petArrays = [petArrays[index] for index in order]
+    hoursElapsed = [float(hoursElapsed[index]) for index in order]
+
+    voxelVolumeML = computeVoxelVolumeML(spacing)
+    if petArrays[0].size * voxelVolumeML == 0:
+        raise ValueError("Total volume is zero. Ensure the SPECT volume contains valid data.")
+    physicalDecayConstant = np.log(2.0) / parameters.halfLifeHours
+    doseFactor = _getTimeActivityDoseFactor(parameters)
+    totalActivityMBq = np.sum(petArrays[0], dtype=np.float64) * voxelVolumeML / 1000000
+
+    if out is None:
+        out = np.empty(petArrays[0].shape, dtype=parameters.doseDtype)
+    # The dose kernel is linear, so it can be applied to the time-integrated activity
+    integralArray = out if not parameters.doseKernel and out.dtype == np.float32 else None
+    if fitMode == "voxel":
+        integralArray = computeTimeIntegratedActivity(petArrays, hoursElapsed, parameters.halfLifeHours, out=integralArray)
+    else:
+        totals = [[np.sum(array, dtype=np.float64)] for array in petArrays]
+        _, (fieldDecayConstant,) = fitMonoExponential(hoursElapsed, totals, physicalDecayConstant)
+        if integralArray is None:
+            integralArray = np.zeros(petArrays[0].shape, dtype=np.float32)
+        else:
+            integralArray[...] = 0
+        for array, hours in zip(petArrays, hoursElapsed):
+            integralArray += array * np.float32(np.exp(fieldDecayConstant * hours) / (len(petArrays) * fieldDecayConstant))
+    equivalentActivityMBq = np.sum(integralArray, dtype=np.float64) * voxelVolumeML * physicalDecayConstant / 1000000
+
+    integralArray *= np.float32(doseFactor)
+    integralStatistics = None
+    if fitMode == "segment" and parameters.doseKernel:
+        integralStatistics = computeSegmentStatistics(integralArray, labelLayers, voxelVolumeML)
+    if parameters.doseKernel:
+        doseArray = convolveWithDoseKernel(integralArray, parameters.doseKernel, spacing, out=out)
+    else:
+        if integralArray is not out:
+            out[...] = integralArray
+        doseArray = out
+    del integralArray
+
+    statistics = computeSegmentStatistics(doseArray, labelLayers, voxelVolumeML, squares=True)
+    # The segment mean curves give the effective half-life of each segment, and in segment mode its dose
+    curves = [computeSegmentStatistics(array, labelLayers, voxelVolumeML).means for array in petArrays]
+    amplitudes, segmentDecayConstants = fitMonoExponential(hoursElapsed, curves, physicalDecayConstant)
+    if fitMode == "voxel":
+        segmentDoses = statistics.means
+        segmentMeanSquareDoses = statistics.meanSquares
+    else:
+        segmentDoses = amplitudes / segmentDecayConstants * doseFactor
+        if integralStatistics is not None:
+            # The curves are fitted without the dose kernel, which is linear, so the spill-in and spill-out of
+            # each segment are those of the convolved time-integrated activity instead of one convolution per timepoint
+            with np.errstate(divide="ignore", invalid="ignore"):
+                segmentDoses = np.where(integralStatistics.means > 0,
+                                        segmentDoses * statistics.means / integralStatistics.means, statistics.means)
+        # The dose map keeps the shape of the dose distribution, only the segment fit sets its level
+        with np.errstate(divide="ignore", invalid="ignore"):
+            segmentMeanSquareDoses = statistics.meanSquares * (segmentDoses / statistics.means) ** 2
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        segmentEffectiveHalfLivesHours = np.log(2.0) / segmentDecayConstants
+    return DosimetryResult(
+        segmentIDs=statistics.segmentIDs,
+        segmentDoses=segmentDoses,
+        segmentVolumes=statistics.volumes,
+        segmentActivities=((statistics.volumes * segmentDoses) / parameters.conversionFactor) * parameters.densityGPerML,
+        doseArray=doseArray,
+        totalActivityMBq=totalActivityMBq,
+        decayCorrectedActivityMBq=equivalentActivityMBq,
+        doseVolumeHistograms=computeDoseVolumeHistograms(doseArray, labelLayers),
+        segmentEffectiveHalfLivesHours=segmentEffectiveHalfLivesHours,
+        segmentMeanSquareDoses=segmentMeanSquareDoses,
+    )
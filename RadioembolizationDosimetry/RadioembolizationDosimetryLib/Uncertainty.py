@@ -0,0 +1,104 @@
+from dataclasses import dataclass, field
+
+import numpy as np
+
+from .RelativeDosimetry import estimateLungDose
+
+
+# DosimetryParameters fields that can be sampled, with the range their samples are clipped to
+UNCERTAIN_PARAMETER_BOUNDS = {
+    "lungShuntFraction": (0.0, 1.0),
+    "lungMassG": (1e-6, np.inf),
+    "densityGPerML": (1e-6, np.inf),
+    "conversionFactor": (1e-6, np.inf),
+}
+
+
+@dataclass
+class ParameterUncertainty:
+    """
+    Distribution of one parameter around its nominal value: "normal" with standard deviation spread,
+    "uniform" over nominal +/- spread, or "fixed". spread is in the units of the parameter.
+    """
+    distribution: str = "fixed"
+    spread: float = 0.0
+
+    def sample(self, rng, nominal, numberOfSamples):
+        if self.distribution == "fixed" or self.spread <= 0:
+            return np.full(numberOfSamples, float(nominal))
+        if self.distribution == "normal":
+            return rng.normal(nominal, self.spread, numberOfSamples)
+        if self.distribution == "uniform":
+            return rng.uniform(nominal - self.spread, nominal + self.spread, numberOfSamples)
+        raise ValueError(f"Unknown distribution '{self.distribution}'. Use fixed, normal or uniform.")
+
+
+@dataclass
+class UncertaintyModel:
+    """
+    Distributions of uncertain DosimetryParameters fields, keyed by field name, and the sampling settings.
+    The same seed always gives the same samples.
+    """
+    parameters: dict = field(default_factory=dict)
+    numberOfSamples: int = 10000
+    seed: int = 0
+    confidencePercent: float = 95.0
+
+    def sample(self, parameters):
+        """
+        {field name: samples} for all fields in UNCERTAIN_PARAMETER_BOUNDS, around the values of a DosimetryParameters.
+        """
+        rng = np.random.default_rng(self.seed)
+        samples = {}
+        for name, (lower, upper) in UNCERTAIN_PARAMETER_BOUNDS.items():
+            uncertainty = self.parameters.get(name, ParameterUncertainty())
+            samples[name] = np.clip(uncertainty.sample(rng, getattr(parameters, name), self.numberOfSamples), lower, upper)
+        return samples
+
+
+@dataclass
+class DoseUncertainty:
+    """
+    Sampled segment mean doses, shape (samples, segments) in the order of segmentIDs, and lung doses.
+    """
+    segmentIDs: list
+    segmentDoseSamples: np.ndarray
+    lungDoseSamples: np.ndarray
+    confidencePercent: float = 95.0
+
+    def _percentiles(self):
+        tail = (100.0 - self.confidencePercent) / 2.0
+        return [tail, 100.0 - tail]
+
+    @property
+    def segmentIntervals(self):
+        """
+        (lower, upper) per-segment dose bounds of the central confidence interval.
+        """
+        lower, upper = np.percentile(self.segmentDoseSamples, self._percentiles(), axis=0)
+        return lower, upper
+
+    @property
+    def lungDoseInterval(self):
+        """
+        (lower, upper) lung dose bounds of the central confidence interval.
+        """
+        lower, upper = np.percentile(self.lungDoseSamples, self._percentiles())
+        return float(lower), float(upper)
+
+
+def propagateRelativeDoseUncertainty(doseState, parameters, model):
+    """
+    Evaluate the patient-relative model of a RelativeDoseState for all samples of an UncertaintyModel
+    at once. Only the cached per-segment count sums are used.
+    """
+    samples = model.sample(parameters)
+    rescaleFactors = doseState.rescaleFactor(parameters.activityMBq, samples["lungShuntFraction"],
+                                             samples["conversionFactor"], samples["densityGPerML"])
+    return DoseUncertainty(
+        segmentIDs=doseState.segmentStatistics.segmentIDs,
+        segmentDoseSamples=rescaleFactors[:, np.newaxis] * doseState.segmentStatistics.means[np.newaxis, :],
+        lungDoseSamples=estimateLungDose(parameters.activityMBq, samples["lungShuntFraction"],
+                                         samples["conversionFactor"], samples["lungMassG"]),
+        confidencePercent=model.confidencePercent,
+    )
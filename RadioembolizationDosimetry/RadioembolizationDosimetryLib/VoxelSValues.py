@@ -0,0 +1,146 @@
+import collections
+import threading
+
+import numpy as np
+
+try:
+    import scipy.fft as _fft
+    _nextFastLength = _fft.next_fast_len
+except ImportError:
+    # NumPy's FFT works as well, only without the fast-length padding and the plan cache of scipy
+    _fft = np.fft
+
+    def _nextFastLength(size):
+        return size
+
+
+# Beta energy deposition in water around a point source, approximated as exp(-mu * r) per spherical shell.
+# X90 is the radius (mm) containing 90% of the energy, the maximum range (mm) truncates the kernel.
+# These are approximations of the published dose point kernels, not tabulated voxel S-values.
+DOSE_KERNEL_NUCLIDES = {
+    "Y-90": {"x90MM": 5.3, "maxRangeMM": 11.0},
+    "Ho-166": {"x90MM": 4.1, "maxRangeMM": 8.7},
+}
+
+# Dose engines offered in the modules: (label, nuclide of the voxel kernel or None for local deposition)
+DOSE_ENGINES = [
+    ("Local deposition", None),
+    ("Approximate dose kernel (Y-90)", "Y-90"),
+    ("Approximate dose kernel (Ho-166)", "Ho-166"),
+]
+
+# Voxels per FFT slab; bounds the memory of one slab and its transform
+CONVOLUTION_SLAB_VOXELS = 1 << 23
+
+
+def buildVoxelKernel(nuclide, spacing, subsamples=4):
+    """
+    Fraction of the energy emitted in the central voxel that is absorbed in each voxel of a KJI grid
+    with the given spacing (mm, IJK order like vtkMRMLVolumeNode.GetSpacing). The kernel sums to 1.
+    Each voxel is integrated with subsamples^3 points; the central voxel gets the remaining energy,
+    which avoids sampling the singularity of the point kernel at r = 0.
+    """
+    if nuclide not in DOSE_KERNEL_NUCLIDES:
+        raise ValueError(f"No dose kernel for {nuclide}. Available: {', '.join(DOSE_KERNEL_NUCLIDES)}.")
+    x90MM = DOSE_KERNEL_NUCLIDES[nuclide]["x90MM"]
+    maxRangeMM = DOSE_KERNEL_NUCLIDES[nuclide]["maxRangeMM"]
+    mu = np.log(10.0) / x90MM
+    spacingKJI = np.asarray(spacing, dtype=np.float64)[::-1]
+    radii = np.ceil(maxRangeMM / spacingKJI).astype(int)
+
+    # Sub-sample offsets inside one voxel, in units of the voxel size
+    fractions = (np.arange(subsamples) + 0.5) / subsamples - 0.5
+    voxelAxes = [np.arange(-radius, radius + 1) for radius in radii]
+    points = [(voxelAxis[:, np.newaxis] + fractions[np.newaxis, :]) * axisSpacing
+              for voxelAxis, axisSpacing in zip(voxelAxes, spacingKJI)]
+    k = points[0][:, np.newaxis, np.newaxis, :, np.newaxis, np.newaxis]
+    j = points[1][np.newaxis, :, np.newaxis, np.newaxis, :, np.newaxis]
+    i = points[2][np.newaxis, np.newaxis, :, np.newaxis, np.newaxis, :]
+    r = np.sqrt(k ** 2 + j ** 2 + i ** 2)
+
+    # Energy per volume of the truncated exponential shell model, normalized to 1 within the maximum range
+    with np.errstate(divide="ignore", invalid="ignore"):
+        density = mu * np.exp(-mu * r) / (4 * np.pi * r ** 2 * (1 - np.exp(-mu * maxRangeMM)))
+    density[r > maxRangeMM] = 0.0
+    kernel = density.mean(axis=(3, 4, 5)) * np.prod(spacingKJI)
+
+    center = tuple(radii)
+    kernel[center] = 0.0
+    kernel[center] = max(1.0 - kernel.sum(), 0.0)
+    return kernel / kernel.sum()
+
+
+class VoxelKernelCache:
+    """
+    Voxel kernels by nuclide and spacing, and the FFTs of recently used kernels by transform shape.
+    """
+
+    def __init__(self, maximumTransforms=2):
+        self._kernels = {}
+        self._transforms = collections.OrderedDict()
+        self._maximumTransforms = maximumTransforms
+        self._lock = threading.Lock()
+
+    def kernel(self, nuclide, spacing):
+        key = (nuclide, tuple(round(float(s), 4) for s in spacing))
+        with self._lock:
+            if key not in self._kernels:
+                self._kernels[key] = buildVoxelKernel(nuclide, spacing)
+            return key, self._kernels[key]
+
+    def transform(self, kernelKey, kernel, shape):
+        key = (kernelKey, shape)
+        with self._lock:
+            if key in self._transforms:
+                self._transforms.move_to_end(key)
+                return self._transforms[key]
+            transform = _fft.rfftn(kernel.astype(np.float32), shape, axes=(0, 1, 2))
+            self._transforms[key] = transform
+            while len(self._transforms) > self._maximumTransforms:
+                self._transforms.popitem(last=False)
+            return transform
+
+    def clear(self):
+        with self._lock:
+            self._kernels.clear()
+            self._transforms.clear()
+
+
+# Shared by all dose calculations of the session
+voxelKernelCache = VoxelKernelCache()
+
+
+def convolveWithDoseKernel(array, nuclide, spacing, out=None, slabVoxels=CONVOLUTION_SLAB_VOXELS, cache=None):
+    """
+    Redistribute the locally deposited values of array (KJI) with the voxel kernel of a nuclide.
+    The linear convolution is computed with FFTs slab by slab along K (overlap-add), so only one padded
+    slab is transformed at a time. out must not share memory with array.
+    """
+    if cache is None:
+        cache = voxelKernelCache
+    kernelKey, kernel = cache.kernel(nuclide, spacing)
+    radii = [size // 2 for size in kernel.shape]
+    if out is None:
+        out = np.zeros(array.shape, dtype=np.float32)
+    elif np.shares_memory(out, array):
+        raise ValueError("The convolution output must not share memory with its input.")
+    else:
+        out[...] = 0
+
+    kSize, jSize, iSize = array.shape
+    slabThickness = int(max(1, min(kSize, slabVoxels // max(jSize * iSize, 1))))
+    shape = tuple(_nextFastLength(size + 2 * radius) for size, radius in
+                  zip((slabThickness, jSize, iSize), radii))
+    transform = cache.transform(kernelKey, kernel, shape)
+
+    for k0 in range(0, kSize, slabThickness):
+        k1 = min(k0 + slabThickness, kSize)
+        slabTransform = _fft.rfftn(array[k0:k1].astype(np.float32, copy=False), shape, axes=(0, 1, 2))
+        slab = _fft.irfftn(slabTransform * transform, shape, axes=(0, 1, 2))
+        # The full convolution of the slab starts radius voxels before it along every axis
+        outputStart = k0 - radii[0]
+        first = max(outputStart, 0)
+        last = min(k1 + radii[0], kSize)
+        out[first:last] += slab[first - outputStart:last - outputStart,
+                                radii[1]:radii[1] + jSize, radii[2]:radii[2] + iSize]
+    return out
@@ -0,0 +1,270 @@
+"""
+Behaviour shared by the widgets of the dosimetry modules. The mixins use Qt and the MRML scene,
+so this module is only imported by the widgets and is not part of the package namespace.
+"""
+
+import logging
+
+import numpy as np
+import qt
+import slicer
+import vtk
+
+from .BackgroundJobs import releaseOutputVolume
+from .Isodose import computeIsodoseRegions, parseIsodoseLevels
+from .LabelmapCache import getUnionMask
+from .OutputVolumes import finishOutputVolume, prepareOutputVolume
+from .Parameters import computeVoxelVolumeML
+from .Profiling import StageTimer, timedStage
+from .Radiobiology import BiologicalDoseMaps, TissueParameters
+from .SegmentLabelmaps import createIsodoseSegments, getSegmentIDs, getSegmentMasks
+
+
+class BackgroundJobWidgetMixin:
+    """
+    Runs BackgroundJobs and polls them from the main thread. The widget provides progressBar,
+    calculateButton and cancelButton and calls setupBackgroundJobs() in setup().
+    """
+
+    def setupBackgroundJobs(self):
+        self.job = None
+        self.jobPollTimer = qt.QTimer()
+        self.jobPollTimer.setInterval(100)
+        self.jobPollTimer.connect('timeout()', self.onJobPollTimeout)
+        self.cancelButton.connect('clicked(bool)', self.onCancelButton)
+
+    def runJob(self, job, outputVolumeID, timer, onFinished):
+        """
+        Start a background job and poll it from the main thread. onFinished(job) is called on the
+        main thread if the job succeeded.
+        """
+        self.job = job
+        self.jobOutputVolumeID = outputVolumeID
+        self.jobStageTimer = timer
+        self.jobFinishedCallback = onFinished
+        self.setCalculationRunning(True)
+        job.start()
+        self.jobPollTimer.start()
+
+    def onJobPollTimeout(self):
+        job = self.job
+        if job is None:
+            self.jobPollTimer.stop()
+            return
+        self.progressBar.value = int(job.progress * 100)
+        self.progressBar.format = f"{job.stageName or 'Starting'}: %p%"
+        if not job.done:
+            return
+
+        self.jobPollTimer.stop()
+        self.job = None
+        try:
+            if job.error is None:
+                self.jobFinishedCallback(job)
+        except Exception as e:
+            job.error = e
+        finally:
+            releaseOutputVolume(self.jobOutputVolumeID)
+            self.setCalculationRunning(False)
+
+        timer = self.jobStageTimer
+        if job.error is not None:
+            timer.error = f"{type(job.error).__name__}: {job.error}"
+        timer.finish()
+        if job.cancelled:
+            self.progressBar.value = 0
+            self.progressBar.format = "Cancelled"
+            logging.info("Dose calculation cancelled.")
+        elif job.error is not None:
+            self.progressBar.value = 0
+            self.progressBar.format = "Failed"
+            slicer.util.errorDisplay(f"Dose calculation failed: {job.error}")
+        else:
+            self.progressBar.format = "Done"
+
+    def setCalculationRunning(self, running):
+        self.calculateButton.enabled = not running
+        self.cancelButton.enabled = running
+
+    def onCancelButton(self):
+        if self.job is not None:
+            self.job.cancel()
+            self.progressBar.format = "Cancelling..."
+
+    def cleanup(self):
+        if self.job is not None:
+            self.job.cancel()
+            self.job.wait()
+            self.jobPollTimer.stop()
+            releaseOutputVolume(self.jobOutputVolumeID)
+            self.job = None
+        super().cleanup()
+
+
+class RadiobiologyWidgetMixin:
+    """
+    Tissue parameter rows, BED and EQD2 maps of the dose map in the output volume. The widget provides
+    halfLifeSpinBox, tumourSegmentSelector, tumourTissueWidgets and normalTissueWidgets (from createTissueRows),
+    outputVolumeSelector and segmentationSelector.
+    """
+
+    def createTissueRows(self, formLayout, tissueName, tissue):
+        """
+        Add alpha/beta, repair half-time and alpha spin boxes of a tissue and return them in that order.
+        """
+        spinBoxes = []
+        for label, value, maximum, decimals in [("Alpha/Beta (Gy)", tissue.alphaBetaGy, 100.0, 2),
+                                                ("Repair Half-Time (h)", tissue.repairHalfTimeHours, 100.0, 2),
+                                                ("Alpha (1/Gy)", tissue.alphaPerGy, 10.0, 4)]:
+            spinBox = qt.QDoubleSpinBox()
+            spinBox.setDecimals(decimals)
+            spinBox.setRange(10 ** -decimals, maximum)
+            spinBox.setValue(value)
+            formLayout.addRow(f"{tissueName} {label}: ", spinBox)
+            spinBoxes.append(spinBox)
+        return spinBoxes
+
+    def getTissueParameters(self, widgets):
+        alphaBetaSpinBox, repairHalfTimeSpinBox, alphaSpinBox = widgets
+        return TissueParameters(alphaBetaGy=alphaBetaSpinBox.value, repairHalfTimeHours=repairHalfTimeSpinBox.value,
+                                alphaPerGy=alphaSpinBox.value)
+
+    def getSegmentTissues(self):
+        """
+        {segmentID: TissueParameters} of the tumour segments; all other segments are normal liver.
+        """
+        tumourTissue = self.getTissueParameters(self.tumourTissueWidgets)
+        return {segmentID: tumourTissue for segmentID in self.tumourSegmentSelector.selectedSegmentIDs()}
+
+    def getRadiobiologyReportParameters(self):
+        """
+        Report lines with the half-life and the tissue parameters used for BED, EQD2 and EUD.
+        """
+        parameters = [("Half-Life", f"{self.halfLifeSpinBox.value:.2f} h")]
+        for tissueName, widgets in [("Tumour", self.tumourTissueWidgets), ("Normal Liver", self.normalTissueWidgets)]:
+            tissue = self.getTissueParameters(widgets)
+            parameters.append((f"{tissueName} Tissue", f"alpha/beta {tissue.alphaBetaGy:.2f} Gy, repair half-time "
+                                                      f"{tissue.repairHalfTimeHours:.2f} h, alpha {tissue.alphaPerGy:.4f} 1/Gy"))
+        return parameters
+
+    def onShowBedClicked(self):
+        self.onShowBiologicalDoseMap("BED")
+
+    def onShowEqd2Clicked(self):
+        self.onShowBiologicalDoseMap("EQD2")
+
+    def onShowBiologicalDoseMap(self, kind):
+        """
+        Materialise the BED or EQD2 map of the dose map in the output volume into its own volume and show it.
+        """
+        outputVolumeNode = self.outputVolumeSelector.currentNode()
+        segmentationNode = self.segmentationSelector.currentNode()
+        if not outputVolumeNode or outputVolumeNode.GetAttribute("DicomRtImport.DoseVolume") != "1":
+            slicer.util.errorDisplay("Calculate the dose map first.")
+            return
+        try:
+            doseArray = slicer.util.arrayFromVolume(outputVolumeNode)
+            tumourSegmentIDs = list(self.tumourSegmentSelector.selectedSegmentIDs()) if segmentationNode else []
+            tumourMask = None
+            if tumourSegmentIDs:
+                tumourMask = getUnionMask(getSegmentMasks(segmentationNode, tumourSegmentIDs, outputVolumeNode).values())
+            maps = BiologicalDoseMaps(doseArray, self.halfLifeSpinBox.value, tumourMask,
+                                      self.getTissueParameters(self.tumourTissueWidgets),
+                                      self.getTissueParameters(self.normalTissueWidgets))
+
+            mapName = f"{kind} Map (Gy)"
+            mapVolumeNode = slicer.mrmlScene.GetFirstNodeByName(mapName)
+            if mapVolumeNode is None or mapVolumeNode is outputVolumeNode:
+                mapVolumeNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLScalarVolumeNode", mapName)
+            mapArray = prepareOutputVolume(outputVolumeNode, mapVolumeNode, np.float32)
+            finishOutputVolume(mapVolumeNode, maps.materialize(kind, out=mapArray))
+        except Exception as e:
+            slicer.util.errorDisplay(f"{kind} map failed: {e}")
+            return
+        slicer.util.setSliceViewerLayers(foreground=mapVolumeNode, foregroundOpacity=0.5)
+
+
+class IsodoseWidgetMixin:
+    """
+    Isodose segments and the isodose region table of the dose map in the output volume. The widget provides
+    isodoseLevelsLineEdit, isodoseTable, isodoseSegmentationNodeID, outputVolumeSelector, segmentationSelector
+    and getSegmentOversampling().
+    """
+
+    def onCreateIsodoseClicked(self):
+        outputVolumeNode = self.outputVolumeSelector.currentNode()
+        if not outputVolumeNode or outputVolumeNode.GetAttribute("DicomRtImport.DoseVolume") != "1":
+            slicer.util.errorDisplay("Calculate the dose map first.")
+            return
+        try:
+            with StageTimer("IsodoseSegments") as timer:
+                self.createIsodoseSegmentsFromDose(outputVolumeNode, self.segmentationSelector.currentNode(), timer)
+        except Exception as e:
+            slicer.util.errorDisplay(f"Isodose segments failed: {e}")
+
+    def createIsodoseSegmentsFromDose(self, outputVolumeNode, segmentationNode, timer=None):
+        """
+        Digitise the dose map against all isodose levels at once, write the isodose segments and
+        show their volumes and their overlap with the segments of the dose calculation.
+        """
+        levels = parseIsodoseLevels(self.isodoseLevelsLineEdit.text)
+        segmentMasks = {}
+        if segmentationNode:
+            with timedStage(timer, "labelmapExport"):
+                segmentMasks = getSegmentMasks(segmentationNode, getSegmentIDs(segmentationNode.GetSegmentation()),
+                                               outputVolumeNode, oversampling=self.getSegmentOversampling())
+        with timedStage(timer, "isodoseRegions"):
+            regions = computeIsodoseRegions(slicer.util.arrayFromVolume(outputVolumeNode), levels,
+                                            computeVoxelVolumeML(outputVolumeNode.GetSpacing()), segmentMasks)
+        with timedStage(timer, "isodoseSegments"):
+            isodoseSegmentationNode = slicer.mrmlScene.GetNodeByID(self.isodoseSegmentationNodeID) if self.isodoseSegmentationNodeID else None
+            isodoseSegmentationNode = createIsodoseSegments(regions, outputVolumeNode, isodoseSegmentationNode)
+            self.isodoseSegmentationNodeID = isodoseSegmentationNode.GetID()
+
+        segmentNames = [segmentationNode.GetSegmentation().GetSegment(segmentID).GetName() for segmentID in regions.segmentIDs]
+        self.isodoseTable.setRowCount(0)
+        self.isodoseTable.setColumnCount(2 + len(segmentNames))
+        self.isodoseTable.setHorizontalHeaderLabels(["Level (Gy)", "Volume (mL)"] + [f"{name} (%)" for name in segmentNames])
+        self.isodoseTable.setRowCount(len(regions.levelsGy))
+        overlapPercent = regions.segmentOverlapPercent
+        for row, (levelGy, volumeML) in enumerate(zip(regions.levelsGy, regions.volumesML)):
+            values = [levelGy, volumeML] + list(overlapPercent[:, row])
+            for column, value in enumerate(values):
+                self.isodoseTable.setItem(row, column, qt.QTableWidgetItem(f"{value:.2f}"))
+
+
+class SegmentObserverWidgetMixin:
+    """
+    Records the segments edited in the selected segmentation, so a calculation only recomputes the
+    statistics of those segments. The widget calls setupSegmentObserver() in setup() and
+    observeSegmentation() when another segmentation is selected.
+    """
+
+    def setupSegmentObserver(self, segmentationNode):
+        self.editedSegmentIDs = set()
+        self.observedSegmentationNode = None
+        self.segmentationObserverTags = []
+        self.observeSegmentation(segmentationNode)
+
+    def observeSegmentation(self, segmentationNode):
+        """
+        Record the segments that are edited in segmentationNode, e.g. in Segment Editor.
+        """
+        if self.observedSegmentationNode is not None:
+            for tag in self.segmentationObserverTags:
+                self.observedSegmentationNode.RemoveObserver(tag)
+        self.observedSegmentationNode = segmentationNode
+        self.segmentationObserverTags = []
+        self.editedSegmentIDs = set()
+        if segmentationNode is not None:
+            for event in (slicer.vtkSegmentation.SegmentModified, slicer.vtkSegmentation.SegmentAdded,
+                          slicer.vtkSegmentation.SegmentRemoved):
+                self.segmentationObserverTags.append(segmentationNode.AddObserver(event, self.onSegmentEdited))
+
+    @vtk.calldata_type(vtk.VTK_STRING)
+    def onSegmentEdited(self, caller, event, segmentID):
+        self.editedSegmentIDs.add(segmentID)
+
+    def cleanup(self):
+        self.observeSegmentation(None)
+        super().cleanup()
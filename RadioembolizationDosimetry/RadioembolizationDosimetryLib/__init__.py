@@ -0,0 +1,19 @@
+from .Parameters import *
+from .SegmentStatistics import *
+from .DoseVolumeHistograms import *
+from .Isodose import *
+from .LabelmapCache import *
+from .SegmentLabelmaps import *
+from .Masking import *
+from .VoxelSValues import *
+from .OutputVolumes import *
+from .Profiling import *
+from .BackgroundJobs import *
+from .RelativeDosimetry import *
+from .AbsoluteDosimetry import *
+from .TimeActivity import *
+from .LungShunt import *
+from .PartitionModel import *
+from .Uncertainty import *
+from .Radiobiology import *
+from .Reports import *
@@ -0,0 +1,76 @@
+"""
+Voxel kernels and the overlap-add FFT convolution, compared with a direct convolution. The tests need only NumPy:
+
+    python DoseKernelTest.py
+"""
+
+import os
+import sys
+import unittest
+
+import numpy as np
+
+# The library lives next to the module script, two folders up
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from DosimetryTestData import SHAPE, makePhantom  # noqa: E402
+from RadioembolizationDosimetryLib import (  # noqa: E402
+    VoxelKernelCache,
+    convolveWithDoseKernel,
+)
+
+
+class DoseKernelConvolutionTest(unittest.TestCase):
+
+    def directConvolution(self, array, kernel):
+        """
+        Linear convolution cropped to the input grid, one shifted kernel per non-zero voxel.
+        """
+        radii = [size // 2 for size in kernel.shape]
+        padded = np.zeros([size + 2 * radius for size, radius in zip(array.shape, radii)])
+        for k, j, i in zip(*np.nonzero(array)):
+            padded[k:k + kernel.shape[0], j:j + kernel.shape[1], i:i + kernel.shape[2]] += array[k, j, i] * kernel
+        return padded[radii[0]:radii[0] + array.shape[0], radii[1]:radii[1] + array.shape[1], radii[2]:radii[2] + array.shape[2]]
+
+    def setUp(self):
+        spect, liverMask, _ = makePhantom()
+        self.array = np.where(liverMask, spect, 0).astype(np.float32)
+        self.spacing = (3.0, 4.0, 5.0)
+        self.cache = VoxelKernelCache()
+
+    def test_kernelSumsToOne(self):
+        _, kernel = self.cache.kernel("Y-90", self.spacing)
+        self.assertAlmostEqual(kernel.sum(), 1.0)
+        # 11 mm maximum range on 5, 4 and 3 mm along K, J and I
+        self.assertEqual(kernel.shape, (7, 7, 9))
+        # The kernel is symmetric around the source voxel
+        np.testing.assert_allclose(kernel, kernel[::-1, ::-1, ::-1], rtol=1e-12)
+
+    def test_matchesDirectConvolution(self):
+        _, kernel = self.cache.kernel("Y-90", self.spacing)
+        expected = self.directConvolution(self.array.astype(np.float64), kernel)
+        actual = convolveWithDoseKernel(self.array, "Y-90", self.spacing, cache=self.cache)
+        np.testing.assert_allclose(actual, expected, rtol=1e-4, atol=1e-3)
+
+    def test_overlapAddSlabs(self):
+        # Slabs of two slices, so every slice receives contributions from neighbouring slabs
+        _, kernel = self.cache.kernel("Ho-166", self.spacing)
+        expected = self.directConvolution(self.array.astype(np.float64), kernel)
+        actual = convolveWithDoseKernel(self.array, "Ho-166", self.spacing, slabVoxels=2 * SHAPE[1] * SHAPE[2], cache=self.cache)
+        np.testing.assert_allclose(actual, expected, rtol=1e-4, atol=1e-3)
+
+    def test_outputBuffer(self):
+        out = np.full(SHAPE, 7.0, dtype=np.float32)
+        expected = convolveWithDoseKernel(self.array, "Y-90", self.spacing, cache=self.cache)
+        self.assertIs(convolveWithDoseKernel(self.array, "Y-90", self.spacing, out=out, cache=self.cache), out)
+        np.testing.assert_allclose(out, expected, rtol=1e-6)
+        with self.assertRaises(ValueError):
+            convolveWithDoseKernel(self.array, "Y-90", self.spacing, out=self.array, cache=self.cache)
+
+    def test_unknownNuclide(self):
+        with self.assertRaises(ValueError):
+            convolveWithDoseKernel(self.array, "I-131", self.spacing, cache=self.cache)
+
+
+if __name__ == "__main__":
+    unittest.main()
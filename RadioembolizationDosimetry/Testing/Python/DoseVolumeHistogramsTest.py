@@ -0,0 +1,90 @@
+"""
+Dose-volume histograms and Dx/Vx metrics, compared with np.histogram of each segment. The tests need only NumPy:
+
+    python DoseVolumeHistogramsTest.py
+"""
+
+import importlib
+import os
+import sys
+import unittest
+from unittest import mock
+
+import numpy as np
+
+# The library lives next to the module script, two folders up
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from DosimetryTestData import makeFractions, makeLabelLayers, makePhantom  # noqa: E402
+from RadioembolizationDosimetryLib import (  # noqa: E402
+    FractionalSegmentMask,
+    SegmentMask,
+    computeDoseVolumeHistograms,
+)
+
+# The package namespace re-exports the classes, which hide the modules of the same name
+DoseVolumeHistogramsModule = importlib.import_module("RadioembolizationDosimetryLib.DoseVolumeHistograms")
+
+
+class DoseVolumeHistogramTest(unittest.TestCase):
+
+    def setUp(self):
+        self.spect, self.liverMask, self.segmentMasks = makePhantom()
+        self.labelLayers = makeLabelLayers(self.segmentMasks, [["Tumour_1", "Tumour_2"], ["Segment_3"]])
+        self.maxValue = float(self.spect.max())
+
+    def assertMatchesHistograms(self, histograms, numberOfBins):
+        edges = np.arange(numberOfBins + 1) * (self.maxValue / numberOfBins)
+        np.testing.assert_allclose(histograms.binEdges, edges)
+        for index, mask in enumerate(self.segmentMasks.values()):
+            expected, _ = np.histogram(self.spect[mask], bins=edges)
+            np.testing.assert_array_equal(histograms.voxelCounts[index], expected)
+            # The cumulative histogram is the fraction of voxels at or above each bin edge
+            values = self.spect[mask]
+            np.testing.assert_allclose(histograms.cumulative[index, :-1],
+                                       [np.mean(values >= edge) for edge in edges[:-1]])
+
+    def test_labelLayers(self):
+        histograms = computeDoseVolumeHistograms(self.spect, self.labelLayers, numberOfBins=50)
+        self.assertMatchesHistograms(histograms, 50)
+
+    def test_labelLayersInChunks(self):
+        with mock.patch.object(DoseVolumeHistogramsModule, "STATISTICS_CHUNK_SIZE", 41):
+            histograms = computeDoseVolumeHistograms(self.spect, self.labelLayers, numberOfBins=50)
+        self.assertMatchesHistograms(histograms, 50)
+
+    def test_segmentMasks(self):
+        masks = {segmentID: SegmentMask(mask) for segmentID, mask in self.segmentMasks.items()}
+        histograms = computeDoseVolumeHistograms(self.spect, masks, numberOfBins=50, maxValue=self.maxValue)
+        self.assertMatchesHistograms(histograms, 50)
+
+    def test_metrics(self):
+        histograms = computeDoseVolumeHistograms(self.spect, self.labelLayers, numberOfBins=2000)
+        binWidth = self.maxValue / 2000
+        metrics = histograms.metrics(("D50", "D90", "V100"))
+        for index, mask in enumerate(self.segmentMasks.values()):
+            values = np.sort(self.spect[mask].astype(np.float64))[::-1]
+            for percent in (50, 90):
+                # The hottest percent of the voxels receives at least the dose of its coldest voxel
+                coldestHot = values[int(np.ceil(values.size * percent / 100.0)) - 1]
+                self.assertLessEqual(abs(metrics[f"D{percent}"][index] - coldestHot), 2 * binWidth)
+            np.testing.assert_allclose(metrics["V100"][index], np.mean(values >= 100.0) * 100.0, atol=100.0 / values.size)
+
+    def test_scaled(self):
+        histograms = computeDoseVolumeHistograms(self.spect, self.labelLayers, numberOfBins=50)
+        scaled = histograms.scaled(2.0)
+        np.testing.assert_allclose(scaled.doseAtVolume(50), histograms.doseAtVolume(50) * 2.0)
+
+    def test_fractionalSegmentMasks(self):
+        fractions = [makeFractions(mask) for mask in self.segmentMasks.values()]
+        masks = {segmentID: FractionalSegmentMask(value) for segmentID, value in zip(self.segmentMasks, fractions)}
+        histograms = computeDoseVolumeHistograms(self.spect, masks, numberOfBins=50, maxValue=self.maxValue)
+        edges = np.arange(51) * (self.maxValue / 50)
+        for index, weights in enumerate(fractions):
+            touched = weights > 0
+            expected, _ = np.histogram(self.spect[touched], bins=edges, weights=weights[touched].astype(np.float64))
+            np.testing.assert_allclose(histograms.voxelCounts[index], expected, rtol=1e-6)
+
+
+if __name__ == "__main__":
+    unittest.main()
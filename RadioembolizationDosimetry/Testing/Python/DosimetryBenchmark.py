@@ -0,0 +1,197 @@
+"""
+Benchmark of the dosimetry hot paths on synthetic phantoms.
+
+Usage (plain Python, no Slicer needed):
+
+    python DosimetryBenchmark.py --sizes 128 256 --segments 1 10 50 --overlap 0 0.3 --output benchmark.json
+
+Each phantom is a smooth background with hot spheres, an ellipsoid liver, a lung region and
+spherical segments placed in label layers the way Slicer shares them. The stages mirror what
+the modules do per calculation: liver masking, cloning the output, rescaling to dose, per-segment
+statistics, lung shunt sums, total activity sums, absolute dosimetry, the update after one segment
+is edited, dose kernel convolution and report generation.
+Minimum and median wall times of every stage are written to a JSON file.
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+import numpy as np
+
+# The library lives next to the module script, two folders up
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from RadioembolizationDosimetryLib import (  # noqa: E402
+    DosimetryParameters,
+    SegmentMask,
+    calculateAbsoluteDose,
+    calculateLungShuntFraction,
+    computeDoseVolumeHistograms,
+    computeSegmentStatistics,
+    computeTotalActivityMBq,
+    convolveWithDoseKernel,
+    formatRtfReport,
+    maskArray,
+    relativeDoseRescaleFactor,
+    updateAbsoluteDoseSegments,
+)
+
+
+SPACING = (4.0, 4.0, 4.0)
+
+
+def _sphere(grid, center, radius):
+    k, j, i = grid
+    return (k - center[0]) ** 2 + (j - center[1]) ** 2 + (i - center[2]) ** 2 <= radius ** 2
+
+
+def makePhantom(size, segmentCount, overlap, dtype, seed=0):
+    """
+    Synthetic SPECT, liver and lung masks and segment label layers on a size^3 grid.
+    overlap (0-1) is the fraction of the segment radius by which neighbouring segments overlap.
+    """
+    rng = np.random.default_rng(seed)
+    grid = np.ogrid[:size, :size, :size]
+    k, j, i = grid
+
+    # Liver ellipsoid in the lower half, lungs above it
+    liverMask = ((k - 0.35 * size) / (0.25 * size)) ** 2 + ((j - 0.5 * size) / (0.3 * size)) ** 2 + ((i - 0.45 * size) / (0.35 * size)) ** 2 <= 1
+    lungMask = ((k - 0.75 * size) / (0.15 * size)) ** 2 + ((j - 0.5 * size) / (0.35 * size)) ** 2 + ((i - 0.5 * size) / (0.4 * size)) ** 2 <= 1
+
+    # Smooth background with noise and hot spheres
+    spect = 100.0 + 50.0 * liverMask + 5.0 * lungMask
+    spect = spect + rng.normal(0.0, 5.0, (size, size, size))
+    for _ in range(5):
+        center = rng.uniform(0.25 * size, 0.45 * size, 3)
+        spect += 400.0 * _sphere(grid, center, 0.04 * size)
+    spect = np.clip(spect, 0, None).astype(dtype)
+
+    # Segments on a line through the liver; the spacing of their centers sets the overlap
+    radius = max(2.0, 0.2 * size / max(segmentCount, 1) ** (1 / 3))
+    step = 2 * radius * (1 - overlap)
+    segments = []
+    for index in range(segmentCount):
+        offset = (index - (segmentCount - 1) / 2) * step
+        center = (0.35 * size, 0.5 * size + (offset % (0.5 * size)) - 0.25 * size,
+                  0.45 * size + (index % 7 - 3) * 0.05 * size)
+        segments.append((f"Segment_{index + 1}", _sphere(grid, center, radius)))
+
+    # Greedy layer assignment: a segment shares a layer with segments it does not overlap
+    layers = []
+    for segmentID, mask in segments:
+        for layer in layers:
+            if not np.any(layer["occupied"] & mask):
+                break
+        else:
+            layer = {"occupied": np.zeros((size, size, size), dtype=bool), "segments": []}
+            layers.append(layer)
+        layer["occupied"] |= mask
+        layer["segments"].append((segmentID, mask))
+
+    labelLayers = []
+    for layer in layers:
+        labelArray = np.zeros((size, size, size), dtype=np.uint16)
+        for index, (segmentID, mask) in enumerate(layer["segments"]):
+            labelArray[mask] = index + 1
+        labelLayers.append((labelArray, [segmentID for segmentID, _ in layer["segments"]]))
+
+    return spect, liverMask, lungMask, labelLayers
+
+
+def timeStage(function, repeat):
+    times = []
+    for _ in range(repeat):
+        startTime = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - startTime)
+    return {"min": min(times), "median": statistics.median(times)}
+
+
+def benchmarkPhantom(size, segmentCount, overlap, dtype, repeat):
+    spect, liverMask, lungMask, labelLayers = makePhantom(size, segmentCount, overlap, dtype)
+    parameters = DosimetryParameters(activityMBq=2000.0, lungShuntFraction=0.05)
+    voxelVolumeML = (SPACING[0] * SPACING[1] * SPACING[2]) / 1000.0
+    masked = maskArray(spect, liverMask)
+    rescaleFactor = relativeDoseRescaleFactor(parameters.activityMBq, parameters.lungShuntFraction, float(np.sum(masked)),
+                                              voxelVolumeML, parameters.conversionFactor, parameters.densityGPerML)
+    doseArray = np.multiply(masked, rescaleFactor, out=np.empty(masked.shape, parameters.doseDtype), casting="unsafe")
+    convolvedArray = np.empty(masked.shape, np.float32)
+    segmentStatistics = computeSegmentStatistics(doseArray, labelLayers, voxelVolumeML)
+    segmentMasks = {segmentID: SegmentMask(labelArray == index + 1)
+                    for labelArray, segmentIDs in labelLayers for index, segmentID in enumerate(segmentIDs)}
+    segmentRows = [(segmentID, f"{dose:.2f}", f"{volume:.2f}", f"{activity:.2f}") for segmentID, dose, volume, activity in zip(
+        segmentStatistics.segmentIDs, segmentStatistics.means, segmentStatistics.volumes,
+        segmentStatistics.activities(parameters.conversionFactor, parameters.densityGPerML))]
+    absoluteResult = calculateAbsoluteDose(spect, SPACING, segmentMasks, parameters)
+    editedSegmentIDs = [segmentStatistics.segmentIDs[-1]]
+    reportParameters = [("Activity", f"{parameters.activityMBq:.2f} MBq"), ("Lung Shunt", "5.00%")]
+
+    stages = {
+        "mask": lambda: maskArray(spect, liverMask),
+        "clone": lambda: spect.copy(),
+        "rescale": lambda: np.multiply(masked, rescaleFactor, out=doseArray, casting="unsafe"),
+        "segmentStatistics": lambda: computeSegmentStatistics(doseArray, labelLayers, voxelVolumeML),
+        "segmentMaskStatistics": lambda: computeSegmentStatistics(doseArray, segmentMasks, voxelVolumeML),
+        "doseVolumeHistograms": lambda: computeDoseVolumeHistograms(doseArray, labelLayers),
+        "segmentMaskDoseVolumeHistograms": lambda: computeDoseVolumeHistograms(doseArray, segmentMasks),
+        "lsfSums": lambda: calculateLungShuntFraction(spect, liverMask, lungMask),
+        "totalActivity": lambda: computeTotalActivityMBq(spect, voxelVolumeML),
+        "absoluteDose": lambda: calculateAbsoluteDose(spect, SPACING, labelLayers, parameters),
+        "singleSegmentUpdate": lambda: updateAbsoluteDoseSegments(absoluteResult, segmentMasks, editedSegmentIDs,
+                                                                  SPACING, parameters),
+        "voxelSValueConvolution": lambda: convolveWithDoseKernel(doseArray, "Y-90", SPACING, out=convolvedArray),
+        "report": lambda: formatRtfReport("Benchmark", reportParameters, segmentRows, generated=""),
+    }
+    return {
+        "size": size,
+        "segments": segmentCount,
+        "overlap": overlap,
+        "dtype": np.dtype(dtype).name,
+        "layers": len(labelLayers),
+        "stages": {name: timeStage(function, repeat) for name, function in stages.items()},
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the dosimetry hot paths on synthetic phantoms.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[128, 256], help="matrix sizes (voxels per axis)")
+    parser.add_argument("--segments", type=int, nargs="+", default=[1, 10, 50], help="segment counts")
+    parser.add_argument("--overlap", type=float, nargs="+", default=[0.0, 0.3], help="segment overlap fractions")
+    parser.add_argument("--dtypes", nargs="+", default=["float32", "float64"], help="SPECT voxel types")
+    parser.add_argument("--repeat", type=int, default=3, help="repetitions per stage")
+    parser.add_argument("--output", default="DosimetryBenchmark.json", help="JSON results file")
+    args = parser.parse_args(argv)
+
+    runs = []
+    for size in args.sizes:
+        for segmentCount in args.segments:
+            for overlap in args.overlap:
+                for dtype in args.dtypes:
+                    run = benchmarkPhantom(size, segmentCount, overlap, dtype, args.repeat)
+                    runs.append(run)
+                    summary = ", ".join(f"{name} {times['median'] * 1000:.1f}" for name, times in run["stages"].items())
+                    print(f"{size}^3, {segmentCount} segments, overlap {overlap}, {dtype}: {summary} ms")
+
+    results = {
+        "environment": {
+            "python": sys.version.split()[0],
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "cpuCount": os.cpu_count(),
+        },
+        "repeat": args.repeat,
+        "runs": runs,
+    }
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
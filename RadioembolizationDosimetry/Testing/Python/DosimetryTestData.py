@@ -0,0 +1,75 @@
+"""
+Synthetic arrays shared by the dosimetry unit tests: a small SPECT phantom with a liver and
+overlapping segments, and the per-segment loop of the original relative dose calculation.
+"""
+
+import numpy as np
+
+
+SHAPE = (9, 10, 11)
+SPACING = (4.0, 4.0, 4.0)
+VOXEL_VOLUME_ML = 0.064
+
+
+def makePhantom(seed=0):
+    """
+    Random counts, an ellipsoid liver and three spheres in two label layers: Tumour_1 and Tumour_2 lie
+    inside the liver and do not overlap, Segment_3 overlaps Tumour_1 and sticks out of the liver.
+    Returns (spect, liverMask, segmentMasks) with segmentMasks a {segmentID: boolean array} dict.
+    """
+    rng = np.random.default_rng(seed)
+    k, j, i = np.ogrid[:SHAPE[0], :SHAPE[1], :SHAPE[2]]
+    liverMask = ((k - 4) / 3.6) ** 2 + ((j - 4.5) / 4.2) ** 2 + ((i - 5) / 4.8) ** 2 <= 1
+    segmentMasks = {
+        "Tumour_1": (k - 4) ** 2 + (j - 3) ** 2 + (i - 3) ** 2 <= 2.2 ** 2,
+        "Tumour_2": (k - 4) ** 2 + (j - 6) ** 2 + (i - 7) ** 2 <= 1.5 ** 2,
+        "Segment_3": (k - 5) ** 2 + (j - 2) ** 2 + (i - 2) ** 2 <= 2.5 ** 2,
+    }
+    spect = rng.uniform(10.0, 100.0, SHAPE) + 200.0 * segmentMasks["Tumour_1"] + 100.0 * segmentMasks["Tumour_2"]
+    return spect.astype(np.float32), liverMask, segmentMasks
+
+
+def makeLabelLayers(segmentMasks, layerSegmentIDs):
+    """
+    (labelArray, segmentIDs) layers; segments of one layer must not overlap.
+    """
+    labelLayers = []
+    for segmentIDs in layerSegmentIDs:
+        labelArray = np.zeros(SHAPE, dtype=np.uint8)
+        for index, segmentID in enumerate(segmentIDs):
+            labelArray[segmentMasks[segmentID]] = index + 1
+        labelLayers.append((labelArray, list(segmentIDs)))
+    return labelLayers
+
+
+def makeFractions(mask, seed=1):
+    """
+    Partial-volume fractions: 1 inside the mask and random fractions on a one voxel rim around it.
+    """
+    rng = np.random.default_rng(seed)
+    rim = np.zeros(mask.shape, dtype=bool)
+    for axis in range(mask.ndim):
+        rim |= np.roll(mask, 1, axis) | np.roll(mask, -1, axis)
+    rim &= ~mask
+    fractions = mask.astype(np.float32)
+    fractions[rim] = rng.uniform(0.05, 0.95, int(np.count_nonzero(rim)))
+    return fractions
+
+
+def baselineRelativeDose(spect, liverMask, segmentMasks, activityMBq, lungShuntFraction, parameters):
+    """
+    Per-segment loop of the original relative calculateDose: mask, rescale the full volume to the
+    mean liver dose, then average the dose inside each segment.
+    """
+    maskedArray = np.where(liverMask, spect, 0).astype(np.float64)
+    totalVolumeML = maskedArray.size * VOXEL_VOLUME_ML
+    meanInputValue = np.sum(maskedArray) / maskedArray.size
+    meanOutputDoseGy = (activityMBq * (1 - lungShuntFraction) / (totalVolumeML * parameters.densityGPerML)) * parameters.conversionFactor
+    doseArray = maskedArray * (meanOutputDoseGy / meanInputValue)
+    segmentDoses, segmentVolumes, segmentActivities = {}, {}, {}
+    for segmentID, mask in segmentMasks.items():
+        maskedDoseArray = doseArray[mask]
+        segmentDoses[segmentID] = np.mean(maskedDoseArray)
+        segmentVolumes[segmentID] = VOXEL_VOLUME_ML * maskedDoseArray.size
+        segmentActivities[segmentID] = (segmentVolumes[segmentID] * segmentDoses[segmentID] / parameters.conversionFactor) * parameters.densityGPerML
+    return doseArray, segmentDoses, segmentVolumes, segmentActivities
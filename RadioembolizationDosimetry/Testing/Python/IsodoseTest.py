@@ -0,0 +1,80 @@
+"""
+Isodose digitisation and segment overlaps, compared with one threshold per level. The tests need only NumPy:
+
+    python IsodoseTest.py
+"""
+
+import importlib
+import os
+import sys
+import unittest
+from unittest import mock
+
+import numpy as np
+
+# The library lives next to the module script, two folders up
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from DosimetryTestData import VOXEL_VOLUME_ML, makeFractions, makeLabelLayers, makePhantom  # noqa: E402
+from RadioembolizationDosimetryLib import (  # noqa: E402
+    FractionalSegmentMask,
+    SegmentMask,
+    computeIsodoseRegions,
+)
+
+# The package namespace re-exports the classes, which hide the modules of the same name
+IsodoseModule = importlib.import_module("RadioembolizationDosimetryLib.Isodose")
+
+
+class IsodoseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.spect, self.liverMask, self.segmentMasks = makePhantom()
+        self.dose = self.spect * 1.5
+        self.levels = [150.0, 60.0, 300.0]
+
+    def assertMatchesBruteForce(self, regions, segmentWeights):
+        levels = sorted(self.levels)
+        self.assertEqual(regions.levelsGy, levels)
+        np.testing.assert_array_equal(regions.levelIndices, sum((self.dose >= level).astype(np.uint8) for level in levels))
+        for levelIndex, level in enumerate(levels):
+            region = self.dose >= level
+            np.testing.assert_array_equal(regions.mask(levelIndex), region)
+            self.assertEqual(regions.voxelCounts[levelIndex], np.count_nonzero(region))
+            np.testing.assert_allclose(regions.volumesML[levelIndex], np.count_nonzero(region) * VOXEL_VOLUME_ML)
+            for segmentIndex, weights in enumerate(segmentWeights):
+                expected = np.sum(weights * region, dtype=np.float64)
+                np.testing.assert_allclose(regions.segmentVoxelCounts[segmentIndex, levelIndex], expected, rtol=1e-6)
+                np.testing.assert_allclose(regions.segmentOverlapPercent[segmentIndex, levelIndex],
+                                           expected * 100.0 / np.sum(weights, dtype=np.float64), rtol=1e-6)
+
+    def test_labelLayers(self):
+        labelLayers = makeLabelLayers(self.segmentMasks, [["Tumour_1", "Tumour_2"], ["Segment_3"]])
+        regions = computeIsodoseRegions(self.dose, self.levels, VOXEL_VOLUME_ML, labelLayers)
+        self.assertEqual(regions.segmentIDs, list(self.segmentMasks))
+        self.assertMatchesBruteForce(regions, list(self.segmentMasks.values()))
+
+    def test_labelLayersInChunks(self):
+        labelLayers = makeLabelLayers(self.segmentMasks, [["Tumour_1", "Tumour_2"], ["Segment_3"]])
+        with mock.patch.object(IsodoseModule, "STATISTICS_CHUNK_SIZE", 53):
+            regions = computeIsodoseRegions(self.dose, self.levels, VOXEL_VOLUME_ML, labelLayers)
+        self.assertMatchesBruteForce(regions, list(self.segmentMasks.values()))
+
+    def test_segmentMasks(self):
+        masks = {segmentID: SegmentMask(mask) for segmentID, mask in self.segmentMasks.items()}
+        regions = computeIsodoseRegions(self.dose, self.levels, VOXEL_VOLUME_ML, masks)
+        self.assertMatchesBruteForce(regions, list(self.segmentMasks.values()))
+
+    def test_withoutSegments(self):
+        regions = computeIsodoseRegions(self.dose, self.levels, VOXEL_VOLUME_ML)
+        self.assertMatchesBruteForce(regions, [])
+
+    def test_fractionalSegmentMasks(self):
+        fractions = [makeFractions(mask) for mask in self.segmentMasks.values()]
+        masks = {segmentID: FractionalSegmentMask(value) for segmentID, value in zip(self.segmentMasks, fractions)}
+        regions = computeIsodoseRegions(self.dose, self.levels, VOXEL_VOLUME_ML, masks)
+        self.assertMatchesBruteForce(regions, fractions)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,90 @@
+"""
+Bit-packed segment masks and the least-recently-used labelmap cache. The tests need only NumPy:
+
+    python LabelmapCacheTest.py
+"""
+
+import os
+import sys
+import unittest
+
+import numpy as np
+
+# The library lives next to the module script, two folders up
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from DosimetryTestData import SHAPE, makeFractions, makePhantom  # noqa: E402
+from RadioembolizationDosimetryLib import (  # noqa: E402
+    FractionalSegmentMask,
+    LabelmapCache,
+    SegmentMask,
+)
+
+
+class LabelmapCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        # Shifted copies of one sphere, so all masks take the same memory
+        _, _, segmentMasks = makePhantom()
+        self.masks = [SegmentMask(np.roll(segmentMasks["Tumour_1"], shift, axis=2)) for shift in range(3)]
+
+    def test_segmentMaskRoundTrip(self):
+        _, liverMask, segmentMasks = makePhantom()
+        for mask in [liverMask, np.zeros(SHAPE, dtype=bool)] + list(segmentMasks.values()):
+            segmentMask = SegmentMask(mask)
+            np.testing.assert_array_equal(segmentMask.toArray(), mask)
+            self.assertEqual(segmentMask.voxelCount, np.count_nonzero(mask))
+            self.assertEqual(segmentMask.sumValues(mask.astype(np.float64)), np.count_nonzero(mask))
+
+    def test_maskFromBlock(self):
+        # A mask built from a block of the grid and its offset equals the one built from the whole grid
+        _, _, segmentMasks = makePhantom()
+        fractions = makeFractions(segmentMasks["Tumour_2"])
+        block = ((1, 8), (3, 10), (4, 11))
+        region = tuple(slice(start, stop) for start, stop in block)
+        offset = tuple(start for start, _ in block)
+        for maskClass, array in [(SegmentMask, segmentMasks["Tumour_2"]), (FractionalSegmentMask, fractions)]:
+            expected = maskClass(array)
+            actual = maskClass(array[region], offset=offset, shape=SHAPE)
+            self.assertEqual(actual.shape, SHAPE)
+            self.assertEqual(actual.bounds, expected.bounds)
+            np.testing.assert_array_equal(actual.packedMask, expected.packedMask)
+            np.testing.assert_array_equal(actual.weights, expected.weights)
+        empty = FractionalSegmentMask(np.zeros((0, 0, 0), dtype=np.float32), shape=SHAPE)
+        self.assertEqual((empty.shape, empty.voxelCount, empty.volumeVoxels), (SHAPE, 0, 0.0))
+        np.testing.assert_array_equal(empty.toArray(), np.zeros(SHAPE, dtype=bool))
+
+    def test_regionWeights(self):
+        _, _, segmentMasks = makePhantom()
+        mask = segmentMasks["Segment_3"]
+        # A region that cuts the bounding box, and one that misses the segment
+        bounds = ((4, 9), (0, 3), (1, 11))
+        region = tuple(slice(start, stop) for start, stop in bounds)
+        np.testing.assert_array_equal(SegmentMask(mask).regionWeights(bounds), mask[region].astype(np.float32))
+        np.testing.assert_array_equal(SegmentMask(mask).regionWeights(((0, 1), (8, 10), (9, 11))), np.zeros((1, 2, 2)))
+
+    def test_leastRecentlyUsedEviction(self):
+        cache = LabelmapCache(memoryBudgetBytes=2 * self.masks[0].nbytes)
+        cache.put("a", self.masks[0])
+        cache.put("b", self.masks[1])
+        self.assertIs(cache.get("a"), self.masks[0])
+        cache.put("c", self.masks[2])
+        self.assertNotIn("b", cache)
+        self.assertIn("a", cache)
+        self.assertIn("c", cache)
+        self.assertEqual(cache.memoryUsedBytes, 2 * self.masks[0].nbytes)
+
+    def test_budget(self):
+        cache = LabelmapCache(memoryBudgetBytes=self.masks[0].nbytes - 1)
+        cache.put("a", self.masks[0])
+        self.assertEqual(len(cache), 0)
+        cache.memoryBudgetBytes = 3 * self.masks[0].nbytes
+        for key, mask in zip("abc", self.masks):
+            cache.put(key, mask)
+        cache.memoryBudgetBytes = self.masks[0].nbytes
+        self.assertEqual(len(cache), 1)
+        self.assertIn("c", cache)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,55 @@
+"""
+Lung shunt fraction sums, compared with a brute-force sum over the masks. The tests need only NumPy:
+
+    python LungShuntTest.py
+"""
+
+import os
+import sys
+import unittest
+
+import numpy as np
+
+# The library lives next to the module script, two folders up
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from DosimetryTestData import SHAPE, makeFractions, makePhantom  # noqa: E402
+from RadioembolizationDosimetryLib import (  # noqa: E402
+    FractionalSegmentMask,
+    SegmentMask,
+    calculateLungShuntFraction,
+)
+
+
+class LungShuntTest(unittest.TestCase):
+
+    def setUp(self):
+        self.spect, self.liverMask, segmentMasks = makePhantom()
+        # The lung overlaps the top of the liver, so some voxels count for both organs
+        self.lungMask = np.zeros(SHAPE, dtype=bool)
+        self.lungMask[6:] = True
+
+    def expected(self, liverWeights, lungWeights):
+        values = self.spect.astype(np.float64)
+        lungCounts = np.sum(values * lungWeights)
+        liverCounts = np.sum(values * liverWeights)
+        return lungCounts, liverCounts, lungCounts / (lungCounts + liverCounts) * 100
+
+    def test_booleanArrays(self):
+        actual = calculateLungShuntFraction(self.spect, self.liverMask, self.lungMask)
+        np.testing.assert_allclose(actual, self.expected(self.liverMask, self.lungMask), rtol=1e-9)
+
+    def test_segmentMasks(self):
+        actual = calculateLungShuntFraction(self.spect, SegmentMask(self.liverMask), SegmentMask(self.lungMask))
+        np.testing.assert_allclose(actual, self.expected(self.liverMask, self.lungMask), rtol=1e-9)
+
+    def test_fractionalSegmentMasks(self):
+        liverFractions = makeFractions(self.liverMask)
+        lungFractions = makeFractions(self.lungMask, seed=2)
+        actual = calculateLungShuntFraction(self.spect, FractionalSegmentMask(liverFractions), FractionalSegmentMask(lungFractions))
+        np.testing.assert_allclose(actual, self.expected(liverFractions.astype(np.float64), lungFractions.astype(np.float64)),
+                                   rtol=1e-6)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,42 @@
+"""
+In-memory masking that replaces the MaskScalarVolume CLI, compared with np.where. The tests need only NumPy:
+
+    python MaskingTest.py
+"""
+
+import os
+import sys
+import unittest
+
+import numpy as np
+
+# The library lives next to the module script, two folders up
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from DosimetryTestData import makeLabelLayers, makePhantom  # noqa: E402
+from RadioembolizationDosimetryLib import maskArray  # noqa: E402
+
+
+class MaskingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.spect, self.liverMask, self.segmentMasks = makePhantom()
+
+    def test_booleanMask(self):
+        masked = maskArray(self.spect, self.liverMask)
+        self.assertEqual(masked.dtype, self.spect.dtype)
+        np.testing.assert_array_equal(masked, np.where(self.liverMask, self.spect, 0))
+
+    def test_labelAndReplace(self):
+        # Like the CLI, only voxels of the given label are kept
+        labelArray, _ = makeLabelLayers(self.segmentMasks, [["Tumour_1", "Tumour_2"]])[0]
+        masked = maskArray(self.spect, labelArray, label=2, replace=-1)
+        np.testing.assert_array_equal(masked, np.where(self.segmentMasks["Tumour_2"], self.spect, -1))
+
+    def test_geometryMismatch(self):
+        with self.assertRaises(ValueError):
+            maskArray(self.spect, self.liverMask[1:])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,109 @@
+"""
+Partition-model activity planning, compared with the compartment doses of the dose map. The tests need only NumPy:
+
+    python PartitionModelTest.py
+"""
+
+import os
+import sys
+import unittest
+
+import numpy as np
+
+# The library lives next to the module script, two folders up
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from DosimetryTestData import SPACING, makeFractions, makePhantom  # noqa: E402
+from RadioembolizationDosimetryLib import (  # noqa: E402
+    DosimetryParameters,
+    FractionalSegmentMask,
+    PartitionConstraints,
+    SegmentMask,
+    computeRelativeDoseState,
+    planPartitionActivity,
+)
+
+
+class PartitionModelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.spect, self.liverMask, self.phantomMasks = makePhantom()
+        self.tumourMasks = {segmentID: self.phantomMasks[segmentID] & self.liverMask for segmentID in ("Tumour_1", "Tumour_2")}
+        masks = dict(self.tumourMasks, Segment_3=self.phantomMasks["Segment_3"], Liver=self.liverMask)
+        self.segmentMasks = {segmentID: SegmentMask(mask) for segmentID, mask in masks.items()}
+        self.parameters = DosimetryParameters(lungShuntFraction=0.1, doseDtype="float64")
+        self.state = computeRelativeDoseState(self.spect, SPACING, self.liverMask, self.segmentMasks)
+
+    def doseArray(self, activityMBq):
+        return self.state.doseArray(activityMBq, self.parameters.lungShuntFraction, self.parameters.conversionFactor,
+                                    self.parameters.densityGPerML, dtype=np.float64)
+
+    def test_compartmentDoses(self):
+        plan = planPartitionActivity(self.state, "Liver", self.parameters, PartitionConstraints(),
+                                     ["Tumour_1", "Tumour_2"], self.segmentMasks)
+        self.assertEqual(plan.tumourSegmentIDs, ["Tumour_1", "Tumour_2"])
+        activityMBq = 20.0
+        doseArray = self.doseArray(activityMBq)
+        normalLiverMask = self.liverMask & ~np.logical_or.reduce(list(self.tumourMasks.values()))
+        tumourDoses, normalLiverDose, lungDose = plan.doses(activityMBq)
+        # The dose map is the float32 counts times the rescale factor
+        np.testing.assert_allclose(tumourDoses, [np.mean(doseArray[mask]) for mask in self.tumourMasks.values()], rtol=1e-6)
+        np.testing.assert_allclose(normalLiverDose, np.mean(doseArray[normalLiverMask]), rtol=1e-6)
+        np.testing.assert_allclose(lungDose, activityMBq * 0.1 * self.parameters.conversionFactor / self.parameters.lungMassG)
+        np.testing.assert_allclose(plan.tumourToNormalRatios,
+                                   [np.mean(self.spect[mask]) / np.mean(self.spect[normalLiverMask]) for mask in self.tumourMasks.values()],
+                                   rtol=1e-6)
+
+    def test_activityLimits(self):
+        constraints = PartitionConstraints(maxLungDoseGy=30.0, maxNormalLiverDoseGy=70.0, minTumourDoseGy=120.0)
+        plan = planPartitionActivity(self.state, "Liver", self.parameters, constraints, ["Tumour_1", "Tumour_2"], self.segmentMasks)
+        # Each limit is the activity at which its compartment reaches the constraint
+        tumourDoses, _, _ = plan.doses(plan.minimumActivityMBq)
+        np.testing.assert_allclose(np.min(tumourDoses), 120.0, rtol=1e-9)
+        self.assertTrue(np.all(tumourDoses >= 120.0 - 1e-9))
+        np.testing.assert_allclose(plan.doses(plan.activityLimits["lung"])[2], 30.0, rtol=1e-9)
+        np.testing.assert_allclose(plan.doses(plan.activityLimits["normalLiver"])[1], 70.0, rtol=1e-9)
+        self.assertEqual(plan.maximumActivityMBq, min(plan.activityLimits["lung"], plan.activityLimits["normalLiver"]))
+        self.assertEqual(plan.feasible, plan.minimumActivityMBq <= plan.maximumActivityMBq)
+
+    def test_overlappingTumours(self):
+        # Segment_3 overlaps Tumour_1 and sticks out of the liver; the normal liver loses each tumour voxel once
+        tumourSegmentIDs = ["Tumour_1", "Tumour_2", "Segment_3"]
+        plan = planPartitionActivity(self.state, "Liver", self.parameters, PartitionConstraints(), tumourSegmentIDs,
+                                     self.segmentMasks)
+        activityMBq = 20.0
+        doseArray = self.doseArray(activityMBq)
+        union = np.logical_or.reduce([self.segmentMasks[segmentID].toArray() for segmentID in tumourSegmentIDs])
+        tumourDoses, normalLiverDose, _ = plan.doses(activityMBq)
+        np.testing.assert_allclose(normalLiverDose, np.mean(doseArray[self.liverMask & ~union]), rtol=1e-6)
+        np.testing.assert_allclose(tumourDoses[2], np.mean(doseArray[self.phantomMasks["Segment_3"]]), rtol=1e-6)
+
+    def test_partialVolumeOverlap(self):
+        liverFractions = makeFractions(self.liverMask, 2)
+        tumourFractions = [makeFractions(self.phantomMasks[segmentID], seed)
+                           for seed, segmentID in enumerate(["Tumour_1", "Segment_3"])]
+        segmentMasks = {"Tumour_1": FractionalSegmentMask(tumourFractions[0]),
+                        "Segment_3": FractionalSegmentMask(tumourFractions[1]),
+                        "Liver": FractionalSegmentMask(liverFractions)}
+        state = computeRelativeDoseState(self.spect, SPACING, segmentMasks["Liver"], segmentMasks)
+        plan = planPartitionActivity(state, "Liver", self.parameters, PartitionConstraints(), ["Tumour_1", "Segment_3"],
+                                     segmentMasks)
+        # Each voxel of the normal liver counts with its liver fraction less the part that the tumours cover
+        normalWeights = liverFractions - np.minimum(liverFractions, np.maximum(*tumourFractions))
+        doseArray = state.doseArray(20.0, self.parameters.lungShuntFraction, self.parameters.conversionFactor,
+                                    self.parameters.densityGPerML, dtype=np.float64)
+        np.testing.assert_allclose(plan.doses(20.0)[1], np.sum(doseArray * normalWeights) / np.sum(normalWeights), rtol=1e-5)
+
+    def test_tumoursCoverLiver(self):
+        segmentMasks = {"Tumour": SegmentMask(self.liverMask), "Liver": SegmentMask(self.liverMask)}
+        state = computeRelativeDoseState(self.spect, SPACING, self.liverMask, segmentMasks)
+        with self.assertRaises(ValueError):
+            planPartitionActivity(state, "Liver", self.parameters, PartitionConstraints(), ["Tumour"], segmentMasks)
+
+    def test_tumourSegmentsRequired(self):
+        with self.assertRaises(ValueError):
+            planPartitionActivity(self.state, "Liver", self.parameters, PartitionConstraints(), [], self.segmentMasks)
+
+
+if __name__ == "__main__":
+    unittest.main()
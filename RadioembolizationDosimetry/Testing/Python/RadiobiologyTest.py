@@ -0,0 +1,81 @@
+"""
+BED, EQD2 and EUD of segments and voxels, compared with the linear-quadratic formulas per voxel. The tests need only NumPy:
+
+    python RadiobiologyTest.py
+"""
+
+import os
+import sys
+import unittest
+
+import numpy as np
+
+# The library lives next to the module script, two folders up
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from DosimetryTestData import VOXEL_VOLUME_ML, makeLabelLayers, makePhantom  # noqa: E402
+from RadioembolizationDosimetryLib import (  # noqa: E402
+    BiologicalDoseMaps,
+    DosimetryResult,
+    TissueParameters,
+    computeDoseVolumeHistograms,
+    computeSegmentRadiobiology,
+    computeSegmentStatistics,
+    getBedQuadraticFactor,
+    getEqd2Factor,
+)
+
+
+class RadiobiologyTest(unittest.TestCase):
+
+    def setUp(self):
+        spect, liverMask, self.segmentMasks = makePhantom()
+        self.labelLayers = makeLabelLayers(self.segmentMasks, [["Tumour_1", "Tumour_2"], ["Segment_3"]])
+        self.dose = spect.astype(np.float64) * 1.2
+        self.halfLifeHours = 64.2
+        self.tumourTissue = TissueParameters(alphaBetaGy=10.0, repairHalfTimeHours=1.5, alphaPerGy=0.005)
+        self.normalTissue = TissueParameters(alphaBetaGy=2.5, repairHalfTimeHours=2.5, alphaPerGy=0.01)
+
+    def bed(self, dose, tissue):
+        # Dale's BED of a permanent implant: D + D^2 * lambda / ((mu + lambda) * alpha/beta)
+        decayConstant = np.log(2.0) / self.halfLifeHours
+        repairConstant = np.log(2.0) / tissue.repairHalfTimeHours
+        return dose + dose ** 2 * decayConstant / ((repairConstant + decayConstant) * tissue.alphaBetaGy)
+
+    def test_factors(self):
+        self.assertAlmostEqual(100.0 + getBedQuadraticFactor(self.tumourTissue, self.halfLifeHours) * 100.0 ** 2,
+                               self.bed(100.0, self.tumourTissue))
+        self.assertAlmostEqual(getEqd2Factor(self.normalTissue), self.normalTissue.alphaBetaGy / (self.normalTissue.alphaBetaGy + 2.0))
+
+    def test_segmentRadiobiology(self):
+        statistics = computeSegmentStatistics(self.dose, self.labelLayers, VOXEL_VOLUME_ML, squares=True)
+        numberOfBins = 20000
+        result = DosimetryResult(segmentIDs=statistics.segmentIDs, segmentDoses=statistics.means,
+                                 segmentMeanSquareDoses=statistics.meanSquares,
+                                 doseVolumeHistograms=computeDoseVolumeHistograms(self.dose, self.labelLayers, numberOfBins))
+        radiobiology = computeSegmentRadiobiology(result, {"Tumour_1": self.tumourTissue}, self.halfLifeHours,
+                                                  defaultTissue=self.normalTissue)
+        for index, (segmentID, mask) in enumerate(self.segmentMasks.items()):
+            tissue = self.tumourTissue if segmentID == "Tumour_1" else self.normalTissue
+            bed = self.bed(self.dose[mask], tissue)
+            np.testing.assert_allclose(radiobiology.meanBed[index], np.mean(bed), rtol=1e-10)
+            np.testing.assert_allclose(radiobiology.meanEqd2[index], np.mean(bed) * tissue.alphaBetaGy / (tissue.alphaBetaGy + 2.0),
+                                       rtol=1e-10)
+            # The EUD is evaluated on the histogram bins, so it matches the voxel EUD to the bin width
+            eud = -np.log(np.mean(np.exp(-tissue.alphaPerGy * bed))) / tissue.alphaPerGy
+            np.testing.assert_allclose(radiobiology.eud[index], eud, rtol=1e-3)
+
+    def test_biologicalDoseMaps(self):
+        tumourMask = self.segmentMasks["Tumour_1"]
+        maps = BiologicalDoseMaps(self.dose, self.halfLifeHours, tumourMask, self.tumourTissue, self.normalTissue)
+        expectedBed = np.where(tumourMask, self.bed(self.dose, self.tumourTissue), self.bed(self.dose, self.normalTissue))
+        expectedEqd2 = np.where(tumourMask, self.bed(self.dose, self.tumourTissue) * getEqd2Factor(self.tumourTissue),
+                                self.bed(self.dose, self.normalTissue) * getEqd2Factor(self.normalTissue))
+        np.testing.assert_allclose(maps.materialize("BED", dtype=np.float64, chunkSize=97), expectedBed, rtol=1e-12)
+        np.testing.assert_allclose(maps.materialize("EQD2", dtype=np.float64, chunkSize=97), expectedEqd2, rtol=1e-12)
+        with self.assertRaises(ValueError):
+            maps.materialize("EUD")
+
+
+if __name__ == "__main__":
+    unittest.main()
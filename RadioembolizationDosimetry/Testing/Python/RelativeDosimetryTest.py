@@ -0,0 +1,135 @@
+"""
+Patient-relative dose model and its cached dose state, compared with the per-segment loop
+of the original modules. The tests need only NumPy:
+
+    python RelativeDosimetryTest.py
+"""
+
+import os
+import sys
+import unittest
+
+import numpy as np
+
+# The library lives next to the module script, two folders up
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from DosimetryTestData import (  # noqa: E402
+    SHAPE,
+    SPACING,
+    VOXEL_VOLUME_ML,
+    baselineRelativeDose,
+    makeFractions,
+    makeLabelLayers,
+    makePhantom,
+)
+from RadioembolizationDosimetryLib import (  # noqa: E402
+    DosimetryParameters,
+    FractionalSegmentMask,
+    SegmentMask,
+    calculateRelativeDose,
+    computeRelativeDoseState,
+    solveActivityForTargetDose,
+)
+
+
+class RelativeDosimetryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.spect, self.liverMask, self.segmentMasks = makePhantom()
+        self.segmentMasks["Liver"] = self.liverMask
+        self.labelLayers = makeLabelLayers(self.segmentMasks, [["Tumour_1", "Tumour_2"], ["Segment_3"], ["Liver"]])
+        self.parameters = DosimetryParameters(activityMBq=1500.0, lungShuntFraction=0.08, doseDtype="float64")
+
+    def test_solveActivityMatchesBaseline(self):
+        # The original module evaluated the target segment at 1000 MBq and scaled the activity linearly
+        targetDoseGy = 150.0
+        _, segmentDoses, _, _ = baselineRelativeDose(self.spect, self.liverMask, self.segmentMasks, 1000.0,
+                                                     self.parameters.lungShuntFraction, self.parameters)
+        expected = targetDoseGy / segmentDoses["Tumour_1"] * 1000.0
+
+        state = computeRelativeDoseState(self.spect, SPACING, self.liverMask, self.labelLayers)
+        activityMBq = state.solveActivityForTargetDose("Tumour_1", targetDoseGy, self.parameters)
+        np.testing.assert_allclose(activityMBq, expected, rtol=1e-9)
+
+        index = state.segmentStatistics.segmentIDs.index("Tumour_1")
+        doses = state.segmentDoses(activityMBq, self.parameters.lungShuntFraction, self.parameters.conversionFactor,
+                                   self.parameters.densityGPerML)
+        np.testing.assert_allclose(doses[index], targetDoseGy, rtol=1e-9)
+
+    def test_solveActivityOutsideLiver(self):
+        with self.assertRaises(ValueError):
+            solveActivityForTargetDose(100.0, 0.0, 1000.0, 0.1, VOXEL_VOLUME_ML, 49.67, 1.05)
+
+    def test_stateMatchesBaselineForNewParameters(self):
+        # Activity and lung shunt changes only rescale the cached state, the masks are not read again
+        state = computeRelativeDoseState(self.spect, SPACING, self.liverMask, self.labelLayers)
+        for activityMBq, lungShuntFraction in [(1500.0, 0.08), (800.0, 0.2)]:
+            _, segmentDoses, _, _ = baselineRelativeDose(self.spect, self.liverMask, self.segmentMasks, activityMBq,
+                                                         lungShuntFraction, self.parameters)
+            doses = state.segmentDoses(activityMBq, lungShuntFraction, self.parameters.conversionFactor, self.parameters.densityGPerML)
+            np.testing.assert_allclose(doses, [segmentDoses[segmentID] for segmentID in state.segmentStatistics.segmentIDs], rtol=1e-6)
+
+    def test_matchesBaselineLoop(self):
+        result = calculateRelativeDose(self.spect, SPACING, self.liverMask, self.labelLayers, self.parameters)
+        doseArray, segmentDoses, segmentVolumes, segmentActivities = baselineRelativeDose(
+            self.spect, self.liverMask, self.segmentMasks, self.parameters.activityMBq, self.parameters.lungShuntFraction,
+            self.parameters)
+        np.testing.assert_allclose(result.doseArray, doseArray, rtol=1e-6)
+        for index, segmentID in enumerate(result.segmentIDs):
+            np.testing.assert_allclose(result.segmentDoses[index], segmentDoses[segmentID], rtol=1e-6)
+            np.testing.assert_allclose(result.segmentVolumes[index], segmentVolumes[segmentID], rtol=1e-12)
+            np.testing.assert_allclose(result.segmentActivities[index], segmentActivities[segmentID], rtol=1e-6)
+        expectedLungDose = self.parameters.activityMBq * self.parameters.lungShuntFraction * self.parameters.conversionFactor / self.parameters.lungMassG
+        self.assertAlmostEqual(result.lungDoseGy, expectedLungDose)
+
+    def test_liverMeanDoseIsActivityOverMass(self):
+        result = calculateRelativeDose(self.spect, SPACING, self.liverMask, self.labelLayers, self.parameters)
+        liverIndex = result.segmentIDs.index("Liver")
+        liverMassG = np.count_nonzero(self.liverMask) * VOXEL_VOLUME_ML * self.parameters.densityGPerML
+        expected = self.parameters.activityMBq * (1 - self.parameters.lungShuntFraction) * self.parameters.conversionFactor / liverMassG
+        np.testing.assert_allclose(result.segmentDoses[liverIndex], expected, rtol=1e-9)
+
+    def test_float32DoseArray(self):
+        state = computeRelativeDoseState(self.spect, SPACING, self.liverMask, self.labelLayers)
+        parameters = DosimetryParameters(activityMBq=self.parameters.activityMBq, lungShuntFraction=self.parameters.lungShuntFraction)
+        result = state.calculate(parameters)
+        self.assertEqual(result.doseArray.dtype, np.float32)
+        np.testing.assert_allclose(result.doseArray, state.calculate(self.parameters).doseArray, rtol=1e-6)
+        out = np.empty(SHAPE, dtype=np.float32)
+        self.assertIs(state.calculate(parameters, out=out).doseArray, out)
+
+    def test_sweepMatchesSingleEvaluations(self):
+        state = computeRelativeDoseState(self.spect, SPACING, self.liverMask, self.labelLayers)
+        activities, shunts = [1000.0, 2000.0], [0.0, 0.1]
+        sweep = state.sweep(activities, shunts, [49.67], [1.05], 1000.0)
+        row = 0
+        for activityMBq in activities:
+            for lungShuntFraction in shunts:
+                np.testing.assert_allclose(sweep.segmentDoses[row], state.segmentDoses(activityMBq, lungShuntFraction, 49.67, 1.05))
+                row += 1
+
+    def test_fractionalLiverMeanDoseIsActivityOverMass(self):
+        fractions = makeFractions(self.liverMask)
+        liverMask = FractionalSegmentMask(fractions)
+        state = computeRelativeDoseState(self.spect, SPACING, liverMask, {"Liver": liverMask})
+        dose = state.calculate(self.parameters, computeDoseArray=False).segmentDoses[0]
+        liverMassG = np.sum(fractions, dtype=np.float64) * VOXEL_VOLUME_ML * self.parameters.densityGPerML
+        expected = self.parameters.activityMBq * (1 - self.parameters.lungShuntFraction) * self.parameters.conversionFactor / liverMassG
+        np.testing.assert_allclose(dose, expected, rtol=1e-6)
+
+    def test_updateEditedSegment(self):
+        masks = {segmentID: SegmentMask(mask) for segmentID, mask in self.segmentMasks.items()}
+        state = computeRelativeDoseState(self.spect, SPACING, self.liverMask, masks)
+        edited = dict(masks, Tumour_2=SegmentMask(self.segmentMasks["Tumour_2"] | self.segmentMasks["Segment_3"]))
+        updated = state.updateSegments(edited, ["Tumour_2"])
+        expected = computeRelativeDoseState(self.spect, SPACING, self.liverMask, edited)
+        self.assertIs(updated.maskedArray, state.maskedArray)
+        np.testing.assert_allclose(updated.segmentStatistics.sums, expected.segmentStatistics.sums, rtol=1e-12)
+        np.testing.assert_array_equal(updated.segmentStatistics.counts, expected.segmentStatistics.counts)
+        np.testing.assert_allclose(updated.segmentStatistics.sumSquares, expected.segmentStatistics.sumSquares, rtol=1e-12)
+        np.testing.assert_array_equal(updated.countHistograms.voxelCounts, expected.countHistograms.voxelCounts)
+
+
+if __name__ == "__main__":
+    unittest.main()
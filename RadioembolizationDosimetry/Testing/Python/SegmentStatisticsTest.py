@@ -0,0 +1,89 @@
+"""
+Per-segment statistics of label layers and segment masks, compared with the per-segment
+loop of the original modules. The tests need only NumPy:
+
+    python SegmentStatisticsTest.py
+"""
+
+import importlib
+import os
+import sys
+import unittest
+from unittest import mock
+
+import numpy as np
+
+# The library lives next to the module script, two folders up
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from DosimetryTestData import SHAPE, VOXEL_VOLUME_ML, makeFractions, makeLabelLayers, makePhantom  # noqa: E402
+from RadioembolizationDosimetryLib import (  # noqa: E402
+    FractionalSegmentMask,
+    SegmentMask,
+    computeSegmentStatistics,
+)
+
+# The package namespace re-exports the classes, which hide the modules of the same name
+SegmentStatisticsModule = importlib.import_module("RadioembolizationDosimetryLib.SegmentStatistics")
+
+
+class SegmentStatisticsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.spect, self.liverMask, self.segmentMasks = makePhantom()
+        self.labelLayers = makeLabelLayers(self.segmentMasks, [["Tumour_1", "Tumour_2"], ["Segment_3"]])
+
+    def assertMatchesLoop(self, statistics, segmentMasks, values):
+        self.assertEqual(statistics.segmentIDs, list(segmentMasks))
+        for index, (segmentID, mask) in enumerate(segmentMasks.items()):
+            segmentValues = values[mask].astype(np.float64)
+            self.assertEqual(statistics.counts[index], segmentValues.size)
+            np.testing.assert_allclose(statistics.sums[index], segmentValues.sum(), rtol=1e-10)
+            np.testing.assert_allclose(statistics.means[index], np.mean(segmentValues), rtol=1e-10)
+            np.testing.assert_allclose(statistics.meanSquares[index], np.mean(segmentValues ** 2), rtol=1e-10)
+            np.testing.assert_allclose(statistics.volumes[index], segmentValues.size * VOXEL_VOLUME_ML, rtol=1e-12)
+
+    def test_labelLayers(self):
+        statistics = computeSegmentStatistics(self.spect, self.labelLayers, VOXEL_VOLUME_ML, squares=True)
+        self.assertMatchesLoop(statistics, self.segmentMasks, self.spect)
+
+    def test_labelLayersInChunks(self):
+        with mock.patch.object(SegmentStatisticsModule, "STATISTICS_CHUNK_SIZE", 37):
+            statistics = computeSegmentStatistics(self.spect, self.labelLayers, VOXEL_VOLUME_ML, squares=True)
+        self.assertMatchesLoop(statistics, self.segmentMasks, self.spect)
+
+    def test_geometryMismatch(self):
+        with self.assertRaises(ValueError):
+            computeSegmentStatistics(self.spect[1:], self.labelLayers, VOXEL_VOLUME_ML)
+
+    def test_segmentMasks(self):
+        masks = {segmentID: SegmentMask(mask) for segmentID, mask in self.segmentMasks.items()}
+        statistics = computeSegmentStatistics(self.spect, masks, VOXEL_VOLUME_ML, squares=True)
+        self.assertMatchesLoop(statistics, self.segmentMasks, self.spect)
+
+    def test_emptySegment(self):
+        masks = {"Empty": SegmentMask(np.zeros(SHAPE, dtype=bool))}
+        statistics = computeSegmentStatistics(self.spect, masks, VOXEL_VOLUME_ML)
+        self.assertEqual(statistics.counts[0], 0)
+        self.assertTrue(np.isnan(statistics.means[0]))
+
+    def test_fractionalSegmentMasks(self):
+        fractions = {segmentID: makeFractions(mask) for segmentID, mask in self.segmentMasks.items()}
+        masks = {segmentID: FractionalSegmentMask(value) for segmentID, value in fractions.items()}
+        statistics = computeSegmentStatistics(self.spect, masks, VOXEL_VOLUME_ML, squares=True)
+        values = self.spect.astype(np.float64)
+        for index, weights in enumerate(fractions.values()):
+            weights = weights.astype(np.float64)
+            np.testing.assert_allclose(statistics.counts[index], weights.sum(), rtol=1e-6)
+            np.testing.assert_allclose(statistics.means[index], np.sum(weights * values) / weights.sum(), rtol=1e-6)
+            np.testing.assert_allclose(statistics.meanSquares[index], np.sum(weights * values ** 2) / weights.sum(), rtol=1e-6)
+
+    def test_updated(self):
+        statistics = computeSegmentStatistics(self.spect, self.labelLayers, VOXEL_VOLUME_ML, squares=True)
+        edited = dict(self.segmentMasks, Tumour_2=self.segmentMasks["Tumour_2"] | self.segmentMasks["Segment_3"])
+        update = computeSegmentStatistics(self.spect, {"Tumour_2": SegmentMask(edited["Tumour_2"])}, VOXEL_VOLUME_ML, squares=True)
+        self.assertMatchesLoop(statistics.updated(update), edited, self.spect)
+
+
+if __name__ == "__main__":
+    unittest.main()
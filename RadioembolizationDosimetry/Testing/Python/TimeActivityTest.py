@@ -0,0 +1,85 @@
+"""
+Mono-exponential time-activity fits, compared with exact curves and np.polyfit. The tests need only NumPy:
+
+    python TimeActivityTest.py
+"""
+
+import os
+import sys
+import unittest
+
+import numpy as np
+
+# The library lives next to the module script, two folders up
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from DosimetryTestData import SHAPE, SPACING, makeLabelLayers, makePhantom  # noqa: E402
+from RadioembolizationDosimetryLib import (  # noqa: E402
+    DosimetryParameters,
+    calculateTimeIntegratedDose,
+    computeTimeIntegratedActivity,
+    fitMonoExponential,
+)
+
+
+class TimeActivityTest(unittest.TestCase):
+
+    def setUp(self):
+        self.hours = np.array([4.0, 24.0, 72.0, 144.0])
+        self.physicalDecayConstant = np.log(2.0) / 64.2
+
+    def test_exactExponentials(self):
+        amplitudes = np.array([100.0, 5.0, 2000.0])
+        decayConstants = np.array([0.05, 0.02, 0.3])
+        values = amplitudes * np.exp(-decayConstants * self.hours[:, np.newaxis])
+        fittedAmplitudes, fittedDecayConstants = fitMonoExponential(self.hours, values, self.physicalDecayConstant)
+        np.testing.assert_allclose(fittedAmplitudes, amplitudes, rtol=1e-10)
+        np.testing.assert_allclose(fittedDecayConstants, decayConstants, rtol=1e-10)
+
+    def test_matchesLeastSquaresFit(self):
+        rng = np.random.default_rng(3)
+        values = 50.0 * np.exp(-0.04 * self.hours[:, np.newaxis]) * rng.uniform(0.8, 1.2, (self.hours.size, 5))
+        fittedAmplitudes, fittedDecayConstants = fitMonoExponential(self.hours, values, self.physicalDecayConstant)
+        for column in range(values.shape[1]):
+            slope, intercept = np.polyfit(self.hours, np.log(values[:, column]), 1)
+            np.testing.assert_allclose(fittedDecayConstants[column], max(-slope, self.physicalDecayConstant), rtol=1e-9)
+            if -slope >= self.physicalDecayConstant:
+                np.testing.assert_allclose(fittedAmplitudes[column], np.exp(intercept), rtol=1e-9)
+
+    def test_physicalDecayLimits(self):
+        # Uptake that rises over time and a curve with a zero are both decay-corrected with the physical decay
+        values = np.stack([10.0 * np.exp(0.01 * self.hours), np.array([10.0, 0.0, 5.0, 2.0])], axis=1)
+        fittedAmplitudes, fittedDecayConstants = fitMonoExponential(self.hours, values, self.physicalDecayConstant)
+        np.testing.assert_allclose(fittedDecayConstants, self.physicalDecayConstant)
+        expected = np.mean(values * np.exp(self.physicalDecayConstant * self.hours)[:, np.newaxis], axis=0)
+        np.testing.assert_allclose(fittedAmplitudes[1], expected[1], rtol=1e-10)
+
+    def test_singleTimepoint(self):
+        fittedAmplitudes, fittedDecayConstants = fitMonoExponential([24.0], [[80.0]], self.physicalDecayConstant)
+        np.testing.assert_allclose(fittedDecayConstants, self.physicalDecayConstant)
+        np.testing.assert_allclose(fittedAmplitudes, 80.0 * np.exp(self.physicalDecayConstant * 24.0))
+
+    def test_timeIntegratedActivityPerVoxel(self):
+        rng = np.random.default_rng(4)
+        amplitudes = rng.uniform(10.0, 1000.0, SHAPE)
+        decayConstants = rng.uniform(self.physicalDecayConstant, 0.2, SHAPE)
+        petArrays = [(amplitudes * np.exp(-decayConstants * hours)).astype(np.float32) for hours in self.hours]
+        integral = computeTimeIntegratedActivity(petArrays, self.hours, 64.2, chunkSize=101)
+        np.testing.assert_allclose(integral, amplitudes / decayConstants, rtol=1e-4)
+
+    def test_segmentFitWithDoseKernel(self):
+        # With the same uptake pattern at every timepoint, the segment fit must give the segment means of the
+        # convolved dose map, including the spill-in and spill-out of the kernel
+        spect, liverMask, segmentMasks = makePhantom(5)
+        labelLayers = makeLabelLayers(segmentMasks, [["Tumour_1", "Tumour_2"], ["Segment_3"]])
+        petArrays = [(spect * np.exp(-0.03 * hours)).astype(np.float32) for hours in self.hours]
+        parameters = DosimetryParameters(doseKernel="Y-90")
+        voxelResult = calculateTimeIntegratedDose(petArrays, self.hours, SPACING, labelLayers, parameters, "voxel")
+        segmentResult = calculateTimeIntegratedDose(petArrays, self.hours, SPACING, labelLayers, parameters, "segment")
+        np.testing.assert_allclose(segmentResult.segmentDoses, voxelResult.segmentDoses, rtol=1e-4)
+        np.testing.assert_allclose(segmentResult.doseArray, voxelResult.doseArray, rtol=1e-4, atol=1e-6)
+        np.testing.assert_allclose(segmentResult.segmentEffectiveHalfLivesHours, np.log(2.0) / 0.03, rtol=1e-6)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+"""
+Monte Carlo propagation of parameter uncertainty, compared with one model evaluation per sample. The tests need only NumPy:
+
+    python UncertaintyTest.py
+"""
+
+import os
+import sys
+import unittest
+
+import numpy as np
+
+# The library lives next to the module script, two folders up
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from DosimetryTestData import SPACING, makeLabelLayers, makePhantom  # noqa: E402
+from RadioembolizationDosimetryLib import (  # noqa: E402
+    DosimetryParameters,
+    ParameterUncertainty,
+    UncertaintyModel,
+    computeRelativeDoseState,
+    propagateRelativeDoseUncertainty,
+)
+
+
+class UncertaintyTest(unittest.TestCase):
+
+    def setUp(self):
+        spect, liverMask, segmentMasks = makePhantom()
+        labelLayers = makeLabelLayers(segmentMasks, [["Tumour_1", "Tumour_2"], ["Segment_3"]])
+        self.state = computeRelativeDoseState(spect, SPACING, liverMask, labelLayers)
+        self.parameters = DosimetryParameters(activityMBq=1500.0, lungShuntFraction=0.08)
+        self.model = UncertaintyModel({"lungShuntFraction": ParameterUncertainty("normal", 0.02),
+                                       "densityGPerML": ParameterUncertainty("uniform", 0.05),
+                                       "lungMassG": ParameterUncertainty("normal", 100.0)}, numberOfSamples=200, seed=5)
+
+    def test_samplesMatchSingleEvaluations(self):
+        uncertainty = propagateRelativeDoseUncertainty(self.state, self.parameters, self.model)
+        samples = self.model.sample(self.parameters)
+        self.assertTrue(np.all((samples["lungShuntFraction"] >= 0) & (samples["lungShuntFraction"] <= 1)))
+        for index in range(self.model.numberOfSamples):
+            doses = self.state.segmentDoses(self.parameters.activityMBq, samples["lungShuntFraction"][index],
+                                            samples["conversionFactor"][index], samples["densityGPerML"][index])
+            np.testing.assert_allclose(uncertainty.segmentDoseSamples[index], doses, rtol=1e-12)
+        lungDoses = self.parameters.activityMBq * samples["lungShuntFraction"] * samples["conversionFactor"] / samples["lungMassG"]
+        np.testing.assert_allclose(uncertainty.lungDoseSamples, lungDoses, rtol=1e-12)
+
+    def test_intervals(self):
+        uncertainty = propagateRelativeDoseUncertainty(self.state, self.parameters, self.model)
+        lower, upper = uncertainty.segmentIntervals
+        np.testing.assert_allclose(lower, np.percentile(uncertainty.segmentDoseSamples, 2.5, axis=0))
+        np.testing.assert_allclose(upper, np.percentile(uncertainty.segmentDoseSamples, 97.5, axis=0))
+        self.assertEqual(uncertainty.lungDoseInterval, tuple(np.percentile(uncertainty.lungDoseSamples, [2.5, 97.5])))
+
+        # Without distributions every sample is the nominal dose
+        fixed = propagateRelativeDoseUncertainty(self.state, self.parameters, UncertaintyModel(numberOfSamples=10))
+        nominal = self.state.segmentDoses(self.parameters.activityMBq, self.parameters.lungShuntFraction,
+                                          self.parameters.conversionFactor, self.parameters.densityGPerML)
+        for bound in fixed.segmentIntervals:
+            np.testing.assert_allclose(bound, nominal, rtol=1e-12)
+
+    def test_sameSeedSameSamples(self):
+        first = propagateRelativeDoseUncertainty(self.state, self.parameters, self.model)
+        second = propagateRelativeDoseUncertainty(self.state, self.parameters, self.model)
+        np.testing.assert_array_equal(first.segmentDoseSamples, second.segmentDoseSamples)
+        with self.assertRaises(ValueError):
+            UncertaintyModel({"densityGPerML": ParameterUncertainty("lognormal", 0.1)}).sample(self.parameters)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -6,13 +6,45 @@ import logging
 import qt
 import ctk
 import vtk
+from RadioembolizationDosimetryLib import (
+    DEFAULT_DVH_METRICS,
+    DEFAULT_ISODOSE_LEVELS,
+    DOSE_ENGINES,
+    BackgroundJob,
+    DosimetryParameters,
+    NORMAL_LIVER_TISSUE,
+    PARTIAL_VOLUME_AUTO,
+    TUMOUR_TISSUE,
+    StageTimer,
+    acquireOutputVolume,
+    calculateAbsoluteDose,
+    calculateTimeIntegratedDose,
+    computeSegmentRadiobiology,
+    finishOutputVolume,
+    getChangedSegmentIDs,
+    formatRtfReport,
+    getMetricUnit,
+    getSegmentIDs,
+    getSegmentMasks,
+    getSegmentationStateKey,
+    prepareOutputVolume,
+    releaseOutputVolume,
+    timedStage,
+    updateAbsoluteDoseSegments,
+)
+from RadioembolizationDosimetryLib.WidgetMixins import (
+    BackgroundJobWidgetMixin,
+    IsodoseWidgetMixin,
+    RadiobiologyWidgetMixin,
+    SegmentObserverWidgetMixin,
+)
 
 class RadioembolizationDosimetryabs(ScriptedLoadableModule):
     def __init__(self, parent):
         ScriptedLoadableModule.__init__(self, parent)
         parent.title = "Taranis - Dosimetry (Absolute Quantification)"
         parent.categories = ["Nuclear Medicine"]
-        parent.dependencies = []
+        parent.dependencies = ["RadioembolizationDosimetry"]
         parent.contributors = ["Burak Demir, MD, FEBNM"]
         parent.helpText = """
         This module calculates a dosimetry model for radioembolization using SPECT and PET images.
@@ -25,7 +57,8 @@ class RadioembolizationDosimetryabs(ScriptedLoadableModule):
         self.parent.icon = qt.QIcon(iconPath)  # Assign icon to the module
         self.parent = parent
 
-class RadioembolizationDosimetryabsWidget(ScriptedLoadableModuleWidget):
+class RadioembolizationDosimetryabsWidget(BackgroundJobWidgetMixin, RadiobiologyWidgetMixin, IsodoseWidgetMixin,
+                                          SegmentObserverWidgetMixin, ScriptedLoadableModuleWidget):
     def setup(self):
         ScriptedLoadableModuleWidget.setup(self)
 
@@ -130,16 +163,52 @@ class RadioembolizationDosimetryabsWidget(ScriptedLoadableModuleWidget):
         self.outputVolumeSelector.setToolTip("Select the output volume for the Gy maps.")
         formLayout.addRow("Output Volume: ", self.outputVolumeSelector)
 
+        # Dose Engine
+        self.doseEngineComboBox = qt.QComboBox()
+        self.doseEngineComboBox.addItems([label for label, nuclide in DOSE_ENGINES])
+        self.doseEngineComboBox.setToolTip("Local deposition keeps the dose in the voxel where the activity is. "
+                                           "Approximate dose kernel convolves the activity with an exponential beta point kernel "
+                                           "of the nuclide in water, not with tabulated voxel S-values.")
+        formLayout.addRow("Dose Engine: ", self.doseEngineComboBox)
+
+        # Partial-volume segments
+        self.partialVolumeCheckBox = qt.QCheckBox()
+        self.partialVolumeCheckBox.setToolTip("Rasterise each segment at sub-voxel resolution and weight every voxel by the "
+                                              "fraction the segment covers. Keeps small lesions stable on coarse SPECT grids.")
+        formLayout.addRow("Partial-volume Segments: ", self.partialVolumeCheckBox)
+
+        # Output Precision
+        self.outputPrecisionComboBox = qt.QComboBox()
+        self.outputPrecisionComboBox.addItems(["float32", "float64"])
+        self.outputPrecisionComboBox.setToolTip("Precision of the dose map. float64 doubles its memory use.")
+        formLayout.addRow("Output Precision: ", self.outputPrecisionComboBox)
+
         # Calculate Button
         self.calculateButton = qt.QPushButton("Calculate")
         self.calculateButton.toolTip = "Perform dosimetric calculations."
         formLayout.addRow(self.calculateButton)
 
+        # Progress of the running calculation
+        self.progressBar = qt.QProgressBar()
+        self.progressBar.setRange(0, 100)
+        self.progressBar.setValue(0)
+        self.progressBar.setTextVisible(True)
+        formLayout.addRow("Progress: ", self.progressBar)
+
+        # Cancel Button
+        self.cancelButton = qt.QPushButton("Cancel")
+        self.cancelButton.toolTip = "Cancel the running calculation."
+        self.cancelButton.enabled = False
+        formLayout.addRow(self.cancelButton)
+
         # Segment Dose Table
         self.segmentDoseTable = qt.QTableWidget()
-        self.segmentDoseTable.setColumnCount(4)
-        self.segmentDoseTable.setHorizontalHeaderLabels(["Segment", "Dose (Gy)","Volume (mL)","Activity (MBq)"])
-        self.segmentDoseTable.setFixedSize(400,350)
+        self.dvhMetricColumns = [f"{name} ({getMetricUnit(name)})" for name in DEFAULT_DVH_METRICS]
+        self.radiobiologyColumns = ["Mean BED (Gy)", "Mean EQD2 (Gy)", "EUD (Gy)"]
+        self.metricColumns = self.dvhMetricColumns + self.radiobiologyColumns + ["Eff. Half-Life (h)"]
+        self.segmentDoseTable.setColumnCount(4 + len(self.metricColumns))
+        self.segmentDoseTable.setHorizontalHeaderLabels(["Segment", "Dose (Gy)","Volume (mL)","Activity (MBq)"] + self.metricColumns)
+        self.segmentDoseTable.setFixedSize(640,350)
         formLayout.addRow("Segment Doses: ", self.segmentDoseTable)
 
 
@@ -162,8 +231,113 @@ class RadioembolizationDosimetryabsWidget(ScriptedLoadableModuleWidget):
         self.dectotalActivityTextBox.setToolTip("Displays the total calculated decay corrected activity in MBq.")
         formLayout.addRow("Total Decay\nCorr Act (MBq): ", self.dectotalActivityTextBox)
         
+        # Multiple timepoints: registered volumes of the same patient, integrated with a mono-exponential fit
+        timepointsCollapsibleButton = ctk.ctkCollapsibleButton()
+        timepointsCollapsibleButton.text = "Multiple Timepoints"
+        timepointsCollapsibleButton.collapsed = True
+        self.layout.addWidget(timepointsCollapsibleButton)
+        timepointsFormLayout = qt.QFormLayout(timepointsCollapsibleButton)
+
+        self.multiTimepointCheckBox = qt.QCheckBox()
+        self.multiTimepointCheckBox.setToolTip("Integrate the time-activity curve of the input volume and the timepoints below "
+                                               "instead of decay-correcting the input volume alone.")
+        timepointsFormLayout.addRow("Integrate Timepoints: ", self.multiTimepointCheckBox)
+
+        self.timeActivityFitComboBox = qt.QComboBox()
+        self.timeActivityFitComboBox.addItems(["Per voxel", "Per segment"])
+        self.timeActivityFitComboBox.setToolTip("Fit a mono-exponential to every voxel, or to the mean curve of every segment.")
+        timepointsFormLayout.addRow("Fit: ", self.timeActivityFitComboBox)
+
+        self.timepointSelector = slicer.qMRMLNodeComboBox()
+        self.timepointSelector.nodeTypes = ["vtkMRMLScalarVolumeNode"]
+        self.timepointSelector.noneEnabled = True
+        self.timepointSelector.showHidden = False
+        self.timepointSelector.setMRMLScene(slicer.mrmlScene)
+        self.timepointSelector.setToolTip("Volume of a later timepoint, registered and resampled to the input PET volume.")
+        timepointsFormLayout.addRow("Timepoint Volume: ", self.timepointSelector)
+
+        self.timepointHoursSpinBox = qt.QDoubleSpinBox()
+        self.timepointHoursSpinBox.setRange(0.0, 2000.0)
+        self.timepointHoursSpinBox.setSingleStep(1.0)
+        self.timepointHoursSpinBox.setToolTip("Hours after treatment at which the timepoint was acquired.")
+        timepointsFormLayout.addRow("Hours after treatment: ", self.timepointHoursSpinBox)
+
+        self.addTimepointButton = qt.QPushButton("Add Timepoint")
+        self.removeTimepointButton = qt.QPushButton("Remove Selected Timepoint")
+        timepointsFormLayout.addRow(self.addTimepointButton)
+        timepointsFormLayout.addRow(self.removeTimepointButton)
+
+        self.timepointTable = qt.QTableWidget()
+        self.timepointTable.setColumnCount(2)
+        self.timepointTable.setHorizontalHeaderLabels(["Volume", "Hours"])
+        self.timepointTable.setFixedSize(640, 150)
+        timepointsFormLayout.addRow("Timepoints: ", self.timepointTable)
+        self.timepoints = []
+
+        # Radiobiology: BED and EQD2 of tumour and normal liver, with maps that are only computed when shown
+        radiobiologyCollapsibleButton = ctk.ctkCollapsibleButton()
+        radiobiologyCollapsibleButton.text = "Radiobiology"
+        radiobiologyCollapsibleButton.collapsed = True
+        self.layout.addWidget(radiobiologyCollapsibleButton)
+        radiobiologyFormLayout = qt.QFormLayout(radiobiologyCollapsibleButton)
+
+        self.tumourSegmentSelector = slicer.qMRMLSegmentSelectorWidget()
+        self.tumourSegmentSelector.multiSelection = True
+        self.tumourSegmentSelector.setMRMLScene(slicer.mrmlScene)
+        self.tumourSegmentSelector.setToolTip("Segments with the tumour parameters; all others use the normal liver parameters.")
+        radiobiologyFormLayout.addRow("Tumour Segments: ", self.tumourSegmentSelector)
+
+        self.tumourTissueWidgets = self.createTissueRows(radiobiologyFormLayout, "Tumour", TUMOUR_TISSUE)
+        self.normalTissueWidgets = self.createTissueRows(radiobiologyFormLayout, "Normal Liver", NORMAL_LIVER_TISSUE)
+
+        self.showBedButton = qt.QPushButton("Show BED Map")
+        self.showBedButton.toolTip = "Compute the BED map from the dose map in the output volume."
+        radiobiologyFormLayout.addRow(self.showBedButton)
+        self.showEqd2Button = qt.QPushButton("Show EQD2 Map")
+        self.showEqd2Button.toolTip = "Compute the EQD2 map from the dose map in the output volume."
+        radiobiologyFormLayout.addRow(self.showEqd2Button)
+
+        # Isodose segments: all levels from one digitisation of the dose map, with volumes and segment overlaps
+        isodoseCollapsibleButton = ctk.ctkCollapsibleButton()
+        isodoseCollapsibleButton.text = "Isodose Segments"
+        isodoseCollapsibleButton.collapsed = True
+        self.layout.addWidget(isodoseCollapsibleButton)
+        isodoseFormLayout = qt.QFormLayout(isodoseCollapsibleButton)
+
+        self.isodoseLevelsLineEdit = qt.QLineEdit(", ".join(f"{level:g}" for level in DEFAULT_ISODOSE_LEVELS))
+        self.isodoseLevelsLineEdit.setToolTip("Isodose levels in Gy, separated by commas.")
+        isodoseFormLayout.addRow("Levels (Gy): ", self.isodoseLevelsLineEdit)
+
+        self.isodoseAfterCalculationCheckBox = qt.QCheckBox()
+        self.isodoseAfterCalculationCheckBox.setToolTip("Create the isodose segments whenever a dose calculation finishes.")
+        isodoseFormLayout.addRow("Create After Calculation: ", self.isodoseAfterCalculationCheckBox)
+
+        self.createIsodoseButton = qt.QPushButton("Create Isodose Segments")
+        self.createIsodoseButton.toolTip = "Add one segment per level to the Isodose Segments segmentation, from the dose map in the output volume."
+        isodoseFormLayout.addRow(self.createIsodoseButton)
+
+        self.isodoseTable = qt.QTableWidget()
+        self.isodoseTable.setFixedSize(640, 200)
+        isodoseFormLayout.addRow("Isodose Regions: ", self.isodoseTable)
+        self.isodoseSegmentationNodeID = None
+
         # Connections
         self.calculateButton.connect('clicked(bool)', self.onCalculateButton)
+        self.createIsodoseButton.connect('clicked(bool)', self.onCreateIsodoseClicked)
+        self.segmentationSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.tumourSegmentSelector.setCurrentNode)
+        self.showBedButton.connect('clicked(bool)', self.onShowBedClicked)
+        self.showEqd2Button.connect('clicked(bool)', self.onShowEqd2Clicked)
+        self.addTimepointButton.connect('clicked(bool)', self.onAddTimepointClicked)
+        self.removeTimepointButton.connect('clicked(bool)', self.onRemoveTimepointClicked)
+
+        # Calculations run as background jobs that are polled from the main thread
+        self.setupBackgroundJobs()
+
+        # Segment edits are tracked, so Calculate only recomputes the statistics of the edited segments
+        self.doseResult = None
+        self.doseResultKey = None
+        self.setupSegmentObserver(self.segmentationSelector.currentNode())
+        self.segmentationSelector.connect("currentNodeChanged(vtkMRMLNode*)", self.observeSegmentation)
 
         # Add vertical spacer
         self.layout.addStretch(1)
@@ -198,127 +372,289 @@ class RadioembolizationDosimetryabsWidget(ScriptedLoadableModuleWidget):
             slicer.util.errorDisplay(message)
             return
 
+        # Perform dosimetric calculations in the background
+        self.startDoseCalculation(spectVolumeNode, segmentationNode, hourelapsed, outputVolumeNode)
+
+    def showDoseMap(self, outputVolumeNode, backgroundVolumeID):
+        """
+        Show the dose map over backgroundVolumeID, the background volume from before the calculation.
+        """
         sliceWidget = slicer.app.layoutManager().sliceWidget(slicer.app.layoutManager().sliceViewNames()[0])
         sliceCompositeNode = sliceWidget.mrmlSliceCompositeNode()
-        backgroundVolumeid = slicer.app.layoutManager().sliceWidget("Red").mrmlSliceCompositeNode().GetBackgroundVolumeID()
-
-        # Perform dosimetric calculations
-        self.calculateDose(spectVolumeNode, segmentationNode, hourelapsed, outputVolumeNode,self.totalActivityTextBox,self.dectotalActivityTextBox,self.segmentDoseTable)
-        self.outputVolumeSelector.currentNode().SetName("Dose Map (Gy)")
-        foregroundVolumeid = self.outputVolumeSelector.currentNode().GetID()
-        sliceCompositeNode.SetBackgroundVolumeID(backgroundVolumeid)
-        sliceCompositeNode.SetForegroundVolumeID(foregroundVolumeid)
+        sliceCompositeNode.SetBackgroundVolumeID(backgroundVolumeID)
+        outputVolumeNode.SetName("Dose Map (Gy)")
+        sliceCompositeNode.SetForegroundVolumeID(outputVolumeNode.GetID())
         sliceCompositeNode.SetForegroundOpacity(0.5)
-        segmentationNode
-        
-        
-    def calculateDose(self, spectVolumeNode, segmentationNode, hourelapsed, outputVolumeNode, totalActivityTextBox,dectotalActivityTextBox,segmentDoseTable):
+
+    def startDoseCalculation(self, spectVolumeNode, segmentationNode, hourelapsed, outputVolumeNode):
         """
-        Perform dosimetric calculations using the given inputs.
+        Run the dose calculation as a background job. Label map export and all scene updates stay on
+        the main thread; total activity, rescaling and segment statistics run on a worker thread.
         """
-        logging.info("Starting dosimetric calculations.")
+        if self.job is not None:
+            slicer.util.errorDisplay("A dose calculation is already running.")
+            return
+        outputVolumeID = outputVolumeNode.GetID()
+        if not acquireOutputVolume(outputVolumeID):
+            slicer.util.errorDisplay(f"Another calculation is writing to {outputVolumeNode.GetName()}. "
+                                     "Wait until it finishes or select another output volume.")
+            return
 
-        # Validate inputs
-        if not spectVolumeNode or not segmentationNode or not outputVolumeNode:
-            raise ValueError("Invalid inputs. Please select valid nodes.")
+        timer = StageTimer("RadioembolizationDosimetryabs")
+        timer.start()
+        backgroundVolumeID = slicer.app.layoutManager().sliceWidget("Red").mrmlSliceCompositeNode().GetBackgroundVolumeID()
+        self.setCalculationRunning(True)
+        try:
+            self.progressBar.value = 0
+            self.progressBar.format = "labelmapExport: %p%"
+            slicer.app.processEvents()
+            inputs = self.getDoseInputs(spectVolumeNode, segmentationNode, hourelapsed, timer)
+            timepointInputs = self.getTimepointInputs(spectVolumeNode, hourelapsed)
+            # If only segments were edited, the dose volume and the other rows of the last result are reused
+            key = self.getDoseResultKey(spectVolumeNode, segmentationNode, outputVolumeNode, inputs[3])
+            previousResult = self.doseResult
+            editedSegmentIDs = None
+            if timepointInputs is None and outputVolumeNode is not spectVolumeNode:
+                editedSegmentIDs = self.getEditedSegmentIDs(key)
+            self.editedSegmentIDs = set()
+        except Exception as e:
+            releaseOutputVolume(outputVolumeID)
+            self.setCalculationRunning(False)
+            timer.error = f"{type(e).__name__}: {e}"
+            timer.finish()
+            slicer.util.errorDisplay(f"Dose calculation failed: {e}")
+            return
 
-        # Clone the input volume to the output volume to inherit spatial properties
-        volumesLogic = slicer.modules.volumes.logic()
-        clonedOutputVolumeNode = volumesLogic.CloneVolume(slicer.mrmlScene, spectVolumeNode, outputVolumeNode.GetName())
-        outputVolumeNode.Copy(clonedOutputVolumeNode)
-        outputVolumeNode.SetAttribute("DicomRtImport.DoseVolume", "1")
-        slicer.mrmlScene.RemoveNode(clonedOutputVolumeNode)
+        def calculate(job):
+            if editedSegmentIDs is not None:
+                job.setStage("segmentStatistics")
+                with timer.stage("segmentStatistics"):
+                    spectArray, spacing, segmentMasks, parameters = inputs
+                    result = updateAbsoluteDoseSegments(previousResult, segmentMasks, editedSegmentIDs, spacing, parameters)
+            else:
+                job.setStage("absoluteDose")
+                with timer.stage("absoluteDose"):
+                    result = self.computeDose(inputs, timepointInputs)
+            job.setStage("writeOutput")
+            return result
+
+        def onFinished(job):
+            self.writeDoseOutputs(spectVolumeNode, segmentationNode, outputVolumeNode, job.result,
+                                  self.totalActivityTextBox, self.dectotalActivityTextBox, self.segmentDoseTable, timer)
+            # Keep the voxels of the output volume rather than a second copy, so that segment updates do not copy them again
+            if outputVolumeNode is not spectVolumeNode:
+                job.result.doseArray = slicer.util.arrayFromVolume(outputVolumeNode)
+            # The key is taken after writing, as writing the output volume changes its modification time
+            self.doseResult = job.result
+            self.doseResultKey = None
+            if timepointInputs is None:
+                self.doseResultKey = self.getDoseResultKey(spectVolumeNode, segmentationNode, outputVolumeNode, inputs[3],
+                                                           key[1])
+            self.showDoseMap(outputVolumeNode, backgroundVolumeID)
+
+        stageNames = ["absoluteDose" if editedSegmentIDs is None else "segmentStatistics", "writeOutput"]
+        self.runJob(BackgroundJob(calculate, stageNames, "Dose calculation"), outputVolumeID, timer, onFinished)
+
+    def getDoseResultKey(self, spectVolumeNode, segmentationNode, outputVolumeNode, parameters, segmentationStateKey=None):
+        """
+        Key identifying the inputs, output volume and segments of a dose result. segmentationStateKey
+        defaults to the current state of the segmentation.
+        """
+        imageData = spectVolumeNode.GetImageData()
+        outputImageData = outputVolumeNode.GetImageData()
+        inputsKey = (spectVolumeNode.GetID(), spectVolumeNode.GetMTime(), imageData.GetMTime() if imageData else 0,
+                     outputVolumeNode.GetID(), outputImageData.GetMTime() if outputImageData else 0,
+                     parameters.hoursElapsed, parameters.halfLifeHours, parameters.conversionFactor,
+                     parameters.densityGPerML, parameters.doseDtype, parameters.doseKernel, self.getSegmentOversampling())
+        if segmentationStateKey is None:
+            segmentationStateKey = getSegmentationStateKey(segmentationNode)
+        return inputsKey, segmentationStateKey
+
+    def getEditedSegmentIDs(self, key):
+        """
+        Segments edited since the last dose result, if its inputs and output volume are unchanged so that
+        only their statistics need recomputing. None if the dose must be recomputed.
+        """
+        if self.doseResult is None or self.doseResultKey is None:
+            return None
+        inputsKey, segmentationStateKey = key
+        cachedInputsKey, cachedSegmentationStateKey = self.doseResultKey
+        if inputsKey != cachedInputsKey:
+            return None
+        changedSegmentIDs = getChangedSegmentIDs(cachedSegmentationStateKey, segmentationStateKey)
+        # Changes that were not observed, e.g. made while another segmentation was selected, need a full update
+        if changedSegmentIDs is None or not self.editedSegmentIDs.issuperset(changedSegmentIDs):
+            return None
+        return changedSegmentIDs
+
+    def getSegmentOversampling(self):
+        """
+        Oversampling argument of getSegmentMasks: PARTIAL_VOLUME_AUTO for partial-volume masks, None for binary masks.
+        """
+        return PARTIAL_VOLUME_AUTO if self.partialVolumeCheckBox.checked else None
 
+    def getDoseInputs(self, spectVolumeNode, segmentationNode, hourelapsed, timer=None):
+        """
+        Arguments of calculateAbsoluteDose: the PET array, spacing, segment masks and parameters.
+        Reads the scene, so it must run on the main thread.
+        """
         # Get input volume array
         spectArray = slicer.util.arrayFromVolume(spectVolumeNode)
         if spectArray is None:
             raise ValueError("Unable to access data from the input SPECT volume.")
 
-        # Calculate total volume in mL
-        spacing = spectVolumeNode.GetSpacing()  # spacing is in mm
-        voxelVolumeML = (spacing[0] * spacing[1] * spacing[2]) / 1000.0  # convert mm^3 to mL
-        totalVolumeML = spectArray.size * voxelVolumeML
-        if totalVolumeML == 0:
-            raise ValueError("Total volume is zero. Ensure the SPECT volume contains valid data.")
-
-        # Calculate mean input value per voxel
-        meanInputValue = np.sum(spectArray) / spectArray.size
-        activityMBq = totalVolumeML * meanInputValue /1000000
-        totalActivityTextBox.setText(f"{activityMBq:.2f} MBq")
-
-        # Decay correction
-        activityMBq = activityMBq * (2.0 ** (hourelapsed / self.halfLifeSpinBox.value))
-        # Update total activity text box
-        dectotalActivityTextBox.setText(f"{activityMBq:.2f} MBq")
-
-        # Constants for Y-90 dosimetry
-        conversionFactor = self.conversionFactorSpinBox.value
-        densityGPerML = self.liverDensitySpinBox.value
-
-        # Calculate mean output dose
-        meanOutputDoseGy = (activityMBq / (totalVolumeML * densityGPerML)) * conversionFactor
+        # Segment masks come from the shared labelmap cache, so unchanged segments are not exported again.
+        # Segment statistics only read the bounding box of each mask.
+        segmentation = segmentationNode.GetSegmentation()
+        with timedStage(timer, "labelmapExport"):
+            segmentMasks = getSegmentMasks(segmentationNode, getSegmentIDs(segmentation), spectVolumeNode,
+                                           oversampling=self.getSegmentOversampling())
+
+        parameters = DosimetryParameters(
+            hoursElapsed=hourelapsed,
+            halfLifeHours=self.halfLifeSpinBox.value,
+            conversionFactor=self.conversionFactorSpinBox.value,
+            densityGPerML=self.liverDensitySpinBox.value,
+            doseDtype=self.outputPrecisionComboBox.currentText,
+            doseKernel=DOSE_ENGINES[self.doseEngineComboBox.currentIndex][1],
+        )
+        return spectArray, spectVolumeNode.GetSpacing(), segmentMasks, parameters
 
-        # Rescale factor to normalize dose
-        rescaleFactor = meanOutputDoseGy / meanInputValue
+    def getTimepointInputs(self, spectVolumeNode, hourelapsed):
+        """
+        Arrays and acquisition hours of the input volume and the added timepoints, and the fit mode,
+        or None if timepoints are not integrated. Reads the scene, so it must run on the main thread.
+        """
+        if not self.multiTimepointCheckBox.checked:
+            return None
+        petArrays = [slicer.util.arrayFromVolume(spectVolumeNode)]
+        hoursElapsed = [hourelapsed]
+        for nodeID, hours in self.timepoints:
+            timepointNode = slicer.mrmlScene.GetNodeByID(nodeID)
+            if timepointNode is None:
+                raise ValueError("A timepoint volume was removed from the scene.")
+            timepointArray = slicer.util.arrayFromVolume(timepointNode)
+            if timepointArray is None or timepointArray.shape != petArrays[0].shape:
+                raise ValueError(f"Timepoint {timepointNode.GetName()} does not match the geometry of the input PET volume. "
+                                 "Register and resample it to the input volume first.")
+            petArrays.append(timepointArray)
+            hoursElapsed.append(hours)
+        if len(set(hoursElapsed)) < 2:
+            raise ValueError("Add at least one timepoint acquired at another time than the input PET volume.")
+        fitMode = "voxel" if self.timeActivityFitComboBox.currentIndex == 0 else "segment"
+        return petArrays, hoursElapsed, fitMode
+
+    def computeDose(self, inputs, timepointInputs):
+        """
+        Absolute dose from the single input volume, or the time-integrated dose of several timepoints.
+        """
+        if timepointInputs is None:
+            return calculateAbsoluteDose(*inputs)
+        spectArray, spacing, segmentMasks, parameters = inputs
+        petArrays, hoursElapsed, fitMode = timepointInputs
+        return calculateTimeIntegratedDose(petArrays, hoursElapsed, spacing, segmentMasks, parameters, fitMode)
+
+    def onAddTimepointClicked(self):
+        timepointNode = self.timepointSelector.currentNode()
+        if not timepointNode:
+            slicer.util.errorDisplay("Select a timepoint volume first.")
+            return
+        self.timepoints.append((timepointNode.GetID(), self.timepointHoursSpinBox.value))
+        self.updateTimepointTable()
+
+    def onRemoveTimepointClicked(self):
+        row = self.timepointTable.currentRow()
+        if 0 <= row < len(self.timepoints):
+            del self.timepoints[row]
+            self.updateTimepointTable()
+
+    def updateTimepointTable(self):
+        self.timepointTable.setRowCount(len(self.timepoints))
+        for row, (nodeID, hours) in enumerate(self.timepoints):
+            timepointNode = slicer.mrmlScene.GetNodeByID(nodeID)
+            self.timepointTable.setItem(row, 0, qt.QTableWidgetItem(timepointNode.GetName() if timepointNode else nodeID))
+            self.timepointTable.setItem(row, 1, qt.QTableWidgetItem(f"{hours:.1f}"))
+
+    def writeDoseOutputs(self, spectVolumeNode, segmentationNode, outputVolumeNode, result, totalActivityTextBox, dectotalActivityTextBox, segmentDoseTable, timer=None):
+        """
+        Show the activities of a DosimetryResult, write its dose array to the output volume and fill the segment dose table.
+        """
+        segmentation = segmentationNode.GetSegmentation()
 
-        # Write rescaled dose values to output volume
-        doseArray = spectArray * rescaleFactor
-        slicer.util.updateVolumeFromArray(outputVolumeNode, doseArray)
+        # Update total activity text boxes
+        totalActivityTextBox.setText(f"{result.totalActivityMBq:.2f} MBq")
+        dectotalActivityTextBox.setText(f"{result.decayCorrectedActivityMBq:.2f} MBq")
+
+        # The output volume is only touched once the dose is complete, so a cancelled or failed
+        # calculation leaves it as it was. A dose array that is already the output buffer is not copied.
+        doseArray = result.doseArray
+        with timedStage(timer, "writeOutputVolume"):
+            if outputVolumeNode is not spectVolumeNode:
+                prepareOutputVolume(spectVolumeNode, outputVolumeNode, doseArray.dtype)
+            outputVolumeNode.SetAttribute("DicomRtImport.DoseVolume", "1")
+            finishOutputVolume(outputVolumeNode, doseArray)
  
         # Set window/level for the output volume display
-        displayNode = outputVolumeNode.GetDisplayNode()
-        if displayNode:
-            maxDoseGy = np.max(doseArray)
-            window = 250
-            level = 125
-            displayNode.SetAutoWindowLevel(False)
-            displayNode.SetWindow(window)
-            displayNode.SetLevel(level)
-            colorNode = slicer.util.getNode('PET-Rainbow2')
-            displayNode.SetAndObserveColorNodeID(colorNode.GetID())
-        
-        # Calculate mean dose for each segment
-        segmentation = segmentationNode.GetSegmentation()
-        segmentIDs = vtk.vtkStringArray()
-        segmentation.GetSegmentIDs(segmentIDs)
+        with timedStage(timer, "display"):
+            displayNode = outputVolumeNode.GetDisplayNode()
+            if displayNode:
+                window = 250
+                level = 125
+                displayNode.SetAutoWindowLevel(False)
+                displayNode.SetWindow(window)
+                displayNode.SetLevel(level)
+                colorNode = slicer.util.getNode('PET-Rainbow2')
+                displayNode.SetAndObserveColorNodeID(colorNode.GetID())
 
         segmentDoses = {}
         segmentVolumes = {}
         segmentActivity = {}
-
-        for i in range(segmentIDs.GetNumberOfValues()):
-            segmentID = segmentIDs.GetValue(i)
+        segmentMetrics = {}
+        metrics = result.doseVolumeHistograms.metrics(DEFAULT_DVH_METRICS) if result.doseVolumeHistograms else {}
+        if result.radiobiology is None and result.segmentMeanSquareDoses is not None:
+            result.radiobiology = computeSegmentRadiobiology(result, self.getSegmentTissues(), self.halfLifeSpinBox.value,
+                                                             self.getTissueParameters(self.normalTissueWidgets))
+        radiobiology = result.radiobiology
+
+        for index, segmentID in enumerate(result.segmentIDs):
             segmentName = segmentation.GetSegment(segmentID).GetName()
-
-            # Create label map for segment
-            labelMapVolumeNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLabelMapVolumeNode")
-            slicer.modules.segmentations.logic().ExportSegmentsToLabelmapNode(
-                segmentationNode, [segmentID], labelMapVolumeNode, spectVolumeNode
-            )
-
-            # Mask dose array to calculate mean dose for the segment
-            labelMapArray = slicer.util.arrayFromVolume(labelMapVolumeNode)
-            maskedDoseArray = doseArray[labelMapArray == 1]
-            segmentDoses[segmentName] = np.mean(maskedDoseArray)
-            segmentVolumes[segmentName] = voxelVolumeML*maskedDoseArray.size
-            segmentActivity[segmentName] = (((voxelVolumeML*maskedDoseArray.size)*segmentDoses[segmentName])/conversionFactor)*densityGPerML
-            # Remove temporary label map node
-            slicer.mrmlScene.RemoveNode(labelMapVolumeNode)
+            segmentDoses[segmentName] = result.segmentDoses[index]
+            segmentVolumes[segmentName] = result.segmentVolumes[index]
+            segmentActivity[segmentName] = result.segmentActivities[index]
+            segmentMetrics[segmentName] = [values[index] for values in metrics.values()]
+            if radiobiology:
+                segmentMetrics[segmentName] += [radiobiology.meanBed[index], radiobiology.meanEqd2[index], radiobiology.eud[index]]
+            if result.segmentEffectiveHalfLivesHours is not None:
+                segmentMetrics[segmentName].append(result.segmentEffectiveHalfLivesHours[index])
 
         # Populate table with segment doses
-        segmentDoseTable.setRowCount(0)
-        for segmentName, dose in segmentDoses.items():
-            rowPosition = segmentDoseTable.rowCount
-            segmentDoseTable.insertRow(rowPosition)
-            segmentDoseTable.setItem(rowPosition, 0, qt.QTableWidgetItem(segmentName))
-            segmentDoseTable.setItem(rowPosition, 1, qt.QTableWidgetItem(f"{dose:.2f}"))
-            segmentDoseTable.setItem(rowPosition, 2, qt.QTableWidgetItem(f"{segmentVolumes[segmentName]:.2f}"))
-            segmentDoseTable.setItem(rowPosition, 3, qt.QTableWidgetItem(f"{segmentActivity[segmentName]:.2f}"))     
-
-        logging.info("Dosimetric calculations completed.")
+        with timedStage(timer, "segmentTable"):
+            segmentDoseTable.setRowCount(0)
+            for segmentName, dose in segmentDoses.items():
+                rowPosition = segmentDoseTable.rowCount
+                segmentDoseTable.insertRow(rowPosition)
+                segmentDoseTable.setItem(rowPosition, 0, qt.QTableWidgetItem(segmentName))
+                segmentDoseTable.setItem(rowPosition, 1, qt.QTableWidgetItem(f"{dose:.2f}"))
+                segmentDoseTable.setItem(rowPosition, 2, qt.QTableWidgetItem(f"{segmentVolumes[segmentName]:.2f}"))
+                segmentDoseTable.setItem(rowPosition, 3, qt.QTableWidgetItem(f"{segmentActivity[segmentName]:.2f}"))
+                for column, value in enumerate(segmentMetrics[segmentName], 4):
+                    segmentDoseTable.setItem(rowPosition, column, qt.QTableWidgetItem(f"{value:.2f}"))
+
+        if self.isodoseAfterCalculationCheckBox.checked:
+            self.createIsodoseSegmentsFromDose(outputVolumeNode, segmentationNode, timer)
         return segmentDoses
         
         
+    def getSegmentTableRows(self):
+        """
+        Texts of the segment dose table rows as (segment, dose, volume, activity, *DVH metrics), None for empty cells.
+        """
+        rows = []
+        for row in range(self.segmentDoseTable.rowCount):
+            items = [self.segmentDoseTable.item(row, column) for column in range(self.segmentDoseTable.columnCount)]
+            rows.append(tuple(item.text() if item else None for item in items))
+        return rows
+
     def onSaveReportClicked(self):
         # Open file dialog to select save path
         fileDialog = qt.QFileDialog()
@@ -329,44 +665,18 @@ class RadioembolizationDosimetryabsWidget(ScriptedLoadableModuleWidget):
             fileName += ".rtf"
 
         # Build RTF content
-        import datetime
-        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         conversionFactor = self.conversionFactorSpinBox.value
         liverDensity = self.liverDensitySpinBox.value
-        rtf = r"""{\rtf1\ansi\deff0
-{\b Taranis - Absolute Quantification\line
-\b Radioembolization Dosimetry Report}\line
-Generated: """ + now + r"""\line
-\line
-{\b Parameters}\line
-Activity During Imaging: """ + f"{self.totalActivityTextBox.text}" + r"""\line
-Decay Corrected Activity: """ + f"{self.dectotalActivityTextBox.text}" + r"""\line
-Conversion Factor: """ + f"{conversionFactor:.2f} Gy/MBq/g" + r"""\line
-Liver Density: """ + f"{liverDensity:.2f} g/mL" + r"""\line
-\line
-{\b Segment Doses}\line
-"""
-
-        rowCount = self.segmentDoseTable.rowCount
-        colCount = self.segmentDoseTable.columnCount
-        for row in range(rowCount):
-            segment = self.segmentDoseTable.item(row, 0)
-            dose = self.segmentDoseTable.item(row, 1)
-            vol = self.segmentDoseTable.item(row, 2) if colCount > 2 else None
-            act = self.segmentDoseTable.item(row, 3) if colCount > 3 else None
-            
-            rtf += f"Segment: {segment.text()}, "
-
-            if dose:
-                rtf += f"Dose = {dose.text()} Gy"
-            if vol:
-                rtf += f", Volume = {vol.text()} mL"
-            if act:
-                rtf += f", Activity = {act.text()} MBq"
-            rtf += r"\line\n "
-
-        rtf += r"\line\n End of Report}"
-        
+        parameters = [
+            ("Activity During Imaging", f"{self.totalActivityTextBox.text}"),
+            ("Decay Corrected Activity", f"{self.dectotalActivityTextBox.text}"),
+            ("Conversion Factor", f"{conversionFactor:.2f} Gy/MBq/g"),
+            ("Liver Density", f"{liverDensity:.2f} g/mL"),
+        ]
+        parameters += self.getRadiobiologyReportParameters()
+        rtf = formatRtfReport("Taranis - Absolute Quantification", parameters, self.getSegmentTableRows(),
+                              metricColumns=self.metricColumns)
+
         # Write to file
         with open(fileName, "w") as file:
             file.write(rtf)
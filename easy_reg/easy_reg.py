@@ -6,6 +6,7 @@ import logging
 import qt
 import ctk
 import vtk
+from RadioembolizationDosimetryLib import StageTimer
   
 
 class easy_reg(ScriptedLoadableModule):
@@ -13,7 +14,7 @@ class easy_reg(ScriptedLoadableModule):
         ScriptedLoadableModule.__init__(self, parent)
         parent.title = "EasyReg"
         parent.categories = ["Nuclear Medicine"]
-        parent.dependencies = []
+        parent.dependencies = ["RadioembolizationDosimetry"]
         parent.contributors = ["Burak Demir, MD, FEBNM"]
         parent.helpText = """
         This module provides easy workflow for registration of SPECT/CT images to diagnostic CT/MR images.
@@ -381,6 +382,14 @@ class easy_regWidget(ScriptedLoadableModuleWidget):
             slicer.util.errorDisplay("❌ Error: Please select both SPECT CT and Reference CT volumes before registration.")
             return
 
+        with StageTimer("easy_reg") as timer:
+            timer.info["method"] = self.getSelectedRegistrationMethod()
+            self.runRegistration(spectCT, referenceCT, timer)
+
+    def runRegistration(self, spectCT, referenceCT, timer):
+        """
+        Run BRAINSFit with the selected method, harden the transform and show the result.
+        """
         print("🚀 Starting  registration...")
 
 
@@ -403,7 +412,8 @@ class easy_regWidget(ScriptedLoadableModuleWidget):
                 "samplingPercentage": 0.002,
                 "useInitialTransform": True,
             }
-            slicer.cli.runSync(slicer.modules.brainsfit, None, parameters)
+            with timer.stage("brainsfit"):
+                slicer.cli.runSync(slicer.modules.brainsfit, None, parameters)
 
             print("✅ Registration completed!")
             slicer.util.infoDisplay("✅ Registration completed successfully!")
@@ -415,9 +425,10 @@ class easy_regWidget(ScriptedLoadableModuleWidget):
                 spect.SetAndObserveTransformNodeID(transformNode.GetID())
 
             # **✅ Step 5: Harden the Transform**
-            slicer.vtkSlicerTransformLogic().hardenTransform(spectCT)
-            if spect:
-                slicer.vtkSlicerTransformLogic().hardenTransform(spect)
+            with timer.stage("hardenTransform"):
+                slicer.vtkSlicerTransformLogic().hardenTransform(spectCT)
+                if spect:
+                    slicer.vtkSlicerTransformLogic().hardenTransform(spect)
 
             print("✅ Transform applied and hardened to both SPECT CT and SPECT.")
             slicer.util.infoDisplay("✅ Transform successfully applied and hardened.")
@@ -439,7 +450,8 @@ class easy_regWidget(ScriptedLoadableModuleWidget):
                 "samplingPercentage": 0.002,
                 "useInitialTransform": True,
             }
-            slicer.cli.runSync(slicer.modules.brainsfit, None, parameters)
+            with timer.stage("brainsfit"):
+                slicer.cli.runSync(slicer.modules.brainsfit, None, parameters)
 
             print("✅ Registration completed!")
             slicer.util.infoDisplay("✅ Registration completed successfully!")
@@ -451,9 +463,10 @@ class easy_regWidget(ScriptedLoadableModuleWidget):
                 spect.SetAndObserveTransformNodeID(transformNode.GetID())
 
             # **✅ Step 5: Harden the Transform**
-            slicer.vtkSlicerTransformLogic().hardenTransform(spectCT)
-            if spect:
-                slicer.vtkSlicerTransformLogic().hardenTransform(spect)
+            with timer.stage("hardenTransform"):
+                slicer.vtkSlicerTransformLogic().hardenTransform(spectCT)
+                if spect:
+                    slicer.vtkSlicerTransformLogic().hardenTransform(spect)
 
             print("✅ Transform applied and hardened to both SPECT CT and SPECT.")
             slicer.util.infoDisplay("✅ Transform successfully applied and hardened.")
@@ -478,7 +491,8 @@ class easy_regWidget(ScriptedLoadableModuleWidget):
                 "samplingPercentage": 0.002,
                 "useInitialTransform": True,
             }
-            slicer.cli.runSync(slicer.modules.brainsfit, None, parameters)
+            with timer.stage("brainsfit"):
+                slicer.cli.runSync(slicer.modules.brainsfit, None, parameters)
 
             print("✅ Registration completed!")
             slicer.util.infoDisplay("✅ Registration completed successfully!")
@@ -490,9 +504,10 @@ class easy_regWidget(ScriptedLoadableModuleWidget):
                 spect.SetAndObserveTransformNodeID(transformNode.GetID())
 
             # **✅ Step 5: Harden the Transform**
-            slicer.vtkSlicerTransformLogic().hardenTransform(spectCT)
-            if spect:
-                slicer.vtkSlicerTransformLogic().hardenTransform(spect)
+            with timer.stage("hardenTransform"):
+                slicer.vtkSlicerTransformLogic().hardenTransform(spectCT)
+                if spect:
+                    slicer.vtkSlicerTransformLogic().hardenTransform(spect)
 
             print("✅ Transform applied and hardened to both SPECT CT and SPECT.")
             slicer.util.infoDisplay("✅ Transform successfully applied and hardened.")
@@ -508,7 +523,8 @@ class easy_regWidget(ScriptedLoadableModuleWidget):
         else:
             return void
         # **✅ Step 6: Visualize Registration**
-        self.visualizeRegistration()
+        with timer.stage("visualize"):
+            self.visualizeRegistration()
 
 
     def visualizeRegistration(self):